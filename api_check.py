@@ -69,7 +69,7 @@ def search_header_tuple(headers, header_name):
             return value
     return None
 
-def do_request(host_port, method, url, body=None, accept_statuses=[200]):
+def do_request(host_port, method, url, body=None, accept_statuses=[200], headers=None):
     def describe_request():
         return "%s %s%s" % (method, host_port, url)
 
@@ -77,7 +77,7 @@ def do_request(host_port, method, url, body=None, accept_statuses=[200]):
     try:
         conn = httplib.HTTPConnection(host_port, timeout=10)
         try:
-            conn.request(method, url, body)
+            conn.request(method, url, body, headers or {})
             r = conn.getresponse()
         except Exception as e:
             raise Exception(describe_request()
@@ -163,6 +163,56 @@ class SimpleApiCheck(unittest.TestCase):
         self.assertIsInstance(r.body["successor"], json_str_type)
         self.assertIsInstance(r.body["others"], list)
 
+class ConditionalPutApiCheck(unittest.TestCase):
+
+    KEYS = 10
+    CAS_WRITERS = 4
+    CAS_ROUNDS = 10
+
+    def setUp(self):
+        if len(test_nodes) < 1:
+            raise unittest.SkipTest("Need at least one node")
+
+    def test_if_match_races_unconditional_put(self):
+        # Each If-Match write records the ETag of the value it replaced. A lost update shows as two
+        # writes that replaced the same value, or as an acknowledged unconditional write that is
+        # neither the final value nor the value some If-Match write replaced
+        for k in range(self.KEYS):
+            key = "api-test-cas-key-{}".format(uuid.uuid4())
+            do_request(test_nodes[0], "PUT", "/storage/"+key, "initial")
+            replaced = []
+            plain = []
+
+            def cas_writer(writer):
+                node = test_nodes[writer % len(test_nodes)]
+                for n in range(self.CAS_ROUNDS):
+                    r = do_request(node, "GET", "/storage/"+key)
+                    etag = search_header_tuple(r.headers, "ETag")
+                    value = "cas-{}-{}".format(writer, n)
+                    r = do_request(node, "PUT", "/storage/"+key, value, accept_statuses=[200, 412],
+                            headers={"If-Match": etag})
+                    if r.status == 200:
+                        replaced.append(etag)
+
+            def plain_writer():
+                time.sleep(random.random() * 0.05)
+                r = do_request(test_nodes[-1], "PUT", "/storage/"+key, "plain-{}".format(k))
+                plain.append(search_header_tuple(r.headers, "ETag"))
+
+            threads = [threading.Thread(target=cas_writer, args=(i,)) for i in range(self.CAS_WRITERS)]
+            threads.append(threading.Thread(target=plain_writer))
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            r = do_request(test_nodes[0], "GET", "/storage/"+key)
+            final_etag = search_header_tuple(r.headers, "ETag")
+            self.assertEqual(len(replaced), len(set(replaced)), "Two If-Match writes replaced the same value")
+            self.assertEqual(len(plain), 1, "The unconditional write did not complete")
+            self.assertTrue(plain[0] == final_etag or plain[0] in replaced,
+                    "The unconditional write was acknowledged but lost")
+
 class JoinLeaveApiCheck(unittest.TestCase):
 
     def setUp(self):
@@ -252,6 +302,7 @@ if __name__ == "__main__":
     test_loader = unittest.TestLoader()
 
     test_suite.addTests(test_loader.loadTestsFromTestCase(SimpleApiCheck))
+    test_suite.addTests(test_loader.loadTestsFromTestCase(ConditionalPutApiCheck))
     test_suite.addTests(test_loader.loadTestsFromTestCase(JoinLeaveApiCheck))
     test_suite.addTests(test_loader.loadTestsFromTestCase(SimCrashApiCheck))
 
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import bisect
+import collections
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlencode
+
+from chord_client import parse_nodes
+from crawler import crawl
+from server import ring_hash
+from store import DUMP_MAGIC, RECORD, complete_records
+from transport import HttpTransport
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="backup", description="Export every key of a ring to a dump file, or load a dump into a ring")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export = commands.add_parser("export", help="stream every node's own range, concurrently, into one dump")
+    export.add_argument("nodes", type=str,
+            help="seed addresses: the JSON list printed by run.sh, a comma separated list, or a file holding either")
+    export.add_argument("output", type=str,
+            help="dump file to write")
+    export.add_argument("--format", type=str, default="ndjson", choices=["ndjson", "binary"],
+            help="ndjson writes one {key, value} object per line; binary writes length-prefixed records "
+                 "and keeps compressed values compressed (default ndjson)")
+    export.add_argument("--parallel", type=int, default=16,
+            help="nodes exported at once (default 16)")
+    export.add_argument("--timeout", type=float, default=30,
+            help="seconds to wait for each node (default 30)")
+
+    load = commands.add_parser("import", help="load a dump into the ring, in batches sent straight to each key's owner")
+    load.add_argument("nodes", type=str,
+            help="seed addresses: the JSON list printed by run.sh, a comma separated list, or a file holding either")
+    load.add_argument("dump", type=str,
+            help="dump file written by export, in either format; the NDJSON output of scan.py works too")
+    load.add_argument("--batch", type=int, default=1000,
+            help="records per request (default 1000)")
+    load.add_argument("--parallel", type=int, default=16,
+            help="requests in flight (default 16)")
+    load.add_argument("--chunk-size", type=float, default=4,
+            help="MB of the dump read and routed at a time; progress is saved a chunk at a time (default 4)")
+    load.add_argument("--resume", action="store_true",
+            help="continue from the progress saved by an interrupted import of the same dump")
+    load.add_argument("--retries", type=int, default=3,
+            help="attempts per batch before the import stops (default 3)")
+    load.add_argument("--timeout", type=float, default=30,
+            help="seconds to wait for each request (default 30)")
+
+    return parser
+
+
+def ring_nodes(seeds, timeout):
+    """(sorted node ids, their addresses, M, hash) of the live nodes reachable from `seeds`."""
+    states, errors, _ = asyncio.run(crawl(seeds, timeout=timeout))
+    if not states:
+        raise RuntimeError(f"No live nodes reachable from {', '.join(seeds)}")
+    if errors:
+        print(f"skipping {len(errors)} unreachable or crashed nodes", file=sys.stderr)
+    pairs = sorted((state["node_id"], address) for address, state in states.items())
+    state = next(iter(states.values()))
+    return [node_id for node_id, _ in pairs], [address for _, address in pairs], state["M"], state.get("hash", "sha1")
+
+
+def export_node(address, lo, hi, binary, out, lock, timeout, block_size=1 << 20):
+    """Copy the entries of (lo, hi] that `address` holds into `out`, whole records at a time."""
+    started = time.perf_counter()
+    conn = http.client.HTTPConnection(address, timeout=timeout)
+    try:
+        conn.request("GET", "/export?" + urlencode({"lo": lo, "hi": hi, "format": "binary" if binary else "ndjson"}))
+        resp = conn.getresponse()
+        if resp.status != 200:
+            raise RuntimeError(f"GET /export on {address} failed with status {resp.status}: {resp.read().decode()}")
+        pending = b""
+        records = size = 0
+        while True:
+            block = resp.read(block_size)
+            if not block:
+                break
+            pending += block
+            end, count = complete_records(pending, binary)
+            if end:
+                # Other nodes write to the same file, so each write has to hold whole records
+                with lock:
+                    out.write(pending[:end])
+                pending = pending[end:]
+                records += count
+                size += end
+        if pending:
+            raise RuntimeError(f"Export from {address} ended in the middle of a record")
+    finally:
+        conn.close()
+    return {"node": address, "records": records, "bytes": size, "seconds": time.perf_counter() - started}
+
+
+def export(args):
+    started = time.perf_counter()
+    ids, addresses, M, _ = ring_nodes(parse_nodes(args.nodes), args.timeout)
+    binary = args.format == "binary"
+    lock = threading.Lock()
+    nodes, failed = [], {}
+    with open(args.output, "wb") as out, ThreadPoolExecutor(args.parallel) as executor:
+        if binary:
+            out.write(DUMP_MAGIC)
+        # Each node exports the range from its predecessor in the crawled ring, so every id is covered once
+        futures = {executor.submit(export_node, address, ids[i - 1], ids[i], binary, out, lock, args.timeout): address
+                   for i, address in enumerate(addresses)}
+        for future in as_completed(futures):
+            try:
+                nodes.append(future.result())
+            except Exception as e:
+                failed[futures[future]] = str(e)
+                continue
+            print(f"exported {len(nodes)}/{len(addresses)} nodes, {sum(node['records'] for node in nodes)} records", file=sys.stderr)
+    seconds = time.perf_counter() - started
+    size = sum(node["bytes"] for node in nodes)
+    return {
+        "output": args.output,
+        "format": args.format,
+        "M": M,
+        "nodes": len(addresses),
+        "records": sum(node["records"] for node in nodes),
+        "bytes": size,
+        "seconds": seconds,
+        "MB_per_s": size / seconds / 1e6,
+        "failed": failed,
+        "per_node": sorted(nodes, key=lambda node: node["node"]),
+    }
+
+
+def dump_chunks(f, binary, offset, chunk_size):
+    """Yield (end offset, data) for the whole records of the dump from `offset` on, about `chunk_size` bytes at a time."""
+    f.seek(offset)
+    pending = b""
+    while True:
+        block = f.read(chunk_size)
+        if not block:
+            if binary and pending:
+                raise ValueError(f"Dump ends in the middle of a record at byte {offset}")
+            if pending.strip():
+                # The last NDJSON line may lack its newline
+                yield offset + len(pending), pending
+            return
+        pending += block
+        end, _ = complete_records(pending, binary)
+        if end:
+            offset += end
+            yield offset, pending[:end]
+            pending = pending[end:]
+
+
+def split_records(data, binary):
+    """Yield (key, raw record bytes) for the records in `data`."""
+    if not binary:
+        for line in data.splitlines(keepends=True):
+            if line.strip():
+                yield json.loads(line)["key"], line
+        return
+    offset = 0
+    while offset < len(data):
+        key_size, value_size, _ = RECORD.unpack_from(data, offset)
+        end = offset + RECORD.size + key_size + value_size
+        yield data[offset + RECORD.size:offset + RECORD.size + key_size].decode(), data[offset:end]
+        offset = end
+
+
+def route(data, binary, ids, addresses, M, hash_name, batch):
+    """Group the records of one chunk by the node that owns them, in batches of at most `batch`."""
+    owners = collections.defaultdict(list)
+    for key, record in split_records(data, binary):
+        owners[addresses[bisect.bisect_left(ids, ring_hash(key, M, hash_name)) % len(ids)]].append(record)
+    return [(owner, records[i:i + batch]) for owner, records in owners.items() for i in range(0, len(records), batch)]
+
+
+def send_batch(transport, owner, records, binary, addresses, retries, timeout):
+    """PUT one batch, trying the owner first and then other nodes, which forward what they do not own."""
+    body = b"".join(records)
+    headers = {"Content-type": "application/octet-stream" if binary else "application/x-ndjson"}
+    error = None
+    for attempt in range(retries):
+        target = owner if attempt == 0 else addresses[(addresses.index(owner) + attempt) % len(addresses)]
+        try:
+            status, text, _ = transport.request(target, "PUT", "/import", body=body, headers=headers, timeout=timeout)
+        except OSError as e:
+            error = f"{target}: {e!r}"
+        else:
+            counts = json.loads(text) if status == 200 else None
+            if counts is not None and not counts["failed"]:
+                return counts
+            error = f"{target}: {counts['failed']} records failed" if counts else f"{target} answered {status}: {text}"
+        time.sleep(0.5 * 2 ** attempt)
+    raise RuntimeError(f"Batch of {len(records)} records failed {retries} times, last {error}")
+
+
+def write_state(path, state):
+    # Written aside and renamed, so an interrupted import never leaves a half-written checkpoint
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.replace(path + ".tmp", path)
+
+
+def load(args):
+    started = time.perf_counter()
+    ids, addresses, M, hash_name = ring_nodes(parse_nodes(args.nodes), args.timeout)
+    state_path = args.dump + ".import-state"
+    size = os.path.getsize(args.dump)
+    with open(args.dump, "rb") as f:
+        binary = f.read(len(DUMP_MAGIC)) == DUMP_MAGIC
+    state = {"dump_bytes": size, "offset": len(DUMP_MAGIC) if binary else 0, "records": 0}
+    if args.resume and os.path.exists(state_path):
+        with open(state_path) as f:
+            saved = json.load(f)
+        if saved["dump_bytes"] != size:
+            raise RuntimeError(f"{state_path} belongs to a dump of {saved['dump_bytes']} bytes, not this one of {size}")
+        state = saved
+        print(f"resuming at byte {state['offset']} after {state['records']} records", file=sys.stderr)
+    elif args.resume:
+        print(f"no {state_path}, starting from the beginning", file=sys.stderr)
+    first_offset, first_records = state["offset"], state["records"]
+
+    counts = {"stored": 0, "forwarded": 0}
+    window = collections.deque()  # (end offset, records, futures) of the chunks in flight, in dump order
+    error = None
+    transport = HttpTransport(args.timeout, pool_size=args.parallel)
+    last_report = 0
+
+    def settle():
+        # Chunks finish out of order, but progress only moves past a chunk once every earlier one is stored too
+        nonlocal last_report
+        end, records, futures = window.popleft()
+        for future in futures:
+            for name, count in future.result().items():
+                if name in counts:
+                    counts[name] += count
+        state["offset"], state["records"] = end, state["records"] + records
+        write_state(state_path, state)
+        if time.perf_counter() - last_report >= 1 or end == size:
+            last_report = time.perf_counter()
+            print(f"imported {state['records']} records, {end / size:.1%} of the dump", file=sys.stderr)
+
+    with open(args.dump, "rb") as f, ThreadPoolExecutor(args.parallel) as executor:
+        try:
+            for end, data in dump_chunks(f, binary, state["offset"], int(args.chunk_size * 1e6)):
+                batches = route(data, binary, ids, addresses, M, hash_name, args.batch)
+                futures = [executor.submit(send_batch, transport, owner, records, binary, addresses, args.retries, args.timeout)
+                           for owner, records in batches]
+                window.append((end, sum(len(records) for _, records in batches), futures))
+                # Bound the chunks held in memory, settling those already done on the way
+                while window and (len(window) > 2 or all(future.done() for future in window[0][2])):
+                    settle()
+            while window:
+                settle()
+        except Exception as e:
+            error = str(e)
+            for _, _, futures in window:
+                for future in futures:
+                    future.cancel()
+    transport.close()
+
+    seconds = time.perf_counter() - started
+    if error is None:
+        if os.path.exists(state_path):
+            os.remove(state_path)
+    else:
+        print(f"import stopped: {error}\nrerun with --resume to continue from byte {state['offset']}", file=sys.stderr)
+    return {
+        "dump": args.dump,
+        "format": "binary" if binary else "ndjson",
+        "nodes": len(addresses),
+        "records": state["records"] - first_records,
+        "stored": counts["stored"],
+        "forwarded": counts["forwarded"],
+        "bytes": state["offset"] - first_offset,
+        "seconds": seconds,
+        "MB_per_s": (state["offset"] - first_offset) / seconds / 1e6,
+        "complete": error is None,
+        "error": error,
+    }
+
+
+def main(args):
+    report = export(args) if args.command == "export" else load(args)
+    sys.stdout.write(json.dumps(report, indent=2) + "\n")
+    return 0 if not report.get("failed") and report.get("error") is None else 1
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import bisect
+import http.client
+import json
+import math
+import queue
+import random
+import sys
+import threading
+import time
+
+from faults import CLIENT, Scenario
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="bench", description="DHT load generator")
+
+    parser.add_argument("nodes", type=str, nargs="+",
+            help="addresses (host:port) of nodes to send requests to")
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed",
+            help="closed loop: each worker sends its next request when the previous one returns; "
+                 "open loop: requests arrive at --rate regardless of response times (default closed)")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads",
+            help="run workers as threads or asyncio tasks (default threads)")
+    parser.add_argument("--concurrency", type=int, default=8,
+            help="number of concurrent workers / in-flight requests (default 8)")
+    parser.add_argument("--rate", type=float, default=100.0,
+            help="open loop arrival rate in requests per second (default 100)")
+    parser.add_argument("--duration", type=float, default=10.0,
+            help="seconds to run the measured phase (default 10)")
+    parser.add_argument("--warmup", type=float, default=1.0,
+            help="seconds to run before measuring (default 1)")
+    parser.add_argument("--keys", type=int, default=1000,
+            help="size of the key space (default 1000)")
+    parser.add_argument("--distribution", choices=["uniform", "zipf"], default="uniform",
+            help="key popularity distribution (default uniform)")
+    parser.add_argument("--zipf-s", type=float, default=1.1,
+            help="zipf exponent (default 1.1)")
+    parser.add_argument("--value-size", type=int, default=100,
+            help="value size in bytes (default 100)")
+    parser.add_argument("--read-ratio", type=float, default=0.9,
+            help="fraction of operations that are GETs (default 0.9)")
+    parser.add_argument("--no-preload", action="store_true",
+            help="skip writing every key once before the run")
+    parser.add_argument("--timeout", type=float, default=10.0,
+            help="per-request timeout in seconds (default 10)")
+    parser.add_argument("--faults", type=str, default=None,
+            help="JSON scenario of network faults to inject between this client and the nodes, as source \"client\" (see faults.py)")
+    parser.add_argument("--faults-start", type=float, default=None,
+            help="Unix time the scenario's clock starts from, e.g. the one the nodes were given (default: when the benchmark starts)")
+    parser.add_argument("--trace-sample", type=float, default=0.0,
+            help="fraction of requests sent with X-Chord-Trace to record hop counts (default 0)")
+    parser.add_argument("--seed", type=int, default=None,
+            help="random seed for key and node selection")
+    parser.add_argument("--output", type=str, default=None,
+            help="write the JSON report to this file instead of stdout")
+
+    return parser
+
+
+class LatencyHistogram:
+    """HDR-style log-linear histogram of latencies in microseconds.
+
+    Values are bucketed with `precision_bits` of mantissa, so every recorded value
+    is reproduced within 1 / 2**precision_bits relative error at any magnitude.
+    """
+
+    def __init__(self, precision_bits=7):
+        self.precision_bits = precision_bits
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+
+    def record(self, seconds):
+        value = max(int(seconds * 1e6), 0)
+        shift = max(value.bit_length() - self.precision_bits, 0)
+        bucket = (shift, value >> shift)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.total += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        if not self.total:
+            return None
+        rank = max(1, math.ceil(p / 100.0 * self.total))
+        seen = 0
+        for shift, mantissa in sorted(self.counts, key=lambda b: b[1] << b[0]):
+            seen += self.counts[(shift, mantissa)]
+            if seen >= rank:
+                # Report the upper edge of the bucket, like HdrHistogram does
+                return (((mantissa + 1) << shift) - 1) / 1000.0
+        return self.max / 1000.0
+
+    def summary(self):
+        if not self.total:
+            return {"count": 0}
+        return {
+            "count": self.total,
+            "mean_ms": self.sum / self.total / 1000.0,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "p999_ms": self.percentile(99.9),
+            "max_ms": self.max / 1000.0,
+        }
+
+
+class KeyChooser:
+    def __init__(self, keys, distribution, zipf_s, rng):
+        self.keys = [f"bench-key-{i}" for i in range(keys)]
+        self.rng = rng
+        self.cumulative = None
+        if distribution == "zipf":
+            total = 0.0
+            self.cumulative = []
+            for rank in range(1, keys + 1):
+                total += 1.0 / rank ** zipf_s
+                self.cumulative.append(total)
+            # Shuffle so the hot keys are not the lexically first ones
+            rng.shuffle(self.keys)
+
+    def choose(self):
+        if self.cumulative is None:
+            return self.rng.choice(self.keys)
+        i = bisect.bisect_left(self.cumulative, self.rng.random() * self.cumulative[-1])
+        return self.keys[min(i, len(self.keys) - 1)]
+
+
+class Recorder:
+    """Per-worker results, merged at the end so the hot path takes no locks."""
+
+    def __init__(self):
+        self.latency = {"GET": LatencyHistogram(), "PUT": LatencyHistogram()}
+        self.statuses = {}
+        self.errors = 0
+        self.unfinished = 0
+        self.hops = {}
+
+    def record(self, method, status, seconds, hops=None):
+        if hops is not None:
+            self.hops[hops] = self.hops.get(hops, 0) + 1
+        if status is None:
+            self.errors += 1
+        else:
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            if status >= 500:
+                self.errors += 1
+        self.latency[method].record(seconds)
+
+    def record_unfinished(self, method, seconds):
+        """An arrival still waiting to be sent when the run was cut off, counted as a timeout with the time it waited."""
+        self.unfinished += 1
+        self.record(method, None, seconds)
+
+    def merge(self, other):
+        for method, histogram in other.latency.items():
+            self.latency[method].merge(histogram)
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        for hops, count in other.hops.items():
+            self.hops[hops] = self.hops.get(hops, 0) + count
+        self.errors += other.errors
+        self.unfinished += other.unfinished
+
+
+class Workload:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.chooser = KeyChooser(args.keys, args.distribution, args.zipf_s, self.rng)
+        self.value = ("x" * args.value_size).encode()
+        self.faults = Scenario.load(args.faults, args.faults_start, source=CLIENT) if args.faults else None
+
+    def next_operation(self, rng):
+        node = rng.choice(self.args.nodes)
+        key = self.chooser.choose()
+        method = "GET" if rng.random() < self.args.read_ratio else "PUT"
+        trace = rng.random() < self.args.trace_sample
+        return node, method, key, trace
+
+
+def count_hops(trace_header):
+    """Forwards taken by a traced request: every hop after the entry node."""
+    if not trace_header:
+        return None
+    return len(json.loads(trace_header)) - 1
+
+
+class ThreadClient:
+    def __init__(self, timeout, faults=None):
+        self.timeout = timeout
+        self.faults = faults
+        self.connections = {}
+
+    def request(self, node, method, key, value, trace=False):
+        conn = self.connections.get(node)
+        if conn is None:
+            conn = self.connections[node] = http.client.HTTPConnection(node, timeout=self.timeout)
+        body = value if method == "PUT" else None
+
+        def send():
+            headers = {"X-Chord-Trace": "1"} if trace else {}
+            conn.request(method, "/storage/" + key, body=body, headers=headers)
+            resp = conn.getresponse()
+            return resp, resp.read()
+
+        try:
+            if self.faults:
+                resp, _ = self.faults.call(CLIENT, node, send, self.timeout, len(body or b""), lambda result: len(result[1]))
+            else:
+                resp, _ = send()
+            return resp.status, count_hops(resp.getheader("X-Chord-Trace-Hops"))
+        except Exception:
+            conn.close()
+            del self.connections[node]
+            return None, None
+
+
+class AsyncClient:
+    """Keep-alive connections per node for the asyncio engine, reused between requests as ThreadClient's are."""
+
+    def __init__(self, timeout, faults=None):
+        self.timeout = timeout
+        self.faults = faults
+        self.idle = {}
+
+    async def request(self, node, method, key, value, trace=False):
+        body = value if method == "PUT" else b""
+        trace_header = "X-Chord-Trace: 1\r\n" if trace else ""
+        request = (f"{method} /storage/{key} HTTP/1.1\r\nHost: {node}\r\nContent-Length: {len(body)}\r\n"
+                   f"{trace_header}\r\n").encode() + body
+        idle = self.idle.setdefault(node, [])
+        writer = None
+        try:
+            if idle:
+                reader, writer = idle.pop()
+            else:
+                host, port = node.split(":")
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)), self.timeout)
+
+            async def read_response():
+                head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+                headers = {name.lower(): value for name, value in (line.split(": ", 1) for line in head[1:] if ": " in line)}
+                data = await reader.readexactly(int(headers.get("content-length", 0)))
+                return int(head[0].split()[1]), headers, data
+
+            async def send():
+                writer.write(request)
+                return await asyncio.wait_for(read_response(), self.timeout)
+
+            if self.faults:
+                status, headers, _ = await self.faults.acall(CLIENT, node, send, self.timeout, len(body), lambda result: len(result[2]))
+            else:
+                status, headers, _ = await send()
+        except Exception:
+            if writer is not None:
+                writer.close()
+            return None, None
+        if headers.get("connection", "").lower() == "close":
+            writer.close()
+        else:
+            idle.append((reader, writer))
+        return status, count_hops(headers.get("x-chord-trace-hops"))
+
+    def close(self):
+        for connections in self.idle.values():
+            for _, writer in connections:
+                writer.close()
+        self.idle = {}
+
+
+def preload(workload):
+    client = ThreadClient(workload.args.timeout)
+    for key in workload.chooser.keys:
+        client.request(workload.args.nodes[hash(key) % len(workload.args.nodes)], "PUT", key, workload.value)
+
+
+def run_threads(workload):
+    args = workload.args
+    recorders = []
+    generated = threading.Event()
+    arrivals = queue.Queue()
+    started = time.perf_counter()
+    measure_at = started + args.warmup
+    end_at = measure_at + args.duration
+    # Arrivals still queued this long after the end are cut off; requests in flight end within their timeout
+    drain_until = end_at + args.timeout
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = ThreadClient(args.timeout, workload.faults)
+        recorder = Recorder()
+        recorders.append(recorder)
+        while True:
+            if args.mode == "open":
+                try:
+                    intended = arrivals.get(timeout=0.1)
+                except queue.Empty:
+                    if generated.is_set():
+                        return
+                    continue
+            else:
+                intended = time.perf_counter()
+                if intended >= end_at:
+                    return
+            node, method, key, trace = workload.next_operation(rng)
+            measured = measure_at <= intended < end_at
+            if time.perf_counter() > drain_until:
+                if measured:
+                    recorder.record_unfinished(method, time.perf_counter() - intended)
+                continue
+            status, hops = client.request(node, method, key, workload.value, trace)
+            if measured:
+                # Requests are measured by when they were meant to start, and open loop latency counts from the
+                # intended send time, so requests delayed behind slow ones stay in the tail (no coordinated omission)
+                recorder.record(method, status, time.perf_counter() - intended, hops)
+
+    threads = [threading.Thread(target=worker, args=(workload.rng.random(),), daemon=True) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+
+    if args.mode == "open":
+        next_arrival = started
+        while next_arrival < end_at:
+            now = time.perf_counter()
+            if next_arrival > now:
+                time.sleep(next_arrival - now)
+            arrivals.put(next_arrival)
+            next_arrival += workload.rng.expovariate(args.rate)
+        generated.set()
+    for thread in threads:
+        thread.join()
+    return recorders
+
+
+async def run_asyncio(workload):
+    args = workload.args
+    recorder = Recorder()
+    client = AsyncClient(args.timeout, workload.faults)
+    rng = random.Random(workload.rng.random())
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    measure_at = started + args.warmup
+    end_at = measure_at + args.duration
+    drain_until = end_at + args.timeout
+
+    async def one(intended):
+        node, method, key, trace = workload.next_operation(rng)
+        measured = measure_at <= intended < end_at
+        if loop.time() > drain_until:
+            if measured:
+                recorder.record_unfinished(method, loop.time() - intended)
+            return
+        status, hops = await client.request(node, method, key, workload.value, trace)
+        if measured:
+            recorder.record(method, status, loop.time() - intended, hops)
+
+    if args.mode == "open":
+        semaphore = asyncio.Semaphore(args.concurrency)
+        tasks = set()
+
+        async def limited(intended):
+            async with semaphore:
+                await one(intended)
+
+        next_arrival = started
+        while next_arrival < end_at:
+            await asyncio.sleep(max(0.0, next_arrival - loop.time()))
+            task = asyncio.create_task(limited(next_arrival))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            next_arrival += rng.expovariate(args.rate)
+        if tasks:
+            await asyncio.gather(*tasks)
+    else:
+        async def worker():
+            while loop.time() < end_at:
+                await one(loop.time())
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    client.close()
+    return [recorder]
+
+
+def run(args):
+    workload = Workload(args)
+    if not args.no_preload:
+        preload(workload)
+    if args.engine == "asyncio":
+        recorders = asyncio.run(run_asyncio(workload))
+    else:
+        recorders = run_threads(workload)
+
+    total = Recorder()
+    for recorder in recorders:
+        total.merge(recorder)
+    combined = LatencyHistogram()
+    for histogram in total.latency.values():
+        combined.merge(histogram)
+
+    operations = combined.total
+    return {
+        "config": {name: value for name, value in vars(args).items() if name != "output"},
+        "finished": time.time(),
+        "operations": operations,
+        "throughput_ops": operations / args.duration,
+        "errors": total.errors,
+        "unfinished": total.unfinished,
+        "error_rate": total.errors / operations if operations else 0.0,
+        "statuses": {str(status): count for status, count in sorted(total.statuses.items())},
+        "hops": {str(hops): count for hops, count in sorted(total.hops.items())},
+        "latency": {
+            "all": combined.summary(),
+            "get": total.latency["GET"].summary(),
+            "put": total.latency["PUT"].summary(),
+        },
+    }
+
+
+def main(args):
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    main(args)
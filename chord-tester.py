@@ -137,9 +137,13 @@ def walk_neighbours(start_nodes):
     visited = set()
     while to_visit:
         next_node = to_visit.pop()
+        if next_node in visited:
+            continue
         visited.add(next_node)
         neighbors = get_neighbours(next_node)
-        for neighbor in neighbors:
+        # /network is a dict of pointers, the addresses are its values
+        addresses = [neighbors["successor"], neighbors["predecessor"]] + neighbors["finger_table"] if neighbors else []
+        for neighbor in addresses:
             if neighbor not in visited:
                 to_visit.append(neighbor)
     return visited
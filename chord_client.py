@@ -0,0 +1,523 @@
+"""Client for the Chord key-value API, with a blocking and an asyncio flavour.
+
+Both clients keep a pool of keep-alive connections per node, cap the number of
+requests in flight, retry failed requests on other nodes with exponential
+backoff, and can send each key straight to the node that owns it using
+routing tables fetched from the ring:
+
+    with ChordClient(["c6-6:65170"], direct=True) as client:
+        client.put("foo", "bar")
+        values = client.get_many(["foo", "baz"])
+
+    async with AsyncChordClient(["c6-6:65170"]) as client:
+        await client.put_many({"foo": "bar"})
+"""
+
+import asyncio
+import bisect
+import json
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from server import ring_hash
+from transport import ConnectionPool
+
+
+class ChordError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class RoutingTable:
+    """Ring ids of the nodes the client knows about, used to guess the owner of a key.
+
+    The guess only has to be close: a node that does not own the key forwards
+    it, so an incomplete table costs hops, not correctness.
+    """
+
+    def __init__(self):
+        self.M = None
+        self.hash_name = "sha1"
+        self.ids = []
+        self.addresses = []
+        self.updated = 0.0
+
+    def update(self, nodes):
+        """Rebuild from the GET /node responses of some nodes."""
+        known = set()
+        for node in nodes:
+            self.M = node.get("M", self.M)
+            self.hash_name = node.get("hash", self.hash_name)
+            known.add(f"{node['node_name']}:{node['node_port']}")
+            known.update(address for address in [node["successor"], node["predecessor"]] + node["finger_table"] if address)
+        if self.M is None or not known:
+            return
+        pairs = sorted((ring_hash(address, self.M, self.hash_name), address) for address in known)
+        self.ids = [node_id for node_id, _ in pairs]
+        self.addresses = [address for _, address in pairs]
+        self.updated = time.monotonic()
+
+    def owner(self, key):
+        if not self.ids:
+            return None
+        # Nodes hash the key as it appears in the request path
+        return self.addresses[bisect.bisect_left(self.ids, ring_hash(quote_key(key), self.M, self.hash_name)) % len(self.ids)]
+
+
+def parse_nodes(text):
+    """Addresses from the JSON list run.sh prints, a comma or newline separated list, or a file holding either."""
+    if os.path.exists(text):
+        with open(text) as f:
+            text = f.read()
+    text = text.strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [address.strip() for address in text.replace("\n", ",").split(",") if address.strip()]
+
+
+def quote_key(key):
+    return quote(key, safe="")
+
+
+def backoff_delay(attempt, backoff, max_backoff):
+    """Exponential backoff with jitter, so retrying clients do not move in lockstep."""
+    delay = min(max_backoff, backoff * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+
+def storage_path(key):
+    return "/storage/" + quote_key(key)
+
+
+def etag_headers(etag):
+    return {"If-None-Match": etag} if etag else {}
+
+
+def precondition_headers(etag):
+    # With no value expected, only create the key
+    return {"If-Match": etag} if etag else {"If-None-Match": "*"}
+
+
+def versioned_reply(key, status, text, headers):
+    if status == 404:
+        return None, None
+    if status == 304:
+        return None, headers.get("ETag")
+    if status != 200:
+        raise ChordError(f"GET {key}: {status} {text}", status)
+    return text, headers.get("ETag")
+
+
+def conditional_reply(key, status, text, headers):
+    if status == 412:
+        return None
+    if status != 200:
+        raise ChordError(f"PUT {key}: {status} {text}", status)
+    return headers.get("ETag")
+
+
+class ChordClient:
+    """Blocking client, safe to share between threads."""
+
+    def __init__(self, nodes, timeout=10, pool_size=8, max_concurrency=64, retries=3, backoff=0.05, max_backoff=1.0,
+                 direct=False, refresh_interval=30):
+        self.nodes = list(nodes)
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.direct = direct
+        self.refresh_interval = refresh_interval
+        self.max_concurrency = max_concurrency
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.pools = {}
+        self.lock = threading.Lock()
+        self.routes = RoutingTable()
+        self.executor = None
+        self.next_node = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def pool(self, address):
+        pool = self.pools.get(address)
+        if pool is None:
+            with self.lock:
+                pool = self.pools.setdefault(address, ConnectionPool(address, self.pool_size, self.timeout))
+        return pool
+
+    def send(self, address, method, path, body=None, headers=None):
+        """One request to one node, no retries. Return (status, body text, headers dict)."""
+        with self.slots:
+            status, text, response_headers, _ = self.pool(address).request(method, path, body, headers)
+        return status, text, response_headers
+
+    def targets(self, key=None):
+        """Nodes to try in order: the owner when routing directly, then the seed nodes round robin."""
+        with self.lock:
+            start = self.next_node
+            self.next_node = (self.next_node + 1) % len(self.nodes)
+        targets = [self.nodes[(start + i) % len(self.nodes)] for i in range(len(self.nodes))]
+        if key is not None and self.direct:
+            if time.monotonic() - self.routes.updated > self.refresh_interval:
+                self.refresh_routes()
+            owner = self.routes.owner(key)
+            if owner:
+                targets.insert(0, owner)
+        return targets
+
+    def request(self, method, path, body=None, headers=None, key=None, node=None):
+        """Send with retries; 5xx replies and connection errors move on to the next node after a backoff."""
+        targets = [node] if node else self.targets(key)
+        error = None
+        for attempt in range(self.retries + 1):
+            address = targets[attempt % len(targets)]
+            try:
+                status, text, response_headers = self.send(address, method, path, body, headers)
+                if status < 500:
+                    return status, text, response_headers
+                error = ChordError(f"{method} {path} on {address}: {status} {text}", status)
+            except OSError as e:
+                error = ChordError(f"{method} {path} on {address}: {e}")
+                if self.direct and attempt == 0:
+                    # The owner we routed to is gone, so the table is stale
+                    self.routes.updated = 0.0
+            if attempt < self.retries:
+                time.sleep(backoff_delay(attempt, self.backoff, self.max_backoff))
+        raise error
+
+    def refresh_routes(self):
+        nodes = []
+        for address in self.nodes:
+            try:
+                status, text, _ = self.send(address, "GET", "/node")
+            except OSError:
+                continue
+            if status == 200:
+                nodes.append(json.loads(text))
+        self.routes.update(nodes)
+        # Try again in a second rather than on every request when no node answered
+        self.routes.updated = self.routes.updated or time.monotonic() - self.refresh_interval + 1
+
+    def get(self, key):
+        """The value stored under `key`, or None when no node has it."""
+        status, text, _ = self.request("GET", storage_path(key), key=key)
+        if status == 404:
+            return None
+        if status != 200:
+            raise ChordError(f"GET {key}: {status} {text}", status)
+        return text
+
+    def get_versioned(self, key, etag=None):
+        """(value, ETag) of `key`, or (None, None) when no node has it.
+
+        Given the ETag of an earlier read, an unchanged value comes back as
+        (None, etag) and the owner does not send it again.
+        """
+        return versioned_reply(key, *self.request("GET", storage_path(key), headers=etag_headers(etag), key=key))
+
+    def put(self, key, value):
+        """Store `value` and return its ETag."""
+        status, text, headers = self.request("PUT", storage_path(key), body=value.encode(), headers={"Content-type": "text/plain"}, key=key)
+        if status != 200:
+            raise ChordError(f"PUT {key}: {status} {text}", status)
+        return headers.get("ETag")
+
+    def put_if(self, key, value, etag):
+        """Store `value` only if the stored one still has `etag`, or if there is none when `etag` is None.
+
+        Return the new ETag, or None when another write got there first.
+        """
+        return conditional_reply(key, *self.request("PUT", storage_path(key), body=value.encode(), key=key,
+                                                    headers={"Content-type": "text/plain", **precondition_headers(etag)}))
+
+    def map(self, fn, items):
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(self.max_concurrency, thread_name_prefix="chord-client")
+        return list(self.executor.map(fn, items))
+
+    def get_many(self, keys):
+        """Values by key, fetched concurrently; missing keys map to None."""
+        keys = list(keys)
+        return dict(zip(keys, self.map(self.get, keys)))
+
+    def put_many(self, items):
+        """Store a dict or iterable of (key, value) pairs concurrently."""
+        items = list(items.items() if isinstance(items, dict) else items)
+        self.map(lambda item: self.put(*item), items)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        with self.lock:
+            pools, self.pools = list(self.pools.values()), {}
+        for pool in pools:
+            pool.close()
+
+
+class AsyncConnection:
+    """One keep-alive HTTP/1.1 connection that can pipeline requests."""
+
+    def __init__(self, address, reader, writer):
+        self.address = address
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+
+    @classmethod
+    async def open(cls, address, timeout):
+        host, port = address.split(":")
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, int(port)), timeout)
+        return cls(address, reader, writer)
+
+    def encode(self, method, path, body=None, headers=None):
+        body = body or b""
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {self.address}", f"Content-Length: {len(body)}"]
+        lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+    async def read_response(self):
+        head = (await self.reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+        status = int(head[0].split()[1])
+        headers = {}
+        for line in head[1:]:
+            if ": " in line:
+                name, value = line.split(": ", 1)
+                headers[name] = value
+        lower = {name.lower(): value for name, value in headers.items()}
+        length = 0 if status == 304 else int(lower.get("content-length", 0))
+        body = await self.reader.readexactly(length) if length else b""
+        if lower.get("connection", "").lower() == "close":
+            self.close()
+        return status, body.decode(), headers
+
+    async def pipeline(self, requests, timeout):
+        """Write every (method, path, body, headers) request, then read the responses in order."""
+        self.writer.write(b"".join(self.encode(*request) for request in requests))
+        await self.writer.drain()
+        return [await asyncio.wait_for(self.read_response(), timeout) for _ in requests]
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+
+
+class AsyncConnectionPool:
+    def __init__(self, address, size=8, timeout=10):
+        self.address = address
+        self.size = size
+        self.timeout = timeout
+        self.idle = []
+
+    async def acquire(self):
+        while self.idle:
+            conn = self.idle.pop()
+            if not conn.closed and not conn.reader.at_eof():
+                return conn, True
+            conn.close()
+        return await AsyncConnection.open(self.address, self.timeout), False
+
+    def release(self, conn):
+        if conn.closed:
+            return
+        if len(self.idle) < self.size:
+            self.idle.append(conn)
+        else:
+            conn.close()
+
+    async def pipeline(self, requests):
+        conn, reused = await self.acquire()
+        try:
+            responses = await conn.pipeline(requests, self.timeout)
+        except (asyncio.IncompleteReadError, ConnectionError) if reused else ():
+            # The idle connection was closed under us; a fresh one says whether the node is really gone
+            conn.close()
+            conn = await AsyncConnection.open(self.address, self.timeout)
+            try:
+                responses = await conn.pipeline(requests, self.timeout)
+            except BaseException:
+                conn.close()
+                raise
+        except BaseException:
+            conn.close()
+            raise
+        self.release(conn)
+        return responses
+
+    def close(self):
+        idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+class AsyncChordClient:
+    """asyncio client; batch helpers pipeline the keys each node owns over its connections."""
+
+    def __init__(self, nodes, timeout=10, pool_size=8, max_concurrency=64, retries=3, backoff=0.05, max_backoff=1.0,
+                 direct=False, refresh_interval=30, pipeline_depth=16):
+        self.nodes = list(nodes)
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.direct = direct
+        self.refresh_interval = refresh_interval
+        self.pipeline_depth = pipeline_depth
+        self.max_concurrency = max_concurrency
+        self.slots = None  # created on first use, inside the running loop
+        self.pools = {}
+        self.routes = RoutingTable()
+        self.next_node = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def pool(self, address):
+        if address not in self.pools:
+            self.pools[address] = AsyncConnectionPool(address, self.pool_size, self.timeout)
+        return self.pools[address]
+
+    async def send_many(self, address, requests):
+        """Pipeline requests to one node, no retries. Return a (status, body text, headers dict) per request."""
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.max_concurrency)
+        async with self.slots:
+            return await self.pool(address).pipeline(requests)
+
+    async def send(self, address, method, path, body=None, headers=None):
+        return (await self.send_many(address, [(method, path, body, headers)]))[0]
+
+    async def targets(self, key=None):
+        start = self.next_node
+        self.next_node = (self.next_node + 1) % len(self.nodes)
+        targets = [self.nodes[(start + i) % len(self.nodes)] for i in range(len(self.nodes))]
+        if key is not None and self.direct:
+            if time.monotonic() - self.routes.updated > self.refresh_interval:
+                await self.refresh_routes()
+            owner = self.routes.owner(key)
+            if owner:
+                targets.insert(0, owner)
+        return targets
+
+    async def request(self, method, path, body=None, headers=None, key=None, node=None):
+        """Send with retries; 5xx replies and connection errors move on to the next node after a backoff."""
+        targets = [node] if node else await self.targets(key)
+        error = None
+        for attempt in range(self.retries + 1):
+            address = targets[attempt % len(targets)]
+            try:
+                status, text, response_headers = await self.send(address, method, path, body, headers)
+                if status < 500:
+                    return status, text, response_headers
+                error = ChordError(f"{method} {path} on {address}: {status} {text}", status)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                error = ChordError(f"{method} {path} on {address}: {e!r}")
+                if self.direct and attempt == 0:
+                    self.routes.updated = 0.0
+            if attempt < self.retries:
+                await asyncio.sleep(backoff_delay(attempt, self.backoff, self.max_backoff))
+        raise error
+
+    async def refresh_routes(self):
+        async def fetch(address):
+            try:
+                status, text, _ = await self.send(address, "GET", "/node")
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                return None
+            return json.loads(text) if status == 200 else None
+        nodes = await asyncio.gather(*(fetch(address) for address in self.nodes))
+        self.routes.update([node for node in nodes if node])
+        self.routes.updated = self.routes.updated or time.monotonic() - self.refresh_interval + 1
+
+    async def get(self, key):
+        """The value stored under `key`, or None when no node has it."""
+        status, text, _ = await self.request("GET", storage_path(key), key=key)
+        if status == 404:
+            return None
+        if status != 200:
+            raise ChordError(f"GET {key}: {status} {text}", status)
+        return text
+
+    async def get_versioned(self, key, etag=None):
+        """(value, ETag) of `key` as ChordClient.get_versioned gives them."""
+        return versioned_reply(key, *await self.request("GET", storage_path(key), headers=etag_headers(etag), key=key))
+
+    async def put(self, key, value):
+        """Store `value` and return its ETag."""
+        status, text, headers = await self.request("PUT", storage_path(key), body=value.encode(), headers={"Content-type": "text/plain"}, key=key)
+        if status != 200:
+            raise ChordError(f"PUT {key}: {status} {text}", status)
+        return headers.get("ETag")
+
+    async def put_if(self, key, value, etag):
+        """Compare-and-set as ChordClient.put_if does."""
+        return conditional_reply(key, *await self.request("PUT", storage_path(key), body=value.encode(), key=key,
+                                                          headers={"Content-type": "text/plain", **precondition_headers(etag)}))
+
+    async def batches(self, keys):
+        """Split keys into pipelines of at most pipeline_depth, grouped by the node they are sent to."""
+        groups = {}
+        for key in keys:
+            targets = await self.targets(key)
+            groups.setdefault(targets[0], []).append(key)
+        for address, group in groups.items():
+            for i in range(0, len(group), self.pipeline_depth):
+                yield address, group[i:i + self.pipeline_depth]
+
+    async def get_many(self, keys):
+        """Values by key, missing keys map to None. Keys whose pipeline fails are retried one by one."""
+        results = {}
+
+        async def run(address, batch):
+            try:
+                responses = await self.send_many(address, [("GET", storage_path(key), None, None) for key in batch])
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                responses = [(None, None, None)] * len(batch)
+            for key, (status, text, _) in zip(batch, responses):
+                if status == 200:
+                    results[key] = text
+                elif status == 404:
+                    results[key] = None
+                else:
+                    results[key] = await self.get(key)
+
+        await asyncio.gather(*[run(address, batch) async for address, batch in self.batches(keys)])
+        return results
+
+    async def put_many(self, items):
+        """Store a dict or iterable of (key, value) pairs. Pairs whose pipeline fails are retried one by one."""
+        values = dict(items)
+
+        async def run(address, batch):
+            requests = [("PUT", storage_path(key), values[key].encode(), {"Content-type": "text/plain"}) for key in batch]
+            try:
+                responses = await self.send_many(address, requests)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                responses = [(None, None, None)] * len(batch)
+            for key, (status, _, _) in zip(batch, responses):
+                if status != 200:
+                    await self.put(key, values[key])
+
+        await asyncio.gather(*[run(address, batch) async for address, batch in self.batches(values)])
+
+    def close(self):
+        pools, self.pools = list(self.pools.values()), {}
+        for pool in pools:
+            pool.close()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+
+from cluster import LocalCluster, request
+from stats import percentiles
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="churn", description="Measure ring convergence and key availability under churn")
+
+    parser.add_argument("--size", type=int, default=16,
+            help="number of nodes in the ring (default 16)")
+    parser.add_argument("--duration", type=float, default=120,
+            help="seconds of churn to run (default 120)")
+    parser.add_argument("--crash-rate", type=float, default=2.0,
+            help="crashes per minute (default 2)")
+    parser.add_argument("--leave-rate", type=float, default=1.0,
+            help="graceful leaves per minute (default 1)")
+    parser.add_argument("--join-rate", type=float, default=3.0,
+            help="joins per minute; a join recovers a crashed node or rejoins a node that left (default 3)")
+    parser.add_argument("--min-nodes", type=int, default=2,
+            help="never take the ring below this many live nodes (default 2)")
+    parser.add_argument("--sample-interval", type=float, default=0.5,
+            help="seconds between correctness and availability samples (default 0.5)")
+    parser.add_argument("--keys", type=int, default=200,
+            help="keys written before the churn starts and read back while it runs (default 200)")
+    parser.add_argument("--probes", type=int, default=20,
+            help="GETs issued per availability sample (default 20)")
+    parser.add_argument("--in-process", action="store_true",
+            help="run the ring nodes as threads in this process")
+    parser.add_argument("--faults", type=str, default=None,
+            help="JSON scenario of network faults to inject between the nodes, timed from when the cluster starts (see faults.py)")
+    parser.add_argument("--seed", type=int, default=None,
+            help="random seed for the event schedule")
+    parser.add_argument("--output", type=str, default=None,
+            help="write the JSON report to this file instead of stdout")
+
+    return parser
+
+
+def scrape_metrics(address):
+    """Every sample in the node's /metrics, keyed by metric name and labels."""
+    status, body = request(address, "GET", "/metrics")
+    samples = {}
+    if status != 200:
+        return samples
+    for line in body.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+def background_messages(cluster):
+    total = 0.0
+    for address in cluster.addresses:
+        try:
+            samples = scrape_metrics(address)
+        except OSError:
+            continue
+        for name, value in samples.items():
+            if name.startswith("chord_maintenance_requests_total") or \
+                    (name.startswith("chord_request_duration_seconds_count") and 'route="/API/join"' in name):
+                total += value
+    return total
+
+
+def injected_faults(cluster):
+    """Faults the nodes' --faults scenario injected, by kind, summed over the nodes still answering."""
+    faults = {}
+    for address in cluster.addresses:
+        try:
+            samples = scrape_metrics(address)
+        except OSError:
+            continue
+        for name, value in samples.items():
+            if name.startswith("chord_injected_faults_total{"):
+                kind = name.split('kind="', 1)[1].split('"', 1)[0]
+                faults[kind] = faults.get(kind, 0) + value
+    return faults
+
+
+class ChurnRun:
+    def __init__(self, cluster, args):
+        self.cluster = cluster
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.live = list(cluster.addresses)
+        self.crashed = []
+        self.left = []
+        self.lock = threading.Lock()
+        self.events = []  # dicts with type, node, time, converged_at
+        self.samples = []  # (time, ring_correct, get_success_rate)
+        self.keys = {}
+        self.stop = threading.Event()
+
+    def preload(self):
+        for _ in range(self.args.keys):
+            key, value = str(uuid.uuid4()), str(uuid.uuid4())
+            request(self.rng.choice(self.live), "PUT", f"/storage/{key}", body=value, timeout=10)
+            self.keys[key] = value
+
+    def next_event(self):
+        rates = {"crash": self.args.crash_rate, "leave": self.args.leave_rate, "join": self.args.join_rate}
+        with self.lock:
+            if len(self.live) <= self.args.min_nodes:
+                rates["crash"] = rates["leave"] = 0
+            if not self.crashed and not self.left:
+                rates["join"] = 0
+        total = sum(rates.values())
+        if total == 0:
+            return None, 1.0
+        wait = self.rng.expovariate(total / 60.0)
+        pick = self.rng.random() * total
+        for kind, rate in rates.items():
+            pick -= rate
+            if pick <= 0:
+                return kind, wait
+        return kind, wait
+
+    def inject(self, kind):
+        with self.lock:
+            if kind == "crash":
+                node = self.rng.choice(self.live)
+                self.live.remove(node)
+                self.crashed.append(node)
+                path = "/sim-crash"
+            elif kind == "leave":
+                node = self.rng.choice(self.live)
+                self.live.remove(node)
+                self.left.append(node)
+                path = "/leave"
+            else:
+                node = self.rng.choice(self.crashed + self.left)
+                if node in self.crashed:
+                    self.crashed.remove(node)
+                    path = "/sim-recover"
+                else:
+                    self.left.remove(node)
+                    path = f"/join?nprime={self.rng.choice(self.live)}"
+                self.live.append(node)
+        event = {"type": kind, "node": node, "time": time.monotonic(), "converged_at": None}
+        try:
+            request(node, "PUT", path, timeout=30)
+        except OSError as e:
+            event["error"] = str(e)
+        with self.lock:
+            self.events.append(event)
+
+    def run_events(self, end):
+        while not self.stop.is_set():
+            kind, wait = self.next_event()
+            if self.stop.wait(wait) or time.monotonic() > end:
+                return
+            if kind is not None:
+                self.inject(kind)
+
+    def probe_gets(self, live):
+        keys = self.rng.sample(list(self.keys), min(self.args.probes, len(self.keys)))
+        ok = 0
+        for key in keys:
+            try:
+                status, body = request(self.rng.choice(live), "GET", f"/storage/{key}", timeout=5)
+                ok += status == 200 and body == self.keys[key]
+            except OSError:
+                pass
+        return ok / len(keys) if keys else 1.0
+
+    def run_samples(self, end):
+        while time.monotonic() < end:
+            with self.lock:
+                live = list(self.live)
+            now = time.monotonic()
+            correct = self.cluster.is_stable(live)
+            success = self.probe_gets(live)
+            self.samples.append((now, correct, success))
+            if correct:
+                with self.lock:
+                    for event in self.events:
+                        if event["converged_at"] is None and event["time"] <= now:
+                            event["converged_at"] = now
+            time.sleep(self.args.sample_interval)
+
+    def run(self):
+        self.preload()
+        messages_before = background_messages(self.cluster)
+        started = time.monotonic()
+        end = started + self.args.duration
+        injector = threading.Thread(target=self.run_events, args=(end,), daemon=True)
+        injector.start()
+        self.run_samples(end)
+        self.stop.set()
+        injector.join()
+        # Give outstanding events a last chance to converge so they are not reported as never converging
+        settle_end = time.monotonic() + 30
+        while any(e["converged_at"] is None for e in self.events) and time.monotonic() < settle_end:
+            self.run_samples(time.monotonic() + self.args.sample_interval)
+        elapsed = time.monotonic() - started
+        messages = background_messages(self.cluster) - messages_before
+        return self.report(elapsed, messages)
+
+    def report(self, elapsed, messages):
+        convergence = [e["converged_at"] - e["time"] for e in self.events if e["converged_at"] is not None]
+        by_type = {}
+        for event in self.events:
+            if event["converged_at"] is not None:
+                by_type.setdefault(event["type"], []).append(event["converged_at"] - event["time"])
+        availability = [success for _, _, success in self.samples]
+        return {
+            "config": {name: value for name, value in vars(self.args).items() if name != "output"},
+            "duration_s": elapsed,
+            "events": {kind: sum(1 for e in self.events if e["type"] == kind) for kind in ("crash", "leave", "join")},
+            "not_converged": sum(1 for e in self.events if e["converged_at"] is None),
+            "time_to_convergence_s": dict(percentiles(convergence), max=max(convergence, default=None)),
+            "time_to_convergence_by_type_s": {kind: percentiles(times) for kind, times in by_type.items()},
+            "ring_correct_fraction": sum(1 for _, correct, _ in self.samples if correct) / len(self.samples) if self.samples else None,
+            "get_success_rate": {
+                "mean": sum(availability) / len(availability) if availability else None,
+                # Availability is a lower-tail quantity: p1 is the success rate 99% of samples stayed above
+                **percentiles(availability, points=(1, 5, 50)),
+            },
+            "background_messages": messages,
+            "background_messages_per_node_s": messages / elapsed / self.cluster.size,
+            "injected_faults": injected_faults(self.cluster),
+            "timeline": [{"t": t - self.samples[0][0], "ring_correct": correct, "get_success": success}
+                         for t, correct, success in self.samples],
+        }
+
+
+def main(args):
+    with LocalCluster(args.size, in_process=args.in_process, faults=args.faults) as cluster:
+        report = ChurnRun(cluster, args).run()
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from faults import FaultyTransport, Scenario
+from server import HASHES, Node, make_server, ring_hash
+
+SERVER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="cluster", description="Start a local Chord ring on free localhost ports")
+
+    parser.add_argument("size", type=int,
+            help="number of nodes in the ring")
+    parser.add_argument("--in-process", action="store_true",
+            help="run every node as a thread pair in this process instead of one server.py process per node")
+    parser.add_argument("--join", action="store_true",
+            help="start every node alone and form the ring through /join instead of a shared initialization list")
+    parser.add_argument("--hash", type=str, default="sha1", choices=HASHES,
+            help="hash giving the ring ids of keys and nodes (default sha1)")
+    parser.add_argument("--faults", type=str, default=None,
+            help="JSON scenario of network faults to inject between the nodes, timed from when the cluster starts (see faults.py)")
+    parser.add_argument("--timeout", type=float, default=60,
+            help="seconds to wait for the ring to stabilize (default 60)")
+
+    return parser
+
+
+def free_port(host):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def request(address, method, url, body=None, timeout=2):
+    conn = http.client.HTTPConnection(address, timeout=timeout)
+    try:
+        conn.request(method, url, body)
+        resp = conn.getresponse()
+        return resp.status, resp.read().decode()
+    finally:
+        conn.close()
+
+
+class LocalCluster:
+    """A ring of `size` nodes on free localhost ports, usable as a context manager.
+
+    Ports are chosen so that no two nodes share a ring id, since colliding ids
+    break the ring and are likely with the default M of 10 bits. Stabilization
+    is held back until every node has had time to start, otherwise the first
+    nodes up drop the ones still booting from their tables.
+    """
+
+    def __init__(self, size, in_process=False, join=False, host="localhost", M=10, server_args=(), timeout=60, hash_name="sha1", faults=None):
+        self.size = size
+        self.in_process = in_process
+        self.join = join
+        self.host = host
+        self.M = M
+        self.hash_name = hash_name
+        self.faults = faults
+        self.faults_start = None
+        self.server_args = list(server_args)
+        self.timeout = timeout
+        self.stabilize_delay = 2 + 0.25 * size
+        self.startup_seconds = None
+        self.membership_files = {}
+        self.addresses = []
+        self.processes = []
+        self.nodes = []
+        self.servers = []
+
+    def __enter__(self):
+        try:
+            self.start()
+        except BaseException:
+            self.stop()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def pick_addresses(self):
+        ids = set()
+        while len(self.addresses) < self.size:
+            address = f"{self.host}:{free_port(self.host)}"
+            node_id = ring_hash(address, self.M, self.hash_name)
+            if node_id not in ids:
+                ids.add(node_id)
+                self.addresses.append(address)
+
+    def start(self):
+        timeout = self.timeout
+        started = time.monotonic()
+        self.faults_start = time.time()
+        self.pick_addresses()
+        for address in self.addresses:
+            self.start_node(address, [address] if self.join else self.addresses)
+        self.wait_until_ready(timeout)
+        self.startup_seconds = time.monotonic() - started
+        if self.join:
+            for address in self.addresses[1:]:
+                request(address, "PUT", f"/join?nprime={self.addresses[0]}", timeout=timeout)
+        self.wait_until_stable(timeout)
+
+    def membership_file(self, addresses):
+        """A file listing `addresses` for server.py --membership, written once per distinct list."""
+        key = tuple(addresses)
+        if key not in self.membership_files:
+            with tempfile.NamedTemporaryFile("w", prefix="chord-membership-", suffix=".txt", delete=False) as f:
+                f.write("\n".join(addresses) + "\n")
+            self.membership_files[key] = f.name
+        return self.membership_files[key]
+
+    def start_node(self, address, initialization_list):
+        host, port = address.split(":")
+        if self.in_process:
+            node = Node(host, int(port), initialization_list, hash_name=self.hash_name)
+            node.stabilization_delay = self.stabilize_delay
+            if self.faults:
+                scenario = Scenario.load(self.faults, self.faults_start, node.injected_faults, source=address)
+                node.transport = node.membership.transport = FaultyTransport(node.transport, scenario, address)
+            httpd = make_server(node)
+            threading.Thread(target=httpd.serve_forever, daemon=True).start()
+            threading.Thread(target=node.periodic_stabilize, daemon=True).start()
+            self.nodes.append(node)
+            self.servers.append(httpd)
+        else:
+            # Large rings go through a membership file rather than one long command line per node
+            members = ["--membership", self.membership_file(initialization_list)] if len(initialization_list) > 1 else [address]
+            command = [sys.executable, SERVER_PATH, host, port, *members,
+                       "--lifetime", "0", "--stabilize-delay", str(self.stabilize_delay), "--hash", self.hash_name]
+            if self.faults:
+                command += ["--faults", self.faults, "--faults-start", str(self.faults_start)]
+            self.processes.append(subprocess.Popen(command + self.server_args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+
+    def wait_until_ready(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        pending = list(self.addresses)
+        while pending:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Nodes did not come up: {pending}")
+            try:
+                request(pending[0], "GET", "/helloworld")
+                pending.pop(0)
+            except OSError:
+                time.sleep(0.05)
+
+    def ring_state(self):
+        state = {}
+        for address in self.addresses:
+            status, body = request(address, "GET", "/network")
+            if status == 200:
+                state[address] = json.loads(body)
+        return state
+
+    def is_stable(self, addresses=None):
+        """True when walking successors visits exactly `addresses` and every predecessor points back."""
+        addresses = set(addresses or self.addresses)
+        try:
+            state = {address: json.loads(request(address, "GET", "/network")[1]) for address in addresses}
+        except (OSError, ValueError):
+            return False
+        start = next(iter(addresses))
+        current, visited = start, []
+        while current not in visited:
+            if current not in state:
+                return False
+            visited.append(current)
+            current = state[current]["successor"]
+        if current != start or set(visited) != addresses:
+            return False
+        return all(state[state[address]["successor"]]["predecessor"] == address for address in addresses)
+
+    def wait_until_stable(self, timeout=60, addresses=None):
+        started = time.monotonic()
+        while not self.is_stable(addresses):
+            if time.monotonic() - started > timeout:
+                raise TimeoutError(f"Ring of {len(addresses or self.addresses)} nodes did not stabilize in {timeout} s")
+            time.sleep(0.1)
+        return time.monotonic() - started
+
+    def stop(self):
+        for node in self.nodes:
+            node.running = False
+        for httpd in self.servers:
+            httpd.shutdown()
+            httpd.server_close()
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        self.nodes, self.servers, self.processes = [], [], []
+        for path in self.membership_files.values():
+            with contextlib.suppress(OSError):
+                os.unlink(path)
+        self.membership_files = {}
+
+
+def main(args):
+    with LocalCluster(args.size, in_process=args.in_process, join=args.join, timeout=args.timeout, hash_name=args.hash,
+                      faults=args.faults) as cluster:
+        print(json.dumps(cluster.addresses), flush=True)
+        print(f"{args.size} nodes serving after {cluster.startup_seconds:.2f} s", file=sys.stderr, flush=True)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    main(args)
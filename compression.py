@@ -0,0 +1,83 @@
+import lzma
+import time
+import zlib
+
+# Content codings a node can store values in; "deflate" is the zlib format HTTP uses under that name
+CODECS = {
+    "deflate": (lambda data: zlib.compress(data, 6), zlib.decompress),
+    "xz": (lambda data: lzma.compress(data, preset=1), lzma.decompress),
+}
+
+
+class Compressed:
+    """A value held or sent in compressed form, passed between nodes without decompressing it."""
+
+    __slots__ = ("encoding", "data")
+
+    def __init__(self, encoding, data):
+        self.encoding = encoding
+        self.data = data
+
+    def __eq__(self, other):
+        return isinstance(other, Compressed) and (self.encoding, self.data) == (other.encoding, other.data)
+
+
+def accepted_encodings(header):
+    """Codings an Accept-Encoding header accepts, leaving out those with q=0 or a malformed q."""
+    accepted = set()
+    for part in (header or "").split(","):
+        coding, *params = [token.strip() for token in part.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding and quality > 0:
+            accepted.add(coding.lower())
+    return accepted
+
+
+class Codec:
+    """Compresses values of at least `min_size` bytes with one of CODECS, or none with `encoding` None.
+
+    `sizes` (a Counter labelled by encoding and stage) and `durations` (a Histogram
+    labelled by encoding and operation) record the ratio and CPU cost when given.
+    """
+
+    def __init__(self, encoding=None, min_size=1024, sizes=None, durations=None):
+        if encoding is not None and encoding not in CODECS:
+            raise ValueError(f"Unknown encoding {encoding}, use one of {', '.join(CODECS)}")
+        self.encoding = encoding
+        self.min_size = min_size
+        self.sizes = sizes
+        self.durations = durations
+
+    def compress(self, value):
+        """`value` as it should be stored: Compressed when that makes it smaller, else unchanged."""
+        if self.encoding is None or not isinstance(value, str) or len(value) < self.min_size:
+            return value
+        raw = value.encode()
+        started = time.perf_counter()
+        data = CODECS[self.encoding][0](raw)
+        if self.durations is not None:
+            self.durations.observe(time.perf_counter() - started, (self.encoding, "compress"))
+        if self.sizes is not None:
+            self.sizes.inc((self.encoding, "raw"), len(raw))
+            self.sizes.inc((self.encoding, "compressed"), min(len(data), len(raw)))
+        return Compressed(self.encoding, data) if len(data) < len(raw) else value
+
+    def decompress(self, value):
+        """The text of a stored or received value; ValueError when compressed data is corrupt."""
+        if not isinstance(value, Compressed):
+            return value
+        started = time.perf_counter()
+        try:
+            text = CODECS[value.encoding][1](value.data).decode()
+        except (zlib.error, lzma.LZMAError, UnicodeDecodeError) as e:
+            raise ValueError(f"{value.encoding} value does not decompress: {e}") from e
+        if self.durations is not None:
+            self.durations.observe(time.perf_counter() - started, (value.encoding, "decompress"))
+        return text
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import bisect
+import json
+import sys
+import time
+
+from chord_client import AsyncChordClient, parse_nodes
+from server import ring_hash
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="crawler", description="Discover a ring concurrently and check its routing state")
+
+    parser.add_argument("nodes", type=str,
+            help="seed addresses: the JSON list printed by run.sh, a comma separated list, or a file holding either")
+    parser.add_argument("--bits", type=int, default=10,
+            help="ring id size M, used when nodes do not report it (default 10)")
+    parser.add_argument("--concurrency", type=int, default=256,
+            help="maximum requests in flight (default 256)")
+    parser.add_argument("--timeout", type=float, default=5,
+            help="seconds to wait for each node (default 5)")
+    parser.add_argument("--no-crawl", action="store_true",
+            help="only check the given nodes instead of following their pointers to new ones")
+    parser.add_argument("--output", type=str, default=None,
+            help="write the JSON report to this file instead of stdout")
+
+    return parser
+
+
+async def crawl(seeds, concurrency=256, timeout=5, follow=True):
+    """GET /network from every node reachable from `seeds`, one wave of concurrent requests per round.
+
+    Return ({address: network state}, {address: (problem kind, detail)}, rounds).
+    """
+    states, errors = {}, {}
+    frontier = list(dict.fromkeys(seeds))
+    rounds = 0
+    async with AsyncChordClient(seeds, timeout=timeout, max_concurrency=concurrency, pool_size=1) as client:
+        async def fetch(address):
+            try:
+                status, text, _ = await client.send(address, "GET", "/network")
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                errors[address] = ("unreachable", repr(e))
+                return
+            if status != 200:
+                # Crashed nodes still answer, with a 500
+                errors[address] = ("unhealthy", f"{status} {text}")
+                return
+            states[address] = json.loads(text)
+
+        while frontier:
+            rounds += 1
+            await asyncio.gather(*(fetch(address) for address in frontier))
+            if not follow:
+                break
+            seen = set(states) | set(errors)
+            found = []
+            for state in states.values():
+                for address in [state["successor"], state["predecessor"]] + state["finger_table"]:
+                    if address and address not in seen:
+                        seen.add(address)
+                        found.append(address)
+            frontier = found
+    return states, errors, rounds
+
+
+def check_ring(states, errors, M):
+    """Problems found in the crawled state, checked against the ideal ring over the live nodes."""
+    problems = []
+    ids = {address: state.get("node_id", ring_hash(address, M, state.get("hash", "sha1"))) for address, state in states.items()}
+    by_id = {}
+    for address, node_id in ids.items():
+        by_id.setdefault(node_id, []).append(address)
+    for node_id, addresses in by_id.items():
+        if len(addresses) > 1:
+            problems.append({"kind": "id_collision", "nodes": sorted(addresses), "node_id": node_id})
+    for address, (kind, detail) in errors.items():
+        problems.append({"kind": kind, "node": address, "detail": detail})
+
+    ordered = sorted(states, key=lambda address: ids[address])
+    sorted_ids = [ids[address] for address in ordered]
+
+    def ideal_successor(ring_id):
+        return ordered[bisect.bisect_left(sorted_ids, ring_id % 2 ** M) % len(ordered)]
+
+    checked = {"successor": 0, "predecessor": 0, "fingers": 0}
+    correct = {"successor": 0, "predecessor": 0, "fingers": 0}
+    for index, address in enumerate(ordered):
+        state = states[address]
+        expected = {"successor": ordered[(index + 1) % len(ordered)], "predecessor": ordered[index - 1]}
+        for field, ideal in expected.items():
+            checked[field] += 1
+            if state[field] == ideal:
+                correct[field] += 1
+            else:
+                problems.append({"kind": f"wrong_{field}", "node": address, "actual": state[field], "expected": ideal})
+        wrong = []
+        for i, finger in enumerate(state["finger_table"]):
+            ideal = ideal_successor(ids[address] + 2 ** i)
+            checked["fingers"] += 1
+            if finger == ideal:
+                correct["fingers"] += 1
+            else:
+                wrong.append({"index": i, "actual": finger, "expected": ideal})
+        if wrong:
+            problems.append({"kind": "wrong_fingers", "node": address, "count": len(wrong), "fingers": wrong})
+        dead = sorted({target for target in [state["successor"], state["predecessor"]] + state["finger_table"] if target in errors})
+        if dead:
+            problems.append({"kind": "points_to_dead_node", "node": address, "targets": dead})
+        if state["successor"] == address and len(ordered) > 1:
+            problems.append({"kind": "loner", "node": address})
+
+    # Successor cycles: a healthy ring has exactly one and it covers every live node
+    cycles, placed = [], set()
+    for start in ordered:
+        path, current = [], start
+        while current in states and current not in placed and current not in path:
+            path.append(current)
+            current = states[current]["successor"]
+        placed.update(path)
+        if current in path:
+            cycles.append(path[path.index(current):])
+    if len(cycles) != 1 or len(cycles[0]) != len(ordered):
+        problems.append({"kind": "broken_successor_cycle", "cycles": [len(cycle) for cycle in cycles], "live_nodes": len(ordered)})
+
+    accuracy = {field: correct[field] / checked[field] if checked[field] else None for field in checked}
+    return problems, accuracy
+
+
+def health_check(seeds, M=10, concurrency=256, timeout=5, follow=True):
+    started = time.perf_counter()
+    states, errors, rounds = asyncio.run(crawl(seeds, concurrency, timeout, follow))
+    crawl_s = time.perf_counter() - started
+    M = next((state["M"] for state in states.values() if "M" in state), M)
+    problems, accuracy = check_ring(states, errors, M) if states else ([{"kind": "no_live_nodes"}], {})
+    counts = {}
+    for problem in problems:
+        counts[problem["kind"]] = counts.get(problem["kind"], 0) + 1
+    return {
+        "healthy": not problems,
+        "M": M,
+        "live_nodes": len(states),
+        "unreachable_nodes": len(errors),
+        "rounds": rounds,
+        "crawl_s": crawl_s,
+        "check_s": time.perf_counter() - started - crawl_s,
+        "correct": accuracy,
+        "problem_counts": counts,
+        "problems": problems,
+    }
+
+
+def main(args):
+    report = health_check(parse_nodes(args.nodes), args.bits, args.concurrency, args.timeout, not args.no_crawl)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+    return 0 if report["healthy"] else 1
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    sys.exit(main(args))
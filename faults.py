@@ -0,0 +1,178 @@
+import asyncio
+import json
+import random
+import threading
+import time
+
+CLIENT = "client"  # Source name of requests from benchmark and churn clients rather than from a node
+
+
+def sample_ms(spec, rng):
+    """Seconds drawn from a latency spec in milliseconds: a number, or a distribution as a dict.
+
+    {"dist": "uniform", "low", "high"}, {"dist": "normal", "mean", "stdev"},
+    {"dist": "lognormal", "median", "sigma"} or {"dist": "pareto", "scale", "shape"}.
+    """
+    if not isinstance(spec, dict):
+        return spec / 1000
+    dist = spec.get("dist", "constant")
+    if dist == "constant":
+        ms = spec["value"]
+    elif dist == "uniform":
+        ms = rng.uniform(spec["low"], spec["high"])
+    elif dist == "normal":
+        ms = rng.gauss(spec["mean"], spec["stdev"])
+    elif dist == "lognormal":
+        ms = spec["median"] * rng.lognormvariate(0, spec["sigma"])
+    elif dist == "pareto":
+        ms = spec["scale"] * rng.paretovariate(spec["shape"])
+    else:
+        raise ValueError(f"Unknown latency distribution {dist}")
+    return max(ms, 0) / 1000
+
+
+def matches(pattern, address):
+    if pattern is None or pattern == "*":
+        return True
+    return address in pattern if isinstance(pattern, list) else address == pattern
+
+
+class Scenario:
+    """Network faults between named endpoints, read from a JSON scenario file.
+
+    `links` is a list of rules, each optionally limited to a source (`from`),
+    a target (`to`) and a window of seconds since the scenario started
+    (`start`, `end`). A request gets the fields of every rule that matches it,
+    later rules overriding earlier ones:
+
+        latency_ms  one-way delay, a number or a distribution (see sample_ms)
+        loss        chance that the request, and then separately its reply, is lost
+        reset       chance that the connection is reset before the request is sent
+        bandwidth   bytes per second the link carries, delaying large bodies
+
+    `partitions` cut every link between different `groups` of addresses while
+    they are active. A lost request or a cut link costs the sender its full
+    timeout, as a real one would, and then raises TimeoutError.
+
+    `counter`, a Counter labelled by kind, counts the faults injected. The
+    random draws are seeded from `seed` and the `source` endpoint the scenario
+    runs on, so each node draws its own reproducible faults.
+    """
+
+    def __init__(self, spec, start=None, counter=None, rng=None, source=None):
+        self.links = spec.get("links", [])
+        self.partitions = spec.get("partitions", [])
+        self.start = time.time() if start is None else start
+        self.counter = counter
+        seed = spec.get("seed")
+        self.rng = rng or random.Random(seed if seed is None or source is None else f"{seed}/{source}")
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, start=None, counter=None, source=None):
+        with open(path) as f:
+            return cls(json.load(f), start, counter, source=source)
+
+    def active(self, rule, now):
+        return rule.get("start", 0) <= now < rule.get("end", float("inf"))
+
+    def link(self, source, target):
+        """The merged rule for requests from `source` to `target` right now, and whether a partition cuts them."""
+        now = time.time() - self.start
+        merged = {}
+        for rule in self.links:
+            if matches(rule.get("from"), source) and matches(rule.get("to"), target) and self.active(rule, now):
+                merged.update(rule)
+        for partition in self.partitions:
+            if not self.active(partition, now):
+                continue
+            sides = [i for i, group in enumerate(partition["groups"]) for address in (source, target) if address in group]
+            if len(sides) == 2 and sides[0] != sides[1]:
+                return merged, True
+        return merged, False
+
+    def decide(self, source, target):
+        """(outcome, request delay, reply delay, bytes per second) of one request; outcome None is delivered."""
+        rule, cut = self.link(source, target)
+        with self.lock:
+            if cut:
+                outcome = "partition"
+            elif self.rng.random() < rule.get("reset", 0):
+                outcome = "reset"
+            elif self.rng.random() < rule.get("loss", 0):
+                outcome = "request_lost"
+            elif self.rng.random() < rule.get("loss", 0):
+                outcome = "reply_lost"
+            else:
+                outcome = None
+            latency = rule.get("latency_ms", 0)
+            there, back = sample_ms(latency, self.rng), sample_ms(latency, self.rng)
+        if outcome is not None and self.counter is not None:
+            self.counter.inc((outcome,))
+        return outcome, there, back, rule.get("bandwidth")
+
+    def plan(self, source, target, timeout, size):
+        """How one request of `size` bytes goes: (delay before sending, error raised after it, reply outcome and delay, bandwidth)."""
+        outcome, there, back, bandwidth = self.decide(source, target)
+        link = f"{source} -> {target}"
+        if outcome == "reset":
+            return 0, ConnectionResetError(f"Injected reset on {link}"), None, 0, bandwidth
+        if outcome in ("partition", "request_lost"):
+            return timeout, TimeoutError(f"Injected {outcome.replace('_', ' ')} on {link}"), None, 0, bandwidth
+        there += size / bandwidth if bandwidth else 0
+        if there >= timeout:
+            return timeout, TimeoutError(f"Injected latency beyond the timeout on {link}"), None, 0, bandwidth
+        return there, None, outcome, back, bandwidth
+
+    def reply(self, source, target, outcome, there, back, bandwidth, timeout, size):
+        """(delay before the reply arrives, error raised after it) for a reply of `size` bytes."""
+        back += size / bandwidth if bandwidth else 0
+        if outcome == "reply_lost":
+            return timeout - there, TimeoutError(f"Injected reply lost on {source} -> {target}")
+        if there + back >= timeout:
+            return timeout - there, TimeoutError(f"Injected latency beyond the timeout on {source} -> {target}")
+        return back, None
+
+    def call(self, source, target, send, timeout, size=0, reply_size=len):
+        """Run `send()` as if over the link from `source` to `target`, blocking through the delays."""
+        there, error, outcome, back, bandwidth = self.plan(source, target, timeout, size)
+        time.sleep(there)
+        if error:
+            raise error
+        result = send()
+        delay, error = self.reply(source, target, outcome, there, back, bandwidth, timeout, reply_size(result))
+        time.sleep(delay)
+        if error:
+            raise error
+        return result
+
+    async def acall(self, source, target, send, timeout, size=0, reply_size=len):
+        """`call` for a coroutine function `send`, sleeping without blocking the event loop."""
+        there, error, outcome, back, bandwidth = self.plan(source, target, timeout, size)
+        await asyncio.sleep(there)
+        if error:
+            raise error
+        result = await send()
+        delay, error = self.reply(source, target, outcome, there, back, bandwidth, timeout, reply_size(result))
+        await asyncio.sleep(delay)
+        if error:
+            raise error
+        return result
+
+
+class FaultyTransport:
+    """A node transport whose requests go through the links of a Scenario, from `source` to the peer."""
+
+    def __init__(self, inner, scenario, source):
+        self.inner = inner
+        self.scenario = scenario
+        self.source = source
+
+    def request(self, address, method, url, body=None, headers=None, timeout=None):
+        timeout = timeout or self.inner.timeout
+        size = len(body) if body else 0
+        return self.scenario.call(self.source, address, lambda: self.inner.request(address, method, url, body, headers, timeout),
+                                  timeout, size, lambda result: len(result[1]))
+
+    def close(self):
+        self.inner.close()
@@ -0,0 +1,318 @@
+import json
+import math
+import queue
+import random
+import threading
+import time
+
+ALIVE, SUSPECT, DEAD = "alive", "suspect", "dead"
+
+
+def parse_updates(updates):
+    """Gossiped [address, state, incarnation] updates as tuples; ValueError if any is malformed."""
+    if not isinstance(updates, list):
+        raise ValueError("Gossip updates must be a list")
+    parsed = []
+    for update in updates:
+        if not (isinstance(update, list) and len(update) == 3 and isinstance(update[0], str) and update[1] in (ALIVE, SUSPECT, DEAD)
+                and type(update[2]) is int and update[2] >= 0):
+            raise ValueError(f"Malformed gossip update {update!r}")
+        parsed.append(tuple(update))
+    return parsed
+
+
+def parse_message(text, addresses=()):
+    """A gossip message or reply, with its updates parsed; ValueError unless `from`, `peers` and `addresses` hold addresses."""
+    message = json.loads(text)
+    if not isinstance(message, dict):
+        raise ValueError("Gossip message must be a JSON object")
+    message["updates"] = parse_updates(message.get("updates", []))
+    peers = message.get("peers", [])
+    if not isinstance(message.get("from", ""), (str, type(None))) or not isinstance(peers, list) or not all(isinstance(peer, str) for peer in peers):
+        raise ValueError("from and peers must be addresses")
+    for name in addresses:
+        if not isinstance(message.get(name), str):
+            raise ValueError(f"Gossip message needs a {name} address")
+    return message
+
+
+class Membership:
+    """SWIM-style failure detector and membership gossip for one node.
+
+    Each tick probes one member, in a shuffled round-robin order, with a direct
+    ping; if that goes unanswered, up to `indirect_probes` other members ping it
+    on our behalf. A member nobody reached becomes suspect, and is confirmed
+    dead unless it refutes the suspicion within the suspicion timeout. State
+    changes travel as (address, state, incarnation) updates piggybacked on pings,
+    their replies and forwarded requests, each sent about `retransmit_mult` *
+    log2(N) times, so a change reaches every node in O(log N) rounds while a
+    tick sends at most 1 + `indirect_probes` messages per probed member. The
+    suspicion timeout is `suspicion_mult` * log10(N) ticks, as in memberlist.
+    The indirect pings go out together and share one deadline, so a probe of
+    a dead member takes at most probe_timeout + 2 * probe_timeout.
+
+    A node refutes a suspicion by bumping its incarnation and gossiping itself
+    alive, which is also how a node that was confirmed dead rejoins.
+
+    A ping reply also names the members `peers` returns, such as the node's
+    predecessor, which the pinger then learns as it would from their own ping.
+    That is Chord's stabilize: it lets a node find a closer successor it never
+    heard of, as when the failed node between them was their only link.
+    """
+
+    def __init__(self, address, transport, on_alive=None, on_suspect=None, on_dead=None, requests=None, probe_timeout=1.0,
+                 indirect_probes=3, suspicion_mult=3, retransmit_mult=3, max_piggyback=8, dead_retention=60, peers=None, rng=None):
+        self.address = address
+        self.transport = transport
+        self.on_alive = on_alive  # Called with the address of a member that joined, came back, refuted a suspicion or pinged us
+        self.on_suspect = on_suspect  # Called with the address of a member that became suspect
+        self.on_dead = on_dead  # Called with the address of a member confirmed dead
+        self.requests = requests  # Optional Counter labelled by message kind
+        self.probe_timeout = probe_timeout
+        self.indirect_probes = indirect_probes
+        self.suspicion_mult = suspicion_mult
+        self.retransmit_mult = retransmit_mult
+        self.max_piggyback = max_piggyback
+        self.dead_retention = dead_retention
+        self.peers = peers  # Returns the addresses to name in ping replies
+        self.rng = rng or random.Random()
+        self.incarnation = 0
+        self.left = False
+        self.ticks = 0
+        self.sent = 0  # Messages sent, for the maintenance budget
+        self.members = {}  # address -> [state, incarnation, tick of the last change]
+        self.updates = {}  # address -> [state, incarnation, times sent]
+        self.probe_order = []
+        self.parallel = True  # Send indirect pings from threads; off where the transport is not thread safe
+        self.lock = threading.Lock()
+
+    def live(self):
+        with self.lock:
+            return [address for address, (state, _, _) in self.members.items() if state != DEAD]
+
+    def settled(self):
+        """No updates left to gossip and no suspicion pending, so probing can slow down."""
+        with self.lock:
+            return not self.updates and all(state != SUSPECT for state, _, _ in self.members.values())
+
+    def state(self, address):
+        member = self.members.get(address)
+        return member[0] if member else None
+
+    def log_n(self, base=2):
+        return max(1, math.ceil(math.log(len(self.members) + 2, base)))
+
+    def add(self, addresses):
+        """Start tracking addresses this node routes to, without gossiping about them."""
+        with self.lock:
+            for address in addresses:
+                if address and address != self.address and address not in self.members:
+                    self.members[address] = [ALIVE, 0, self.ticks]
+
+    def queue(self, address, state, incarnation):
+        self.updates[address] = [state, incarnation, 0]
+
+    def piggyback(self):
+        """Updates to attach to an outgoing message, least sent first."""
+        with self.lock:
+            if not self.updates:
+                return []
+            limit = self.retransmit_mult * self.log_n()
+            chosen = sorted(self.updates.items(), key=lambda item: item[1][2])[:self.max_piggyback]
+            for address, update in chosen:
+                update[2] += 1
+                if update[2] >= limit:
+                    del self.updates[address]
+            return [[address, state, incarnation] for address, (state, incarnation, _) in chosen]
+
+    def receive(self, updates):
+        """Merge gossiped updates, then tell the node about members that came or went."""
+        changes = []
+        with self.lock:
+            if self.left:
+                return
+            for address, state, incarnation in updates:
+                if address == self.address:
+                    self.refute(state, incarnation)
+                    continue
+                member = self.members.get(address)
+                if member is None:
+                    accept = True
+                elif state == ALIVE:
+                    accept = incarnation > member[1]
+                elif state == SUSPECT:
+                    accept = (member[0] == ALIVE and incarnation >= member[1]) or (member[0] == SUSPECT and incarnation > member[1])
+                else:
+                    accept = member[0] != DEAD and incarnation >= member[1]
+                if not accept:
+                    continue
+                previous = member[0] if member else None
+                self.members[address] = [state, incarnation, self.ticks]
+                self.queue(address, state, incarnation)
+                if state != previous and not (previous is None and state == DEAD):
+                    changes.append((address, state))
+        self.notify(changes)
+
+    def refute(self, state, incarnation):
+        # Someone suspects us, declared us dead, or saw a later incarnation of ours; outbid them
+        if incarnation > self.incarnation or (state != ALIVE and incarnation >= self.incarnation):
+            self.incarnation = incarnation + (state != ALIVE)
+            self.queue(self.address, ALIVE, self.incarnation)
+
+    def notify(self, changes):
+        callbacks = {ALIVE: self.on_alive, SUSPECT: self.on_suspect, DEAD: self.on_dead}
+        for address, state in changes:
+            if callbacks[state]:
+                callbacks[state](address)
+
+    def learn(self, address):
+        """A member pinged us, so it is alive unless gossip says otherwise.
+
+        Members we know of are reported again too, which lets a node notice a
+        closer predecessor pinging it as its successor, as Chord's notify does.
+        """
+        with self.lock:
+            if self.left or not address or address == self.address:
+                return
+            member = self.members.setdefault(address, [ALIVE, 0, self.ticks])
+            if member[0] != ALIVE:
+                return
+        self.notify([(address, ALIVE)])
+
+    def revive(self, address):
+        """A member we hold dead is joining the ring again, so gossip it alive at a higher incarnation."""
+        with self.lock:
+            member = self.members.get(address)
+            if self.left or member is None or member[0] != DEAD:
+                return
+            self.members[address] = [ALIVE, member[1] + 1, self.ticks]
+            self.queue(address, ALIVE, member[1] + 1)
+        self.notify([(address, ALIVE)])
+
+    def send(self, target, path, message, timeout):
+        with self.lock:
+            self.sent += 1
+        if self.requests is not None:
+            self.requests.inc((path.rsplit("/", 1)[-1],))
+        message["from"] = self.address
+        if "updates" not in message:
+            message["updates"] = self.piggyback()
+        try:
+            status, text, _ = self.transport.request(target, "PUT", path, body=json.dumps(message),
+                                                     headers={"Content-type": "application/json"}, timeout=timeout)
+        except Exception:
+            return None
+        if status != 200:
+            return None
+        try:
+            reply = parse_message(text)
+        except ValueError:
+            return None
+        self.receive(reply["updates"])
+        for address in reply.get("peers", []):
+            self.learn(address)
+        return reply
+
+    def ping(self, target):
+        return self.send(target, "/gossip/ping", {}, self.probe_timeout) is not None
+
+    def handle_ping(self, body):
+        """Answer a ping; ValueError, before any state changes, when the message is malformed."""
+        message = parse_message(body)
+        self.learn(message.get("from"))
+        self.receive(message["updates"])
+        return json.dumps({"updates": self.piggyback(), "peers": self.peers() if self.peers else []})
+
+    def handle_ping_req(self, body):
+        message = parse_message(body, addresses=("target",))
+        self.learn(message.get("from"))
+        self.receive(message["updates"])
+        ack = self.ping(message["target"])
+        return json.dumps({"ack": ack, "updates": self.piggyback()})
+
+    def next_target(self):
+        with self.lock:
+            while self.probe_order:
+                address = self.probe_order.pop()
+                if self.state(address) not in (None, DEAD):
+                    return address
+            self.probe_order = [address for address, (state, _, _) in self.members.items() if state != DEAD]
+            self.rng.shuffle(self.probe_order)
+            return self.probe_order.pop() if self.probe_order else None
+
+    def tick(self, urgent=()):
+        """One protocol period: expire suspicions, probe the `urgent` members and one more in round-robin order."""
+        changes = []
+        with self.lock:
+            self.ticks += 1
+            timeout = self.suspicion_mult * self.log_n(10)
+            for address, member in list(self.members.items()):
+                state, incarnation, since = member
+                if state == SUSPECT and self.ticks - since >= timeout:
+                    self.members[address] = [DEAD, incarnation, self.ticks]
+                    self.queue(address, DEAD, incarnation)
+                    changes.append((address, DEAD))
+                elif state == DEAD and self.ticks - since >= self.dead_retention:
+                    del self.members[address]
+        self.notify(changes)
+
+        targets = [address for address in urgent if self.state(address) not in (None, DEAD)]
+        target = self.next_target()
+        if target is not None and target not in targets:
+            targets.append(target)
+        for target in targets:
+            self.probe(target)
+
+    def probe(self, target):
+        if self.ping(target):
+            return
+        helpers = [address for address in self.live() if address != target]
+        if self.ping_indirect(target, self.rng.sample(helpers, min(self.indirect_probes, len(helpers)))):
+            return
+        with self.lock:
+            member = self.members.get(target)
+            if not member or member[0] != ALIVE:
+                return
+            self.members[target] = [SUSPECT, member[1], self.ticks]
+            self.queue(target, SUSPECT, member[1])
+        self.notify([(target, SUSPECT)])
+
+    def ping_indirect(self, target, helpers):
+        """Ask `helpers` to ping `target`; True as soon as one of them reached it."""
+        timeout = 2 * self.probe_timeout
+        if not self.parallel:
+            return any((reply or {}).get("ack") for reply in
+                       (self.send(helper, "/gossip/ping-req", {"target": target}, timeout) for helper in helpers))
+        replies = queue.Queue()
+        for helper in helpers:
+            threading.Thread(target=lambda helper=helper: replies.put(self.send(helper, "/gossip/ping-req", {"target": target}, timeout)),
+                             daemon=True).start()
+        deadline = time.monotonic() + timeout
+        for _ in helpers:
+            try:
+                reply = replies.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                return False
+            if reply and reply.get("ack"):
+                return True
+        return False
+
+    def rejoin(self):
+        """Come back after a crash or leave, outbidding any dead verdict about us."""
+        with self.lock:
+            self.left = False
+            self.incarnation += 1
+            self.queue(self.address, ALIVE, self.incarnation)
+
+    def leave(self, targets):
+        """Tell `targets` this node is leaving, then forget every member."""
+        with self.lock:
+            self.incarnation += 1
+            farewell = [[self.address, DEAD, self.incarnation]]
+        for target in targets:
+            self.send(target, "/gossip/ping", {"updates": farewell}, self.probe_timeout)
+        with self.lock:
+            self.left = True
+            self.members = {}
+            self.updates = {}
+            self.probe_order = []
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import timeit
+import uuid
+
+from server import HASHES, Node, ring_hash
+
+FUNCTIONS = ("hashing", "hex_sha1", "hop", "is_between", "is_responsible", "find_forward_address", "add_node", "setup_finger_table")
+BATCH = 256
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="microbench", description="Time the Node routing functions across ring sizes and id widths")
+
+    parser.add_argument("--sizes", type=str, default="16,256,4096",
+            help="comma separated ring sizes (default 16,256,4096)")
+    parser.add_argument("--bits", type=str, default="10,32,64,160",
+            help="comma separated values of M (default 10,32,64,160)")
+    parser.add_argument("--hashes", type=str, default="sha1",
+            help=f"comma separated ring hashes to build the nodes with, of {','.join(HASHES)} (default sha1)")
+    parser.add_argument("--functions", type=str, default=",".join(FUNCTIONS),
+            help=f"comma separated functions to time (default {','.join(FUNCTIONS)})")
+    parser.add_argument("--repeat", type=int, default=7,
+            help="timed repetitions per case (default 7)")
+    parser.add_argument("--min-time", type=float, default=0.05,
+            help="seconds each repetition should last; the call count is calibrated to it (default 0.05)")
+    parser.add_argument("--warmup", type=float, default=0.1,
+            help="seconds each case runs untimed before measuring (default 0.1)")
+    parser.add_argument("--baseline", type=str, default="microbench_baseline.json",
+            help="stored baseline to compare against (default microbench_baseline.json)")
+    parser.add_argument("--save-baseline", action="store_true",
+            help="store this run as the new baseline instead of comparing")
+    parser.add_argument("--threshold", type=float, default=0.10,
+            help="relative slowdown of the median that counts as a regression (default 0.10)")
+    parser.add_argument("--seed", type=int, default=0,
+            help="random seed for the ring and the inputs (default 0)")
+    parser.add_argument("--output", type=str, default=None,
+            help="also write the JSON results to this file")
+
+    return parser
+
+
+def make_ring(size, M, rng, hash_name="sha1"):
+    """Addresses of `size` nodes with distinct ids on a ring of M bits."""
+    addresses, ids = [], set()
+    while len(addresses) < size:
+        address = f"10.{rng.randrange(256)}.{rng.randrange(256)}.{rng.randrange(256)}:{rng.randrange(1024, 65536)}"
+        node_id = ring_hash(address, M, hash_name)
+        if node_id not in ids:
+            ids.add(node_id)
+            addresses.append(address)
+    return addresses
+
+
+def make_case(function, node, ring, rng):
+    """A no-argument callable running `function` on one batch of inputs, and the number of calls it makes."""
+    space = 2 ** node.M
+    if function == "hashing":
+        keys = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(BATCH)]
+        def case():
+            for key in keys:
+                node.hashing(key)
+    elif function == "hex_sha1":
+        # How key ids used to be computed, through the hex digest, for comparison with hashing
+        keys = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(BATCH)]
+        def case():
+            for key in keys:
+                int(hashlib.sha1(key.encode()).hexdigest(), 16) % (2 ** node.M)
+    elif function == "hop":
+        # The routing work of one hop that received no key id: hash the key, then serve it or pick the next node
+        keys = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(BATCH)]
+        def case():
+            for key in keys:
+                key_id = node.hashing(key)
+                if not node.is_responsible(key_id):
+                    node.find_forward_address(key_id)
+    elif function == "is_between":
+        triples = [(rng.randrange(space), rng.randrange(space), rng.randrange(space)) for _ in range(BATCH)]
+        def case():
+            for left, middle, right in triples:
+                node.is_between(left, middle, right)
+    elif function in ("is_responsible", "find_forward_address"):
+        ids = [rng.randrange(space) for _ in range(BATCH)]
+        method = getattr(node, function)
+        def case():
+            for hashed_key in ids:
+                method(hashed_key)
+    elif function == "add_node":
+        # Mostly new nodes, so every call walks the finger table; the routing state is restored once per batch
+        newcomers = make_ring(BATCH, node.M, rng, node.hash_name)
+        state = (node.pred, node.succ, list(node.finger_table))
+        def case():
+            for address in newcomers:
+                node.add_node(address)
+            node.pred, node.succ, node.finger_table = state[0], state[1], list(state[2])
+    elif function == "setup_finger_table":
+        node.hashed_map = {node.peer_id(address): address for address in ring}
+        node.hashed_list = sorted(node.hashed_map)
+        return node.setup_finger_table, 1
+    else:
+        raise ValueError(f"Unknown function {function}")
+    return case, BATCH
+
+
+def time_case(case, calls, repeat, min_time, warmup):
+    """Nanoseconds per call for each repetition."""
+    timer = timeit.Timer(case)
+    deadline = time.perf_counter() + warmup
+    while time.perf_counter() < deadline:
+        case()
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    return [total / (number * calls) * 1e9 for total in timer.repeat(repeat, number)]
+
+
+def summarize(samples):
+    return {
+        "median_ns": statistics.median(samples),
+        "mean_ns": statistics.mean(samples),
+        "stdev_ns": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "min_ns": min(samples),
+        "max_ns": max(samples),
+        "repeat": len(samples),
+    }
+
+
+def run(args):
+    results = {}
+    functions = args.functions.split(",")
+    for hash_name, M in [(hash_name, int(bits)) for hash_name in args.hashes.split(",") for bits in args.bits.split(",")]:
+        for size in [int(n) for n in args.sizes.split(",")]:
+            if size > 2 ** M // 2:
+                print(f"skipping N={size} M={M}: too many nodes for the id space", file=sys.stderr)
+                continue
+            rng = random.Random(f"{args.seed}-{size}-{M}")
+            ring = make_ring(size, M, rng, hash_name)
+            node_name, node_port = ring[0].split(":")
+            node = Node(node_name, int(node_port), ring, M=M, hash_name=hash_name)
+            # Cases of the default hash keep their old names, so earlier baselines still compare
+            suffix = "" if hash_name == "sha1" else f" hash={hash_name}"
+            for function in functions:
+                if function == "hex_sha1" and hash_name != "sha1":
+                    continue
+                case, calls = make_case(function, node, ring, rng)
+                summary = summarize(time_case(case, calls, args.repeat, args.min_time, args.warmup))
+                results[f"{function} N={size} M={M}{suffix}"] = dict(summary, function=function, nodes=size, bits=M, hash=hash_name)
+                print(f"{function:<22} N={size:<6} M={M:<4} {hash_name:<8} {summary['median_ns']:>12.0f} ns/call "
+                      f"(min {summary['min_ns']:.0f}, stdev {summary['stdev_ns']:.0f})", flush=True)
+    return {
+        "meta": {
+            "time": time.time(),
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+        },
+        "results": results,
+    }
+
+
+def compare(report, baseline, threshold):
+    """Cases whose median got slower than the baseline by more than `threshold`."""
+    regressions = []
+    for name, result in report["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        ratio = result["median_ns"] / before["median_ns"]
+        result["baseline_median_ns"] = before["median_ns"]
+        result["ratio"] = ratio
+        if ratio > 1 + threshold:
+            regressions.append((name, ratio))
+    return regressions
+
+
+def main(args):
+    report = run(args)
+    status = 0
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline written to {args.baseline}")
+    else:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            print(f"no baseline at {args.baseline}, run with --save-baseline to create one")
+        else:
+            regressions = compare(report, baseline, args.threshold)
+            for name, ratio in regressions:
+                print(f"REGRESSION {name}: {ratio:.2f}x the baseline median")
+            if regressions:
+                status = 1
+            else:
+                print(f"no regressions above {args.threshold:.0%} against {args.baseline}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return status
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    sys.exit(main(args))
@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import math
+import sys
+import uuid
+
+import numpy as np
+
+from chord_client import parse_nodes
+from server import HASHES, digest_function, ring_hash
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="placement", description="Predict how keys spread over a ring before deploying it")
+
+    parser.add_argument("ring", type=str,
+            help="node addresses: the JSON list printed by run.sh, a comma separated list, or a file holding either (one per line also works)")
+    parser.add_argument("--bits", type=int, default=10,
+            help="ring id size M in bits, as in Node (default 10)")
+    parser.add_argument("--hash", type=str, default="sha1", choices=HASHES,
+            help="hash giving the ring ids of keys and nodes, as the ring's nodes were started with (default sha1)")
+    parser.add_argument("--keys-file", type=str, default=None,
+            help="real keys, one per line or the NDJSON written by scan.py")
+    parser.add_argument("--sample", type=int, default=1000000,
+            help="number of random uuid4 keys to place when no keys file is given (default 1000000)")
+    parser.add_argument("--batch", type=int, default=1000000,
+            help="keys hashed per batch (default 1000000)")
+    parser.add_argument("--vnodes", type=int, default=1,
+            help="ring positions per node; position 0 is the node's own address (default 1)")
+    parser.add_argument("--add", type=str, default=None,
+            help="comma separated addresses to add, reported as a change against the given ring")
+    parser.add_argument("--remove", type=str, default=None,
+            help="comma separated addresses to remove, reported as a change against the given ring")
+    parser.add_argument("--hop-samples", type=int, default=100000,
+            help="random (entry node, key) lookups routed through ideal finger tables for hop counts (default 100000)")
+    parser.add_argument("--per-node", action="store_true",
+            help="include the load of every node in the report")
+    parser.add_argument("--seed", type=int, default=None,
+            help="random seed for sampled keys and lookups")
+    parser.add_argument("--output", type=str, default=None,
+            help="write the JSON report to this file instead of stdout")
+
+    return parser
+
+
+def to_ring64(node_id, M):
+    """Scale an M-bit ring id onto a 64-bit ring, keeping the order of ids.
+
+    For M above 64 only the top 64 bits are kept, so two ids sharing those bits
+    tie; at 2^-64 per pair that never happens in practice.
+    """
+    return node_id << (64 - M) if M <= 64 else node_id >> (M - 64)
+
+
+def hash_keys(keys, M, hash_name="sha1"):
+    """Ring ids of `keys` on the 64-bit ring, the same ids Node.hashing gives scaled by to_ring64."""
+    digest = digest_function(hash_name, M)
+    digests = [digest(key) for key in keys]
+    size = len(digests[0]) if digests else 20
+    digests = np.frombuffer(b"".join(digests), dtype=np.uint8).reshape(-1, size)[:, -24:]
+    # Big-endian digests as three 64-bit words, zero padded at the top; only the low M <= 192 bits are the id
+    words = np.concatenate([np.zeros((len(keys), 24 - digests.shape[1]), dtype=np.uint8), digests], axis=1)
+    w0, w1, w2 = (np.ascontiguousarray(words[:, 8 * i:8 * i + 8]).view(">u8").ravel().astype(np.uint64) for i in range(3))
+    if M <= 64:
+        low = w2 & np.uint64(2 ** M - 1) if M < 64 else w2
+        return low << np.uint64(64 - M)
+    shift = M - 64
+    # Window of the 64 bits below bit M of the digest
+    if shift == 0:
+        return w2
+    if shift < 64:
+        return (w1 << np.uint64(64 - shift)) | (w2 >> np.uint64(shift))
+    if shift == 64:
+        return w1
+    return (w0 << np.uint64(128 - shift)) | (w1 >> np.uint64(shift - 64))
+
+
+def read_keys(args, rng):
+    """Batches of keys from the keys file, or random uuid4 keys like the ones bench.py writes."""
+    if args.keys_file:
+        batch = []
+        with open(args.keys_file) as f:
+            for line in f:
+                line = line.rstrip("\n")
+                if not line:
+                    continue
+                batch.append(json.loads(line)["key"] if line.startswith("{") else line)
+                if len(batch) >= args.batch:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+    else:
+        remaining = args.sample
+        while remaining > 0:
+            count = min(remaining, args.batch)
+            yield [str(uuid.UUID(bytes=bytes(row), version=4)) for row in rng.integers(0, 256, size=(count, 16), dtype=np.uint8)]
+            remaining -= count
+
+
+class Ring:
+    """Sorted ring positions of a set of nodes, each node holding `vnodes` positions."""
+
+    def __init__(self, addresses, M, vnodes=1, hash_name="sha1"):
+        self.addresses = list(addresses)
+        self.M = M
+        positions = []
+        for index, address in enumerate(self.addresses):
+            for v in range(vnodes):
+                name = address if v == 0 else f"{address}#{v}"
+                positions.append((to_ring64(ring_hash(name, M, hash_name), M), index))
+        positions.sort()
+        self.ids = np.array([position for position, _ in positions], dtype=np.uint64)
+        self.owners = np.array([index for _, index in positions], dtype=np.int64)
+        if len(np.unique(self.ids)) != len(self.ids):
+            print(f"warning: {len(self.ids) - len(np.unique(self.ids))} ring positions collide at M={M}", file=sys.stderr)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def successor_index(self, key_ids):
+        """Index of the first position at or after each key id, wrapping around."""
+        return np.searchsorted(self.ids, key_ids, side="left") % len(self.ids)
+
+    def owner(self, key_ids):
+        return self.owners[self.successor_index(key_ids)]
+
+    def ownership(self):
+        """Fraction of the id space each node owns."""
+        arcs = (self.ids - np.roll(self.ids, 1)).astype(np.float64)
+        if len(self.ids) == 1:
+            arcs[:] = 2.0 ** 64
+        return np.bincount(self.owners, weights=arcs / 2.0 ** 64, minlength=len(self.addresses))
+
+    def finger_offsets(self):
+        # Node.setup_finger_table targets node_id + 2^i on the M-bit ring; on the 64-bit ring fingers below 1 collapse onto the successor
+        shifts = [i + 64 - self.M if self.M <= 64 else max(0, i - (self.M - 64)) for i in range(self.M)]
+        return np.array([1 << shift for shift in shifts], dtype=np.uint64)
+
+    def hops(self, entries, key_ids):
+        """Hops each lookup takes from position `entries` to the owner of its key, routed like Node.find_forward_address."""
+        offsets = self.finger_offsets()
+        size = len(self.ids)
+        current = entries.copy()
+        target = self.successor_index(key_ids)
+        hops = np.zeros(len(entries), dtype=np.int64)
+        active = np.nonzero(current != target)[0]
+        while len(active):
+            node = self.ids[current[active]]
+            distance = key_ids[active] - node
+            succ = (current[active] + 1) % size
+            succ_distance = self.ids[succ] - node
+            # Keys in (node, succ] go to the successor; everything else to the furthest finger before the key
+            step = succ.copy()
+            far = np.nonzero(distance > succ_distance)[0]
+            if len(far):
+                lo = np.zeros(len(far), dtype=np.int64)
+                hi = np.full(len(far), self.M - 1, dtype=np.int64)
+                while (lo < hi).any():
+                    mid = (lo + hi + 1) // 2
+                    finger = self.successor_index(node[far] + offsets[mid])
+                    finger_distance = self.ids[finger] - node[far]
+                    before = (finger_distance != 0) & (finger_distance < distance[far])
+                    lo = np.where(before, mid, lo)
+                    hi = np.where(before, hi, mid - 1)
+                finger = self.successor_index(node[far] + offsets[lo])
+                step[far] = finger
+            current[active] = step
+            hops[active] += 1
+            active = active[current[active] != target[active]]
+        return hops
+
+
+def load_stats(counts, addresses, per_node=False):
+    mean = counts.mean()
+    stats = {
+        "total": counts.sum().item(),
+        "nodes": len(counts),
+        "min": counts.min().item(),
+        "max": counts.max().item(),
+        "mean": float(mean),
+        "stdev": float(counts.std()),
+        "max_over_mean": float(counts.max() / mean) if mean else None,
+        "min_over_mean": float(counts.min() / mean) if mean else None,
+        "p50": float(np.percentile(counts, 50)),
+        "p99": float(np.percentile(counts, 99)),
+        "busiest": addresses[int(counts.argmax())],
+    }
+    if per_node:
+        stats["per_node"] = dict(zip(addresses, counts.tolist()))
+    return stats
+
+
+def hop_stats(ring, samples, rng):
+    if samples <= 0 or len(ring) < 2:
+        return None
+    entries = rng.integers(0, len(ring), size=samples)
+    key_ids = rng.integers(0, 2 ** 64, size=samples, dtype=np.uint64)
+    hops = ring.hops(entries, key_ids)
+    histogram = np.bincount(hops)
+    return {
+        "samples": samples,
+        "mean": float(hops.mean()),
+        "p50": float(np.percentile(hops, 50)),
+        "p99": float(np.percentile(hops, 99)),
+        "max": int(hops.max()),
+        "log2_n": math.log2(len(ring)),
+        "histogram": {hop: int(count) for hop, count in enumerate(histogram) if count},
+    }
+
+
+def analyze(args):
+    rng = np.random.default_rng(args.seed)
+    addresses = parse_nodes(args.ring)
+    ring = Ring(addresses, args.bits, args.vnodes, args.hash)
+    changed = None
+    if args.add or args.remove:
+        removed = set(args.remove.split(",")) if args.remove else set()
+        added = [address for address in (args.add.split(",") if args.add else []) if address not in addresses]
+        changed = Ring([address for address in addresses if address not in removed] + added, args.bits, args.vnodes, args.hash)
+
+    counts = np.zeros(len(ring.addresses), dtype=np.int64)
+    changed_counts = np.zeros(len(changed.addresses), dtype=np.int64) if changed else None
+    moved = 0
+    for batch in read_keys(args, rng):
+        key_ids = hash_keys(batch, args.bits, args.hash)
+        owners = ring.owner(key_ids)
+        counts += np.bincount(owners, minlength=len(ring.addresses))
+        if changed:
+            new_owners = changed.owner(key_ids)
+            changed_counts += np.bincount(new_owners, minlength=len(changed.addresses))
+            moved += int(np.count_nonzero(np.array(ring.addresses, dtype=object)[owners] != np.array(changed.addresses, dtype=object)[new_owners]))
+
+    report = {
+        "config": {name: value for name, value in vars(args).items() if name != "output"},
+        "load": load_stats(counts, ring.addresses, args.per_node),
+        "ownership": load_stats(ring.ownership(), ring.addresses, args.per_node),
+        "hops": hop_stats(ring, args.hop_samples, rng),
+    }
+    if changed:
+        total = int(counts.sum())
+        report["change"] = {
+            "nodes_before": len(ring.addresses),
+            "nodes_after": len(changed.addresses),
+            "moved_keys": moved,
+            "moved_fraction": moved / total if total else None,
+            "load": load_stats(changed_counts, changed.addresses, args.per_node),
+            "hops": hop_stats(changed, args.hop_samples, rng),
+        }
+    return report
+
+
+def main(args):
+    report = analyze(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    main(args)
@@ -1,39 +1,106 @@
-import http
-import subprocess
-import time
+import argparse
+import json
+
 import matplotlib.pyplot as plt
 import numpy as np
-import random
-import http.client
 from matplotlib.backends.backend_pdf import PdfPages
 
+PERCENTILES = ["p50_ms", "p95_ms", "p99_ms", "p999_ms"]
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="plot", description="Plot scaling results recorded by sweep.py")
+
+    parser.add_argument("results", type=str, nargs="?", default="results.ndjson",
+            help="NDJSON file written by sweep.py (default results.ndjson)")
+    parser.add_argument("--output", type=str, default="experiment_results.pdf",
+            help="PDF to write (default experiment_results.pdf)")
+    parser.add_argument("--labels", type=str, default=None,
+            help="comma separated labels (revisions) to include (default all)")
+
+    return parser
+
+
+def load_results(path, labels=None):
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if labels:
+        records = [r for r in records if r["label"] in labels]
+    return records
+
+
+def group(records, *fields):
+    groups = {}
+    for record in records:
+        groups.setdefault(tuple(record[field] for field in fields), []).append(record)
+    return groups
+
+
+def plot_throughput(pdf, records, workload):
+    plt.figure()
+    for (label,), runs in sorted(group(records, "label").items(), key=lambda item: str(item[0])):
+        by_size = group(runs, "nodes")
+        sizes = sorted(size for (size,) in by_size)
+        throughput = [[r["report"]["throughput_ops"] for r in by_size[(size,)]] for size in sizes]
+        plt.errorbar(sizes, [np.mean(t) for t in throughput], yerr=[np.std(t) for t in throughput], label=str(label), fmt="-o")
+    plt.xscale("log", base=2)
+    plt.xlabel("Number of nodes in network")
+    plt.ylabel("Throughput (operations / second)")
+    plt.title(f"Throughput vs ring size ({workload})")
+    plt.legend(title="label")
+    pdf.savefig()
+    plt.close()
+
+
+def plot_latency(pdf, records, workload, label):
+    by_size = group(records, "nodes")
+    sizes = sorted(size for (size,) in by_size)
+    plt.figure()
+    for percentile in PERCENTILES:
+        values = [np.mean([r["report"]["latency"]["all"].get(percentile) or np.nan for r in by_size[(size,)]]) for size in sizes]
+        plt.plot(sizes, values, "-o", label=percentile.replace("_ms", ""))
+    plt.xscale("log", base=2)
+    plt.yscale("log")
+    plt.xlabel("Number of nodes in network")
+    plt.ylabel("Latency (ms)")
+    plt.title(f"Latency percentiles vs ring size ({workload}, {label})")
+    plt.legend()
+    pdf.savefig()
+    plt.close()
+
+
+def plot_hops(pdf, records, workload, label):
+    by_size = group(records, "nodes")
+    sizes = sorted(size for (size,) in by_size)
+    plt.figure()
+    width = 0.8 / max(len(sizes), 1)
+    for i, size in enumerate(sizes):
+        counts = {}
+        for r in by_size[(size,)]:
+            for hops, count in r["report"].get("hops", {}).items():
+                counts[int(hops)] = counts.get(int(hops), 0) + count
+        total = sum(counts.values())
+        if not total:
+            continue
+        hops = sorted(counts)
+        plt.bar([h + i * width for h in hops], [counts[h] / total for h in hops], width=width, label=f"{size} nodes")
+    plt.xlabel("Hops to reach the owner")
+    plt.ylabel("Fraction of traced requests")
+    plt.title(f"Hop count distribution ({workload}, {label})")
+    plt.legend()
+    pdf.savefig()
+    plt.close()
 
-def plot_results(results):
-    num_nodes = [1, 2, 4, 8, 16]
-    put_means = [np.mean(results[n]["put"]) for n in num_nodes]
-    put_stds = [np.std(results[n]["put"]) for n in num_nodes]
-    get_means = [np.mean(results[n]["get"]) for n in num_nodes]
-    get_stds = [np.std(results[n]["get"]) for n in num_nodes]
 
-    with PdfPages("experiment_results.pdf") as pdf:
-        plt.figure()
-        plt.errorbar(num_nodes, put_means, yerr=put_stds, label="PUT", fmt="-o")
-        plt.errorbar(num_nodes, get_means, yerr=get_stds, label="GET", fmt="-o")
-        plt.xlabel("Number of nodes in network")
-        plt.ylabel("Time (seconds)")
-        plt.title("Time to PUT and GET 100 different values in DHT (n=100)")
-        plt.legend()
-        pdf.savefig()  # saves the current figure into a pdf page
-        plt.close()
+def plot_results(records, output="experiment_results.pdf"):
+    with PdfPages(output) as pdf:
+        for (workload,), runs in sorted(group(records, "workload").items()):
+            plot_throughput(pdf, runs, workload)
+            for (label,), labelled in sorted(group(runs, "label").items(), key=lambda item: str(item[0])):
+                plot_latency(pdf, labelled, workload, label)
+                plot_hops(pdf, labelled, workload, label)
 
 
 if __name__ == "__main__":
-    plot_results(
-        {
-            1: {'put': [0.04081535339355469, 0.038034677505493164, 0.03774380683898926], 'get': [0.039659976959228516, 0.034574031829833984, 0.03490447998046875]},
-            2: {'put': [0.10348367691040039, 0.09232711791992188, 0.0971219539642334], 'get': [0.0980384349822998, 0.10206460952758789, 0.10654044151306152]},
-            4: {'put': [0.31058526039123535, 0.3766343593597412, 0.8102521896362305], 'get': [0.1789853572845459, 0.1687772274017334, 0.16334247589111328]},
-            8: {'put': [0.7988860607147217, 0.6718454360961914, 0.5190091133117676], 'get': [0.49247050285339355, 0.49208664894104004, 0.4807400703430176]},
-            16: {'put': [1.0985281467437744, 0.9119656085968018, 0.8069441318511963], 'get': [0.839228630065918, 0.8278074264526367, 0.9630928039550781]}
-        }
-    )
+    args = arg_parser().parse_args()
+    plot_results(load_results(args.results, args.labels.split(",") if args.labels else None), args.output)
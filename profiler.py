@@ -0,0 +1,102 @@
+import marshal
+import sys
+import threading
+import time
+
+
+class SamplingProfiler:
+    """Samples the stacks of every thread in the process at a fixed interval.
+
+    Sampling only reads frames from a background thread, so the profiled threads
+    (request handling, stabilization) run unmodified. Results can be exported as
+    collapsed stacks for flamegraph tools or as a pstats-compatible file.
+    """
+
+    def __init__(self, interval=0.005, max_duration=60):
+        self.interval = interval
+        self.max_duration = max_duration
+        self.stacks = {}  # tuple of (filename, lineno, funcname) from root to leaf -> sample count
+        self.samples = 0
+        self.started = None
+        self.stopped = None
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        self.started = time.time()
+        self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+
+    def run(self):
+        own_id = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + self.max_duration
+        while not self.stop_event.wait(self.interval) and time.monotonic() < deadline:
+            names.update((t.ident, t.name) for t in threading.enumerate())
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                stack.append(("<thread>", 0, names.get(thread_id, str(thread_id))))
+                stack = tuple(reversed(stack))
+                self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+        self.stopped = time.time()
+
+    def collapsed(self):
+        """Stacks in the collapsed format read by flamegraph.pl and speedscope."""
+        lines = []
+        for stack, count in sorted(self.stacks.items()):
+            frames = ";".join(f"{name} ({filename.rsplit('/', 1)[-1]}:{lineno})" if filename != "<thread>" else name
+                              for filename, lineno, name in stack)
+            lines.append(f"{frames} {count}")
+        return "\n".join(lines) + "\n"
+
+    def pstats(self):
+        """Sample counts converted to the marshalled dict that pstats.Stats loads.
+
+        Call counts are not observable by sampling, so every function reports one
+        call per sample it appeared in; times are samples multiplied by the interval.
+        """
+        stats = {}
+        for stack, count in self.stacks.items():
+            seen = set()
+            for depth, func in enumerate(stack):
+                cc, nc, tt, ct, callers = stats.get(func, (0, 0, 0.0, 0.0, {}))
+                if depth == len(stack) - 1:
+                    tt += count * self.interval
+                if func not in seen:
+                    # Recursive frames are counted once per stack for cumulative time
+                    seen.add(func)
+                    ct += count * self.interval
+                    nc += count
+                    cc += count
+                if depth > 0:
+                    caller = stack[depth - 1]
+                    ccc, cnc, ctt, cct = callers.get(caller, (0, 0, 0.0, 0.0))
+                    callers[caller] = (ccc + count, cnc + count, ctt, cct + count * self.interval)
+                stats[func] = (cc, nc, tt, ct, callers)
+        return marshal.dumps(stats)
+
+    def summary(self):
+        return {
+            "running": self.running,
+            "interval": self.interval,
+            "samples": self.samples,
+            "started": self.started,
+            "stopped": self.stopped,
+            "stacks": len(self.stacks),
+        }
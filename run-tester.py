@@ -1,17 +1,20 @@
-import requests
 import sys
 import json
 
+from chord_client import ChordClient
+
 addresses = json.loads(sys.argv[1])
 
 failed = False
 
+client = ChordClient(addresses, retries=0)
+
 for address in addresses:
     try:
-        response = requests.get(f"http://{address}/helloworld")
-        print(f'received "{response.text}"')
-        if response.text != address:
-            if response.text.replace(".ifi.uit.no", "") != address:
+        _, text, _ = client.request("GET", "/helloworld", node=address)
+        print(f'received "{text}"')
+        if text != address:
+            if text.replace(".ifi.uit.no", "") != address:
                 failed = True
     except Exception as e:
         print(f"\nRequest to {address} failed: {e}\n")
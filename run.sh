@@ -21,11 +21,31 @@ done
 
 ADDRESSES_STR=$(IFS=, ; echo "${ADDRESSES[*]}")
 
+# Every node builds its tables from the whole ring at start up, so none of them has to /join.
+# The file sits next to server.py so the other hosts can read it, and goes away when the script exits
+MEMBERSHIP=$(mktemp "$PWD/membership.XXXXXX")
+trap 'rm -f "$MEMBERSHIP"' EXIT
+printf "%s\n" "${ADDRESSES[@]}" > "$MEMBERSHIP"
+STABILIZE_DELAY=$(( 2 + NUM_REQUESTS / 50 ))
+
 for (( i=0; i<$NUM_REQUESTS; i++ )); do
     NODE_INDEX=$(( i % MAX_NODES ))
     NODE=${AVAILABLE_NODES[$NODE_INDEX]}
     PORT=${ADDRESSES[$i]#*:}
-    ssh -f $NODE "python3 $PWD/server.py $NODE $PORT ${ADDRESSES[$i]}"
+    ssh -f $NODE "python3 $PWD/server.py $NODE $PORT --membership $MEMBERSHIP --stabilize-delay $STABILIZE_DELAY" &
+    # Launch in parallel batches, below the default sshd MaxStartups
+    if (( (i + 1) % 32 == 0 )); then
+        wait
+    fi
+done
+wait
+
+# ssh -f returns before the servers have read the file, so wait until each one answers
+for ADDRESS in "${ADDRESSES[@]}"; do
+    for (( try=0; try<60; try++ )); do
+        curl -s -o /dev/null "http://$ADDRESS/helloworld" && break
+        sleep 1
+    done
 done
 
 #echo "${ADDRESSES[*]}"
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import argparse
+import http.client
+import json
+import sys
+from urllib.parse import urlencode
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="scan", description="Page through the keys of a node or the whole ring")
+
+    parser.add_argument("node", type=str,
+            help="address (host:port) of the node to start from")
+    parser.add_argument("--start", type=int, default=0,
+            help="key id to start the scan from (default 0)")
+    parser.add_argument("--limit", type=int, default=100,
+            help="number of keys per page (default 100)")
+    parser.add_argument("--ring", action="store_true",
+            help="walk successors and scan every node in the ring")
+
+    return parser
+
+
+def get_page(node, params):
+    conn = http.client.HTTPConnection(node, timeout=10)
+    try:
+        conn.request("GET", "/scan?" + urlencode(params))
+        resp = conn.getresponse()
+        body = resp.read()
+        if resp.status != 200:
+            raise RuntimeError(f"GET /scan on {node} failed with status {resp.status}: {body.decode()}")
+        return json.loads(body)
+    finally:
+        conn.close()
+
+
+def node_scan(node, start=0, limit=100, ring=False, origin=None):
+    """Yield (node, page) for every page of one node's local store."""
+    params = {"start": start, "limit": limit}
+    if ring:
+        params.update({"ring": 1, "origin": origin or node})
+    while True:
+        page = get_page(node, params)
+        yield node, page
+        if page["cursor"] is None:
+            return
+        params["cursor"] = page["cursor"]
+
+
+def ring_scan(node, start=0, limit=100):
+    """Yield items from every node, walking successors until the ring wraps back to `node`."""
+    current = node
+    visited = set()
+    while current is not None and current not in visited:
+        visited.add(current)
+        next_node = None
+        for _, page in node_scan(current, start, limit, ring=True, origin=node):
+            for item in page["items"]:
+                yield page["node"], item
+            next_node = page.get("next_node")
+        current = next_node
+
+
+def main(args):
+    if args.ring:
+        items = ring_scan(args.node, args.start, args.limit)
+    else:
+        items = ((node, item) for node, page in node_scan(args.node, args.start, args.limit) for item in page["items"])
+    for node, item in items:
+        item["node"] = node
+        sys.stdout.write(json.dumps(item) + "\n")
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    main(args)
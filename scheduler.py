@@ -0,0 +1,182 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+
+class Task:
+    """Periodic work run by a Scheduler; its interval grows by `backoff` after every quiet run, up to `max_interval`."""
+
+    __slots__ = ("name", "fn", "base", "interval", "max_interval", "backoff", "busy", "due")
+
+    def __init__(self, name, fn, interval, max_interval=None, backoff=1.5, busy=None):
+        self.name = name
+        self.fn = fn
+        self.base = interval
+        self.interval = interval
+        self.max_interval = max(max_interval or interval, interval)
+        self.backoff = backoff
+        self.busy = busy  # Returns True while the task has pending work and should keep its base interval
+        self.due = None
+
+
+class Scheduler:
+    """Runs a node's periodic background work from one heap of due times.
+
+    Every delay is jittered by +-`jitter` of itself, so nodes started together
+    do not probe in lockstep. A task backs off after each run in which nothing
+    changed, so a stable ring settles at the tasks' longest intervals, and
+    drops back to its base interval as soon as `changed` reports churn or its
+    `busy` predicate reports pending work. Work is paced by two token buckets
+    refilled at `cpu_budget` CPU seconds and `message_budget` messages per
+    second, each holding up to `burst` seconds' worth; once a run overdraws
+    either, due tasks wait until it is back in credit. A budget of None is
+    unlimited.
+
+    `run` drives the scheduler from a thread on the wall clock; the simulator
+    calls `run_pending` from its own event loop with a virtual `clock`.
+    """
+
+    def __init__(self, clock=time.monotonic, jitter=0.2, cpu_budget=0.05, message_budget=50, burst=10, messages=None,
+                 paused=None, runs=None, cpu=None, deferred=None, rng=None):
+        self.clock = clock
+        self.jitter = jitter
+        self.cpu_budget = cpu_budget
+        self.message_budget = message_budget
+        self.burst = burst
+        self.messages = messages  # Returns the number of messages sent by background work so far
+        self.paused = paused  # Returns True while no task may run, such as when the node has crashed
+        self.runs = runs  # Optional Counter labelled by task
+        self.cpu = cpu  # Optional Counter of CPU seconds, labelled by task
+        self.deferred = deferred  # Optional Counter of runs held back by the budget, labelled by task
+        self.rng = rng or random.Random()
+        self.tasks = {}
+        self.heap = []  # (due, sequence, task name); entries whose due no longer matches the task are stale
+        self.sequence = itertools.count()
+        self.hold_until = clock()
+        self.changes = 0
+        self.cpu_tokens = (cpu_budget or 0) * burst
+        self.message_tokens = (message_budget or 0) * burst
+        self.refilled = clock()
+        self.idle_wait = 5.0  # Longest sleep while paused or without tasks, to notice being stopped
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+    def jittered(self, delay):
+        return delay * self.rng.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def push(self, task, due):
+        task.due = due
+        heapq.heappush(self.heap, (due, next(self.sequence), task.name))
+
+    def hold(self, delay):
+        """Run nothing for `delay` seconds, e.g. while the rest of a new ring starts up."""
+        with self.lock:
+            self.hold_until = self.clock() + delay
+
+    def add(self, name, fn, interval, max_interval=None, backoff=1.5, busy=None):
+        """Run `fn` every `interval` seconds, backing off to `max_interval` while nothing changes."""
+        with self.lock:
+            task = self.tasks[name] = Task(name, fn, interval, max_interval, backoff, busy)
+            # Spread the first runs over one interval
+            self.push(task, max(self.clock(), self.hold_until) + self.rng.uniform(0, interval))
+        self.wakeup.set()
+
+    def remove(self, name):
+        """Stop running a task, such as one-off work that is done; its heap entries go stale."""
+        with self.lock:
+            self.tasks.pop(name, None)
+
+    def changed(self):
+        """Membership or routing changed: put every task back on its base interval and run it within one."""
+        with self.lock:
+            self.changes += 1
+            due = max(self.clock(), self.hold_until)
+            for task in self.tasks.values():
+                task.interval = task.base
+                if task.due is not None and task.due > due + task.base:
+                    self.push(task, due + self.jittered(task.base))
+        self.wakeup.set()
+
+    def intervals(self):
+        with self.lock:
+            return {name: task.interval for name, task in self.tasks.items()}
+
+    def refill(self, now):
+        elapsed, self.refilled = now - self.refilled, now
+        if self.cpu_budget:
+            self.cpu_tokens = min(self.cpu_budget * self.burst, self.cpu_tokens + elapsed * self.cpu_budget)
+        if self.message_budget:
+            self.message_tokens = min(self.message_budget * self.burst, self.message_tokens + elapsed * self.message_budget)
+
+    def budget_wait(self):
+        """Seconds until both buckets are back in credit."""
+        wait = 0.0
+        if self.cpu_budget and self.cpu_tokens < 0:
+            wait = -self.cpu_tokens / self.cpu_budget
+        if self.message_budget and self.message_tokens < 0:
+            wait = max(wait, -self.message_tokens / self.message_budget)
+        return wait
+
+    def next_due(self):
+        """The earliest live heap entry, dropping stale ones. Call with the lock held."""
+        while self.heap:
+            due, _, name = self.heap[0]
+            task = self.tasks.get(name)
+            if task is not None and task.due == due:
+                return due, task
+            heapq.heappop(self.heap)
+        return None, None
+
+    def run_pending(self):
+        """Run every task that is due and within budget, then return when the next one is due (None without tasks)."""
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.refill(now)
+                due, task = self.next_due()
+                if task is None or due > now:
+                    return due
+                wait = self.budget_wait()
+                if wait > 0:
+                    heapq.heappop(self.heap)
+                    self.push(task, now + wait)
+                    if self.deferred is not None:
+                        self.deferred.inc((task.name,))
+                    continue
+                heapq.heappop(self.heap)
+                task.due = None
+                changes = self.changes
+            cpu_started = time.thread_time()
+            sent = self.messages() if self.messages else 0
+            try:
+                task.fn()
+            except Exception:
+                pass  # Background work retries on its next run
+            cpu = time.thread_time() - cpu_started
+            sent = (self.messages() if self.messages else 0) - sent
+            with self.lock:
+                self.cpu_tokens -= cpu
+                self.message_tokens -= sent
+                if self.runs is not None:
+                    self.runs.inc((task.name,))
+                if self.cpu is not None:
+                    self.cpu.inc((task.name,), cpu)
+                if self.changes != changes or (task.busy and task.busy()):
+                    task.interval = task.base
+                else:
+                    task.interval = min(task.interval * task.backoff, task.max_interval)
+                self.push(task, self.clock() + self.jittered(task.interval))
+
+    def run(self, running=lambda: True):
+        """Run tasks as they come due until `running` returns False, sleeping in between and while paused."""
+        while running():
+            self.wakeup.clear()
+            if self.paused and self.paused():
+                self.wakeup.wait(self.idle_wait)
+                continue
+            due = self.run_pending()
+            timeout = self.idle_wait if due is None else min(due - self.clock(), self.idle_wait)
+            if timeout > 0:
+                self.wakeup.wait(timeout)
@@ -1,17 +1,39 @@
+import argparse
+import bisect
+import gzip as gzip_module
 import hashlib
-import http
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+import io
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
 import os
 import sys
 import threading
 import json
+import math
 import time
 import asyncio
 import contextlib
+import functools
 import logging
+import random
+import socket
+import socketserver
+import struct
+import uuid
+from collections import deque
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+from compression import CODECS, Codec, Compressed, accepted_encodings
+from faults import FaultyTransport, Scenario
+from membership import ALIVE, Membership, parse_updates
+from metrics import Registry
+from profiler import SamplingProfiler
+from scheduler import Scheduler
+from store import CompactStore, KeyValueStore, MerkleTree, encode_cursor, decode_cursor, entry_hash, pack_record, read_record
+from transport import HttpTransport, unix_socket_path
 
 # Suppress HTTP server logging
 logging.getLogger("http.server").setLevel(logging.ERROR)  # {{ edit_1 }}
+logger = logging.getLogger("chord")
 
 @contextlib.contextmanager
 def suppress_output():
@@ -24,38 +46,174 @@ def suppress_output():
         finally:
             sys.stdout = old_stdout
 
+HASHES = ("sha1", "blake2b")
+
+
+@functools.lru_cache(maxsize=None)
+def digest_function(name, M):
+    """A function giving the digest of a key or node address, hashing its UTF-8 bytes; its low M bits are the ring id.
+
+    "sha1" is Chord's hash and gives the ids the ring always used. "blake2b" asks
+    only for the digest bytes M needs. Every node of a ring has to use the same one.
+    """
+    if name == "sha1":
+        sha1 = hashlib.sha1
+        return lambda key: sha1(key.encode()).digest()
+    if name == "blake2b":
+        blake2b, size = hashlib.blake2b, min(64, (M + 7) // 8)
+        return lambda key: blake2b(key.encode(), digest_size=size).digest()
+    raise ValueError(f"Unknown hash {name}, use one of {', '.join(HASHES)}")
+
+
+@functools.lru_cache(maxsize=None)
+def hash_function(name, M):
+    """A function giving the M-bit ring id of a key or node address, reading its digest as an integer directly."""
+    mask, digest = 2 ** M - 1, digest_function(name, M)
+    return lambda key: int.from_bytes(digest(key), "big") & mask
+
+
+def ring_hash(key, M, hash_name="sha1"):
+    return hash_function(hash_name, M)(key)
+
+
+class Trace(list):
+    """Hops of one traced request, in the order they were taken."""
+
+    def __init__(self, trace_id):
+        super().__init__()
+        self.trace_id = trace_id
+
+
+def etag_matches(header, tag):
+    """Whether an If-Match or If-None-Match header names `tag`, comparing weak tags as strong ones."""
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return "*" in tags or tag in tags
+
+
+class Preconditions:
+    """The If-None-Match and If-Match of a /storage request, and the ETag of the value its owner holds.
+
+    They travel with the request to the owner, which checks them against the
+    stored value, so a 304 or 412 comes back along the chain without the value.
+    """
+
+    def __init__(self, if_none_match=None, if_match=None):
+        self.if_none_match = if_none_match
+        self.if_match = if_match
+        self.etag = None
+
+    def headers(self):
+        headers = {"If-None-Match": self.if_none_match, "If-Match": self.if_match}
+        return {name: value for name, value in headers.items() if value is not None}
+
+    def not_modified(self, etag):
+        return self.if_none_match is not None and etag_matches(self.if_none_match, etag)
+
+    def allow_write(self, etag):
+        """Whether a PUT may replace the value with ETag `etag`, None when there is none."""
+        if self.if_match is not None and (etag is None or not etag_matches(self.if_match, etag)):
+            return False
+        return not (self.if_none_match is not None and etag is not None and etag_matches(self.if_none_match, etag))
+
+
 class Node:
-    def __init__(self, node_name, node_port, initialization_list):
-        self.M = 10 # 160
+    def __init__(self, node_name, node_port, initialization_list, M=10, transport=None, clock=time.monotonic, hash_name="sha1"):
+        self.M = M # up to 160
+        self.hash_name = hash_name
+        self.hashing = hash_function(hash_name, M)  # Ring id of a key
+        self.peer_ids = {}  # Ring ids of node addresses, asked for on every routing decision
+        self.write_lock = threading.Lock()  # Held by every write to the store, so a conditional PUT's check and write are one step
+        self.transport = transport
         self.node_name = node_name
         self.node_port = node_port
-        self.node_id = self.hashing(f"{node_name}:{node_port}")
+        self.node_id = self.peer_id(f"{node_name}:{node_port}")
         self.finger_table = []
-        self.key_val = {}
+        self.key_val = KeyValueStore(MerkleTree(M))
         self.succ = None
         self.pred = None
         
         self.crashed = False
+        self.running = True
+
+        started = time.perf_counter()
+        self.build_tables(initialization_list)
+        self.startup_seconds = time.perf_counter() - started  # Replaced by the whole start up time when run by main
+        
+        self.loop_prevent = []
+        self.loop_prevent_period = 30  # Seconds a loner refused by network_accept stays refused
+        self.stabilization_period = 1  # Probe interval while the ring changes
+        self.stabilization_max_period = 8  # Probe interval a stable ring backs off to
+        self.successor_max_period = 2  # The successor's probes back off less, since lookups fail until a dead one is replaced
+        self.stabilization_delay = self.stabilization_period
+        self.forward_timeout = 10
+        self.sync_batch = 256  # Buckets per /merkle request; keys per /merkle/values request is a quarter of it
+        self.repair_retries = 10  # Scheduled attempts at the sync after a recovery before giving up on it
+        self.repair_attempts = 0
 
+        self.trace_sample_rate = 0.0
+        self.traces = deque(maxlen=256)  # Recent traces of requests that entered the ring at this node
+        self.profiler = None
+
+        self.setup_metrics()
+        self.codec = Codec(None, sizes=self.compression_bytes, durations=self.compression_latency)
+        if self.transport is None:
+            self.transport = HttpTransport(self.forward_timeout, connections=self.peer_connections)
+        self.membership = Membership(f"{node_name}:{node_port}", self.transport, on_alive=self.add_node, on_suspect=self.remove_node,
+                                     on_dead=self.remove_node, requests=self.maintenance_requests, peers=lambda: [self.pred])
+        self.scheduler = Scheduler(clock, messages=lambda: self.membership.sent, paused=lambda: self.crashed, runs=self.maintenance_runs,
+                                   cpu=self.maintenance_cpu, deferred=self.maintenance_deferred)
+
+    def setup_metrics(self):
+        self.metrics = Registry()
+        self.request_latency = self.metrics.histogram("chord_request_duration_seconds", "Time spent handling a request, by route", ("route", "method", "status"))
+        self.storage_latency = self.metrics.histogram("chord_storage_duration_seconds", "Time spent serving /storage, answered locally or forwarded", ("method", "scope"))
+        self.lookup_hops = self.metrics.histogram("chord_lookup_hops", "Hops a /storage request took to reach its owner", ("method",), buckets=(0, 1, 2, 3, 4, 5, 6, 8, 10, 12, 16, 24, 32, 64))
+        self.forward_latency = self.metrics.histogram("chord_forward_duration_seconds", "Round trip of a forwarded request, by peer", ("peer",))
+        self.forward_failures = self.metrics.counter("chord_forward_failures_total", "Forwarded requests that failed, by peer", ("peer",))
+        self.peer_connections = self.metrics.counter("chord_peer_connections_total", "Requests sent to peers, by whether an idle connection was reused", ("reused",))
+        self.stabilize_latency = self.metrics.histogram("chord_stabilize_duration_seconds", "Duration of one stabilization tick")
+        self.maintenance_requests = self.metrics.counter("chord_maintenance_requests_total", "Requests sent by background maintenance", ("kind",))
+        self.maintenance_runs = self.metrics.counter("chord_maintenance_runs_total", "Runs of background maintenance tasks", ("task",))
+        self.maintenance_cpu = self.metrics.counter("chord_maintenance_cpu_seconds_total", "CPU time spent in background maintenance tasks", ("task",))
+        self.maintenance_deferred = self.metrics.counter("chord_maintenance_deferred_total", "Background task runs postponed by the CPU or message budget", ("task",))
+        self.metrics.gauge("chord_maintenance_interval_seconds", "Current interval of each background task", lambda: {(name,): interval for name, interval in self.scheduler.intervals().items()}, ("task",))
+        self.compression_bytes = self.metrics.counter("chord_compression_bytes_total", "Bytes of values compressed on put, before and after compression", ("encoding", "stage"))
+        self.compression_latency = self.metrics.histogram("chord_compression_duration_seconds", "CPU time spent compressing and decompressing values", ("encoding", "operation"),
+                                                          buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1))
+        self.metrics.gauge("chord_compression_ratio", "Bytes before compression per byte after, by encoding", self.compression_ratio, ("encoding",))
+        self.injected_faults = self.metrics.counter("chord_injected_faults_total", "Faults the --faults scenario injected into requests to peers", ("kind",))
+        self.repaired_keys = self.metrics.counter("chord_repaired_keys_total", "Keys pulled from a peer by anti-entropy sync")
+        self.metrics.gauge("chord_keys", "Keys held in the local store", lambda: len(self.key_val))
+        self.metrics.gauge("chord_startup_seconds", "Seconds from start until the node was serving, including building its tables", lambda: self.startup_seconds)
+        self.metrics.gauge("chord_finger_table_distinct", "Distinct nodes in the finger table", lambda: len(set(self.finger_table)))
+
+    def compression_ratio(self):
+        return {(encoding,): self.compression_bytes.get((encoding, "raw")) / self.compression_bytes.get((encoding, "compressed"))
+                for encoding in CODECS if self.compression_bytes.get((encoding, "compressed"))}
+
+    def peer_id(self, address):
+        node_id = self.peer_ids.get(address)
+        if node_id is None:
+            node_id = self.peer_ids[address] = self.hashing(address)
+        return node_id
+
+    def build_tables(self, initialization_list):
+        """Set the successor, predecessor and finger table from a list of ring members, including this node.
+
+        Sorting the ids costs O(N log N) and every entry is then a binary search,
+        so a node can start from a membership file of thousands of addresses.
+        """
         self.initialization_list = initialization_list
-        self.hashed_map = {self.hashing(node): node for node in self.initialization_list}
-        self.hashed_list = sorted([self.hashing(node) for node in self.initialization_list])
-        self.setup_succ_pred() 
+        self.hashed_map = {self.peer_id(node): node for node in self.initialization_list}
+        self.hashed_list = sorted(self.hashed_map)
+        self.setup_succ_pred()
         self.setup_finger_table()
         self.initialization_list = []  # Drop the list after organizing the ring and table
         self.hashed_map = {}
         self.hashed_list = []
-        
-        self.loop_prevent = []
-        self.loop_prevent_reset_period = 0
-        self.stabilization_period = 1
-        
-
-    def hashing(self, key):
-        return int(hashlib.sha1(key.encode()).hexdigest(), 16) % (2 ** self.M)
 
     def setup_succ_pred(self):
-        index = self.hashed_list.index(self.node_id)
+        index = bisect.bisect_left(self.hashed_list, self.node_id)
         self.pred = self.hashed_map[self.hashed_list[index - 1]]
         self.succ = self.hashed_map[self.hashed_list[(index + 1) % len(self.hashed_list)]]
 
@@ -63,39 +221,244 @@ class Node:
         self.finger_table = []
         for i in range(self.M):
             start = (self.node_id + 2**i) % (2**self.M)
-            #print(f"{self.node_port} finger_table[i={i}], {self.node_id} + {2**i} start: {start}, hashed_map: {self.hashed_map}")
-            successor = next((node for node in self.hashed_list if node >= start), self.hashed_list[0])
+            # The first node at or after start, wrapping around to the lowest id
+            successor = self.hashed_list[bisect.bisect_left(self.hashed_list, start) % len(self.hashed_list)]
             self.finger_table.append(self.hashed_map[successor])
-        #print(f"{self.node_port} finger_table: {self.finger_table}")
 
-    def get_value(self, key):
-        hashed_key = self.hashing(key)
+    def wrong_key_id(self, key, key_id):
+        # Hops before the owner route on a forwarded id without hashing; the owner hashes once to make sure it is the key's,
+        # so a request with a wrong id is refused instead of storing the key where no lookup finds it
+        return key_id is not None and key_id != self.hashing(key)
+
+    def readable(self, key, value):
+        """The text of `value`, or None, logged, when its compressed data is corrupt."""
+        try:
+            return self.codec.decompress(value)
+        except ValueError as e:
+            logger.warning("%s:%s: value of %r is corrupt: %s", self.node_name, self.node_port, key, e)
+            return None
+
+    def value_etag(self, key, value):
+        # The entry hash the Merkle tree already uses, so it covers the value as stored, compressed or not
+        return f'"{entry_hash(key, value):016x}"'
+
+    def get_value(self, key, hops=0, trace=None, key_id=None, preconditions=None):
+        """The value of `key` from its owner; with `preconditions` the owner sets their etag and may answer 304."""
+        started = time.perf_counter()
+        hashed_key = self.hashing(key) if key_id is None else key_id
         if self.is_responsible(hashed_key):
+            if self.wrong_key_id(key, key_id):
+                return "X-Chord-Key-Id does not match the key", 400
+            if trace is not None:
+                trace.append(self.trace_hop("local"))
             value = self.key_val.get(key)
+            self.lookup_hops.observe(hops, ("GET",))
+            self.storage_latency.observe(time.perf_counter() - started, ("GET", "local"))
             if value:
+                if preconditions is not None:
+                    preconditions.etag = self.value_etag(key, value)
+                    if preconditions.not_modified(preconditions.etag):
+                        return "", 304
                 return value, 200
             else:
                 return "Key not found", 404
         else:
-            return self.forward(key, f"/storage/{key}")
+            result = self.forward(key, f"/storage/{key}", hops=hops, trace=trace, key_id=hashed_key, preconditions=preconditions)
+            self.storage_latency.observe(time.perf_counter() - started, ("GET", "forwarded"))
+            return result
+
+    def put_value(self, key, value, hops=0, trace=None, key_id=None, preconditions=None):
+        """Store `value` (text, or Compressed as another node sent it) at its owner, compressing text first.
 
-    def put_value(self, key, value):
-        hashed_key = self.hashing(key)
+        `key_id` is the ring id of `key` when an earlier hop already computed it.
+        With `preconditions` the owner only writes if they hold, answering 412
+        otherwise, and sets their etag to that of the value it ends up holding.
+        """
+        started = time.perf_counter()
+        received, value = value, self.codec.compress(value)
+        hashed_key = self.hashing(key) if key_id is None else key_id
         #print(f"hashed_key: {hashed_key}, I am {self.node_id} port {self.node_port}, pred {self.pred.split(':')}, succ {self.succ.split(':')}")
         #print(f"finger_table: {self.finger_table}")
         if self.is_responsible(hashed_key):
             #print(f"PUT port{self.node_port}: is responsible TRUE")
-            self.key_val[key] = value
+            if self.wrong_key_id(key, key_id):
+                return "X-Chord-Key-Id does not match the key", 400
+            # A client may send compressed bodies, so the owner checks they decompress before storing them
+            if isinstance(received, Compressed) and self.readable(key, received) is None:
+                return f"Value does not decompress as {received.encoding}", 400
+            if trace is not None:
+                trace.append(self.trace_hop("local"))
+            with self.write_lock:
+                if preconditions is not None and (preconditions.if_match is not None or preconditions.if_none_match is not None):
+                    current = self.key_val.get(key)
+                    preconditions.etag = self.value_etag(key, current) if current is not None else None
+                    if not preconditions.allow_write(preconditions.etag):
+                        self.storage_latency.observe(time.perf_counter() - started, ("PUT", "local"))
+                        return "Precondition failed", 412
+                self.key_val.put(key, hashed_key, value)
+            if preconditions is not None:
+                preconditions.etag = self.value_etag(key, value)
+            self.lookup_hops.observe(hops, ("PUT",))
+            self.storage_latency.observe(time.perf_counter() - started, ("PUT", "local"))
             return "Stored", 200
         else:
             #print(f"PUT port{self.node_port}: is responsible FALSE")
-            return self.forward(key, f"/storage/{key}", method="PUT", data=value)
+            result = self.forward(key, f"/storage/{key}", method="PUT", data=value, hops=hops, trace=trace, key_id=hashed_key,
+                                  preconditions=preconditions)
+            self.storage_latency.observe(time.perf_counter() - started, ("PUT", "forwarded"))
+            return result
+
+    def scan(self, start=0, limit=100, cursor=None, ring=False, origin=None):
+        page, next_cursor = self.key_val.scan(start, limit, cursor)
+        texts = [(key_id, key, self.readable(key, value)) for key_id, key, value in page]
+        result = {
+            "node": f"{self.node_name}:{self.node_port}",
+            "items": [{"key": key, "id": key_id, "value": text} for key_id, key, text in texts if text is not None],
+            "cursor": encode_cursor(next_cursor),
+        }
+        if ring:
+            # Point the caller at the successor once this node is exhausted, until the walk is back at the origin
+            origin = origin or result["node"]
+            result["next_node"] = self.succ if next_cursor is None and self.succ != origin else None
+        return result
+
+    def node_info(self):
+        return {
+            "node_hash": self.node_id,
+            "successor": self.succ,
+            "others": list(set([self.pred] + [node for node in self.finger_table if node not in [self.succ, self.pred]]))
+        }
+
+    def in_range(self, key_id, lo, hi):
+        """Whether `key_id` lies in the ring range (lo, hi]; lo == hi is the whole ring."""
+        return lo == hi or key_id == hi or self.is_between(lo, key_id, hi)
+
+    def merkle_query(self, path, params):
+        """Answer /merkle (bucket digests), /merkle/keys (entry hashes) and /merkle/values for a syncing peer."""
+        merkle = self.key_val.merkle
+        try:
+            if path == "/merkle/values":
+                values = {key: self.key_val.get(key) for key in params.get("key", [])}
+                texts = {key: self.readable(key, value) for key, value in values.items() if value is not None}
+                return json.dumps({key: text for key, text in texts.items() if text is not None}), 200
+            buckets = [int(bucket) for bucket in params.get("buckets", [""])[0].split(",") if bucket]
+            if path == "/merkle/keys":
+                hashes = {}
+                for bucket in buckets:
+                    hashes.update(self.key_val.bucket_hashes(*merkle.bucket_range(merkle.depth, bucket)))
+                return json.dumps(hashes), 200
+            level = int(params["level"][0])
+        except (KeyError, ValueError):
+            return "Invalid merkle parameters", 400
+        if not 0 <= level <= merkle.depth:
+            return f"Level must be between 0 and {merkle.depth}", 400
+        return json.dumps({"depth": merkle.depth, "digests": [merkle.digest(level, bucket) for bucket in buckets]}), 200
+
+    def sync_range(self, peer, lo=None, hi=None):
+        """Pull the keys in (lo, hi] that differ on `peer`, by default this node's own range.
+
+        Digests are compared top down and only buckets that differ and overlap the
+        range are expanded, then the entry hashes of the differing leaves, and
+        only the keys whose hashes differ are fetched. The peer's value wins, as
+        it took the writes while this node was away. The peer's keys outside the
+        range make the buckets on the range boundary differ too, so each level
+        costs up to two extra buckets on top of the real difference.
+        """
+        if lo is None:
+            lo, hi = self.peer_id(self.pred), self.node_id
+        merkle = self.key_val.merkle
+        stats = {"peer": peer, "requests": 0, "buckets_compared": 0, "keys_compared": 0, "keys_repaired": 0}
+
+        def fetch(path, params):
+            stats["requests"] += 1
+            self.maintenance_requests.inc(("merkle",))
+            status, text, _ = self.transport.request(peer, "GET", f"{path}?{urlencode(params, doseq=True)}", timeout=self.forward_timeout)
+            if status != 200:
+                raise Exception(f"{peer} answered {path} with {status}: {text}")
+            return json.loads(text)
+
+        def overlaps(level, bucket):
+            first, last = merkle.bucket_range(level, bucket)
+            return self.in_range(first, lo, hi) or first <= (lo + 1) % (2 ** self.M) <= last
+
+        def batches(items, size):
+            return (items[i:i + size] for i in range(0, len(items), size))
+
+        differing = [0]
+        for level in range(merkle.depth + 1):
+            candidates = differing if level == 0 else [child for bucket in differing for child in (2 * bucket, 2 * bucket + 1) if overlaps(level, child)]
+            differing = []
+            for batch in batches(candidates, self.sync_batch):
+                remote = fetch("/merkle", {"level": level, "buckets": ",".join(map(str, batch))})
+                if remote["depth"] != merkle.depth:
+                    raise Exception(f"{peer} has a Merkle tree of depth {remote['depth']}, not {merkle.depth}")
+                differing.extend(bucket for bucket, digest in zip(batch, remote["digests"]) if digest != merkle.digest(level, bucket))
+            stats["buckets_compared"] += len(candidates)
+            if not differing:
+                return stats
+
+        remote_hashes = {}
+        for batch in batches(differing, self.sync_batch):
+            remote_hashes.update(fetch("/merkle/keys", {"buckets": ",".join(map(str, batch))}))
+        local_hashes = {}
+        for bucket in differing:
+            local_hashes.update(self.key_val.bucket_hashes(*merkle.bucket_range(merkle.depth, bucket)))
+        stats["keys_compared"] = len(remote_hashes)
+        wanted = [key for key, digest in remote_hashes.items() if local_hashes.get(key) != digest and self.in_range(self.hashing(key), lo, hi)]
+        for batch in batches(wanted, self.sync_batch // 4):
+            for key, value in fetch("/merkle/values", {"key": batch}).items():
+                with self.write_lock:
+                    self.key_val.put(key, self.hashing(key), self.codec.compress(value))
+                stats["keys_repaired"] += 1
+        self.repaired_keys.inc(amount=stats["keys_repaired"])
+        return stats
+
+    def export(self, lo=None, hi=None, binary=False, batch=1000):
+        """Yield the entries in (lo, hi], by default this node's own range, as dump records a page at a time.
+
+        Binary records keep compressed values as they are stored; NDJSON lines
+        carry the text. The store is only locked while a page is read.
+        """
+        if lo is None:
+            lo, hi = self.peer_id(self.pred), self.node_id
+        # Without wrapping, the range is one run of the id order; otherwise the whole store is filtered
+        start, stop = (lo + 1, hi) if lo < hi else (0, None)
+        cursor = None
+        while True:
+            page, cursor = self.key_val.scan(start, batch, cursor)
+            chunk = []
+            for key_id, key, value in page:
+                if stop is not None and key_id > stop:
+                    cursor = None
+                    break
+                if not self.in_range(key_id, lo, hi):
+                    continue
+                if binary:
+                    chunk.append(pack_record(key, value))
+                else:
+                    text = self.readable(key, value)
+                    if text is not None:
+                        chunk.append(json.dumps({"key": key, "value": text}).encode() + b"\n")
+            if chunk:
+                yield b"".join(chunk)
+            if cursor is None:
+                return
+
+    def import_records(self, records):
+        """Store (key, value) records, forwarding those this node does not own; returns the counts."""
+        counts = {"stored": 0, "forwarded": 0, "failed": 0}
+        for key, value in records:
+            key_id = self.hashing(key)
+            local = self.is_responsible(key_id)
+            _, status = self.put_value(key, value, key_id=key_id)
+            counts["failed" if status != 200 else "stored" if local else "forwarded"] += 1
+        return counts
 
     def is_responsible(self, hashed_key):
         #print(f"{self.hashing(self.pred)} < {hashed_key} <= {self.node_id}, {self.hashing(self.pred) < hashed_key <= self.node_id} ")
         if self.node_id == hashed_key:
             return True
-        pred_id = self.hashing(self.pred)
+        pred_id = self.peer_id(self.pred)
         if pred_id == self.node_id:  # single node only
             return True
         if pred_id < self.node_id:
@@ -108,62 +471,81 @@ class Node:
                 return True
         return False
     def find_forward_address(self, hashed_key):
-        #print(f"finger_table: {[self.hashing(self.finger_table[i]) for i in range(self.M)]}")
-        for i in range(self.M):
-            #print(f"Forwarding? {self.finger_table[i]} >= {hashed_key}")
-            if self.hashing(self.finger_table[i]) >= hashed_key:
-                if i == 0:
-                    #print(f"Forwarding to finger_table[i=0]{self.finger_table[i]}")
-                    return self.finger_table[i]
-                #print(f"Forwarding to finger_table[i={i-1}]{self.finger_table[i-1]}")
-                return self.finger_table[i-1]
-        #print(f"Forwarding to finger_table[0]{self.finger_table[0]}")
-        return self.finger_table[0]
+        # The successor owns keys in (self, succ]; otherwise jump to the closest finger preceding the key,
+        # measured around the ring so keys behind this node do not fall back to walking successors
+        succ_id = self.peer_id(self.succ)
+        if hashed_key == succ_id or self.is_between(self.node_id, hashed_key, succ_id):
+            return self.succ
+        for i in range(self.M - 1, -1, -1):
+            if self.is_between(self.node_id, self.peer_id(self.finger_table[i]), hashed_key):
+                #print(f"Forwarding to finger_table[i={i}]{self.finger_table[i]}")
+                return self.finger_table[i]
+        return self.succ
     
-    def forward(self, key, url, method="GET", data=None):
-        forward_host, forward_port = self.find_forward_address(self.hashing(key)).split(":")
-        conn = http.client.HTTPConnection(forward_host, int(forward_port))
-        #print(f"Forwarding to {forward_host}:{forward_port}")
+    def trace_hop(self, decision):
+        return {"node": f"{self.node_name}:{self.node_port}", "node_id": self.node_id, "decision": decision, "ms": None}
+
+    def record_trace(self, trace_id, method, key, status, hops):
+        self.traces.append({
+            "trace_id": trace_id,
+            "method": method,
+            "key": key,
+            "status": status,
+            "time": time.time(),
+            "ms": hops[0]["ms"] if hops else None,
+            "hops": hops,
+        })
+
+    def forward(self, key, url, method="GET", data=None, hops=0, trace=None, key_id=None, preconditions=None):
+        key_id = self.hashing(key) if key_id is None else key_id
+        peer = self.find_forward_address(key_id)
+        #print(f"Forwarding to {peer}")
+        started = time.perf_counter()
         try:
-            if method == "GET":
-                conn.request("GET", url)
-            elif method == "PUT":
-                headers = {"Content-type": "text/plain"}
-                conn.request("PUT", url, body=data, headers=headers)
-            response = conn.getresponse()
-            response_text = response.read().decode()
-            return response_text, response.status
+            # The next hop takes the key id from X-Chord-Key-Id instead of hashing the key again
+            headers = {"X-Chord-Hops": str(hops + 1), "X-Chord-Key-Id": str(key_id), "Accept-Encoding": ", ".join(CODECS)}
+            if isinstance(data, Compressed):
+                headers["Content-Encoding"] = data.encoding
+                data = data.data
+            updates = self.membership.piggyback()
+            if updates:
+                headers["X-Chord-Gossip"] = json.dumps(updates, separators=(",", ":"))
+            if trace is not None:
+                trace.append(self.trace_hop(f"forward {peer}"))
+                headers["X-Chord-Trace"] = trace.trace_id
+            if method == "PUT":
+                headers["Content-type"] = "text/plain"
+            if preconditions is not None:
+                headers.update(preconditions.headers())
+            status, response_text, response_headers = self.transport.request(peer, method, url, body=data, headers=headers, timeout=self.forward_timeout)
+            self.forward_latency.observe(time.perf_counter() - started, (peer,))
+            if preconditions is not None:
+                preconditions.etag = response_headers.get("ETag")
+            if trace is not None and response_headers.get("X-Chord-Trace-Hops"):
+                trace.extend(json.loads(response_headers["X-Chord-Trace-Hops"]))
+            if response_headers.get("Content-Encoding") in CODECS and not isinstance(response_text, Compressed):
+                # Passed on as is; only the entry node decompresses, and only for clients that cannot
+                response_text = Compressed(response_headers["Content-Encoding"], response_text)
+            return response_text, status
         except Exception as e:
+            self.forward_failures.inc((peer,))
             return f"Forwarding failed: {e}", 500
-        finally:
-            conn.close()
             
     def network_join(self, nprime):
-        forward_host, forward_port = nprime.split(":")
-        conn = http.client.HTTPConnection(forward_host, int(forward_port))
         headers = {"Content-type": "text/plain"}
         body = f"{self.node_name}:{self.node_port},{nprime}"
         #print(f"network join forwards")
-        conn.request("PUT", "/API/join", body=body, headers=headers)
-        response = conn.getresponse()
-        response_text = response.read().decode()
-        if response.status == 200:
+        status, response_text, _ = self.transport.request(nprime, "PUT", "/API/join", body=body, headers=headers)
+        if status == 200:
             #print("initializing with the response")
             #print(response_text)
-            self.initialization_list = response_text.split(",")
-            self.initialization_list = [node for node in self.initialization_list if node] + [f"{self.node_name}:{self.node_port}"]
-            #print(self.initialization_list)
-            self.hashed_map = {self.hashing(node): node for node in self.initialization_list}
-            self.hashed_list = sorted([self.hashing(node) for node in self.initialization_list])
-            self.setup_succ_pred() 
-            self.setup_finger_table()
-            self.initialization_list = []  # Drop the list after organizing the ring and table
-            self.hashed_map = {}
-            self.hashed_list = []
-        conn.close()
+            self.build_tables([node for node in response_text.split(",") if node] + [f"{self.node_name}:{self.node_port}"])
+            self.membership.rejoin()
+            self.scheduler.changed()
     
     async def network_accept(self, body):
         loner, nprime = body.split(",")
+        self.membership.revive(loner)
         others = list(set([self.pred, self.succ, f"{self.node_name}:{self.node_port}"] + [node for node in self.finger_table]))
         #print(f"{self.node_name} {self.node_port}others {others}")
         if loner in others:
@@ -176,16 +558,12 @@ class Node:
         
         network = [f"{self.node_name}:{self.node_port}"]
         for node in others:
-            if self.is_between(self.node_id, self.hashing(node), self.hashing(nprime)):
-                conn = http.client.HTTPConnection(node.split(":")[0], node.split(":")[1])
+            if self.is_between(self.node_id, self.peer_id(node), self.peer_id(nprime)):
                 headers = {"Content-type": "text/plain"}
                 body = f"{loner},{nprime}"
-                conn.request("PUT", "/API/join", body=body, headers=headers)
-                response = conn.getresponse()
-                response_text = response.read().decode()
-                if response.status == 200:
+                status, response_text, _ = self.transport.request(node, "PUT", "/API/join", body=body, headers=headers)
+                if status == 200:
                     network.extend(response_text.split(","))
-                conn.close()
         return ",".join(network)
     
     def is_between(self, left, middle, right):
@@ -201,219 +579,467 @@ class Node:
     def add_node(self, node):
         #print(f"adds node {node}")
         change = False
-        hashed_key = self.hashing(node)
-        if self.is_between(self.hashing(self.pred), hashed_key, self.node_id):
+        hashed_key = self.peer_id(node)
+        if self.is_between(self.peer_id(self.pred), hashed_key, self.node_id):
             self.pred = node
             change = True
             #print("changed pred")
-        if self.is_between(self.node_id, hashed_key, self.hashing(self.succ)):
+        if self.is_between(self.node_id, hashed_key, self.peer_id(self.succ)):
             self.succ = node
             change = True
             #print("changed succ")
         for i in range(self.M):
             start = (self.node_id + 2**i) % (2**self.M)
-            if self.is_between(start, hashed_key, self.hashing(self.finger_table[i])):
+            if self.is_between(start, hashed_key, self.peer_id(self.finger_table[i])):
                 self.finger_table[i] = node
                 change = True
                 #print("changed finger")
+        if change:
+            self.scheduler.changed()
         return change
+
+    def recover(self):
+        self.crashed = False
+        self.loop_prevent = []
+        self.scheduler.changed()
+        others = list(set([self.pred, self.succ] + self.finger_table))
+        try:
+            others.remove(f"{self.node_name}:{self.node_port}")  # Remove self from others
+        except Exception as e:
+            pass
+        if len(others) == 0:
+            return "Node has recovered", 200
+        for node in others:
+            try:
+                self.network_join(node)
+            except Exception as e:
+                continue
+            for peer in {self.succ, self.pred} - {f"{self.node_name}:{self.node_port}"}:
+                # Outbid the dead verdict right away instead of waiting to be probed
+                self.membership.ping(peer)
+            if not self.repair_range():
+                # Retried once stabilization has given the node a successor, or the successor answers
+                self.repair_attempts = 0
+                self.scheduler.add("repair", self.repair_task, self.stabilization_period, self.stabilization_max_period)
+            return "Joined network successfully", 200
+        return "Node has NOT recovered", 500
+
+    def repair_range(self):
+        """Pull the writes to this node's range that went to its successor while it was down; True once done."""
+        me = f"{self.node_name}:{self.node_port}"
+        if self.succ == me:
+            # A peer that still had us in its tables sends no ring back, which leaves us alone until stabilization
+            return False
+        try:
+            stats = self.sync_range(self.succ)
+        except Exception as e:
+            logger.warning("%s: repair from %s after recovery failed: %s", me, self.succ, e)
+            return False
+        if stats["keys_repaired"]:
+            logger.info("%s: repaired %d keys from %s after recovery", me, stats["keys_repaired"], self.succ)
+        return True
+
+    def repair_task(self):
+        self.repair_attempts += 1
+        if self.repair_range():
+            self.scheduler.remove("repair")
+        elif self.repair_attempts >= self.repair_retries:
+            logger.warning("%s:%s: gave up on the repair after recovery; run PUT /sync to retry", self.node_name, self.node_port)
+            self.scheduler.remove("repair")
+
     def leave_network(self):
+        self.membership.leave({self.pred, self.succ} - {f"{self.node_name}:{self.node_port}"})
         self.pred = f"{self.node_name}:{self.node_port}"
         self.succ = f"{self.node_name}:{self.node_port}"
         for i in range(self.M):
             self.finger_table[i] = f"{self.node_name}:{self.node_port}"
 
+    def schedule_maintenance(self):
+        """Register the background work with the scheduler, using the periods currently set on the node."""
+        # Give the rest of a freshly started ring time to come up before probing it
+        self.scheduler.hold(self.stabilization_delay)
+        unsettled = lambda: not self.membership.settled()
+        self.scheduler.add("stabilize", self.stabilize_tick, self.stabilization_period, self.stabilization_max_period, busy=unsettled)
+        self.scheduler.add("successor", self.probe_successor, self.stabilization_period,
+                           min(self.successor_max_period, self.stabilization_max_period), busy=unsettled)
+        self.scheduler.add("expire", self.expire_loop_prevent, self.loop_prevent_period)
+        self.scheduler.add("compact", lambda: self.key_val.tidy(), 10, 120)
+
     def periodic_stabilize(self):
-        while True:
-            if not self.crashed:
-                self.look_for_crashes()  # Await the asynchronous look_for_crashes
-                time.sleep(self.stabilization_period)  # Use asyncio.sleep instead of time.sleep
-                self.loop_prevent_reset_period += self.stabilization_period
-                if self.loop_prevent_reset_period > 30:
-                    self.loop_prevent_reset_period = 0
-                    self.loop_prevent = []
-            
-    def look_for_crashes(self):
-        others = list(set([self.pred, self.succ] + [node for node in self.finger_table]))
-        for node in others:
-            try:
-                conn = http.client.HTTPConnection(node.split(":")[0], int(node.split(":")[1]))
-                conn.request("GET", "/node-info")
-                response = conn.getresponse()
-                if response.status != 200:
-                    raise Exception(f"Node {node} is not responding.")
-                data = json.loads(response.read().decode())
-                if data["successor"] == node:
-                    raise Exception(f"Node {node} is a loner.")
-            except Exception as e:
-                self.remove_node(node)
-            finally:
-                conn.close()
-    
+        self.schedule_maintenance()
+        self.scheduler.run(lambda: self.running)
+
+    def stabilize_tick(self):
+        started = time.perf_counter()
+        self.membership.add([self.pred, self.succ] + self.finger_table)
+        self.membership.tick()
+        self.stabilize_latency.observe(time.perf_counter() - started)
+
+    def probe_successor(self):
+        self.membership.add([self.succ])
+        if self.membership.state(self.succ) == ALIVE:
+            self.membership.probe(self.succ)
+
+    def expire_loop_prevent(self):
+        self.loop_prevent = []
+
     def remove_node(self, node):
-        if node in self.finger_table:
-            for i in range(self.M -1, -1, -1):
-                if self.finger_table[i] == node:
-                    self.finger_table[i] = self.finger_table[(i+1) % self.M]
-                    while True:
-                        conn = http.client.HTTPConnection(self.finger_table[(i) % self.M].split(":")[0], int(self.finger_table[(i) % self.M].split(":")[1]))
-                        conn.request("GET", "/node")
-                        response = conn.getresponse()
-                        if response.status != 200:
-                            conn.close()
-                            break
-                        data = json.loads(response.read().decode())
-                        pred = data["predecessor"]
-                        if self.is_between(self.hashing(node), self.hashing(pred), self.hashing(self.finger_table[i])) and pred != node:
-                            self.finger_table[i] = pred
-                        else:
-                            conn.close()
-                            break
-                        conn.close()
-        if node == self.succ:
-            self.succ = self.finger_table[0]
-            
-        if node == self.pred:
-        # Find the node that has this node or the node to be removed as its successor through API calls
-            others = list(set([node for node in self.finger_table]))
-            for other_node in others:
-                try:
-                    conn = http.client.HTTPConnection(other_node.split(":")[0], int(other_node.split(":")[1]))
-                    conn.request("GET", "/network")
-                    response = conn.getresponse()
-                    if response.status == 200:
-                        data = json.loads(response.read().decode())
-                        if data["successor"] == node:
-                            self.pred = other_node
-                        elif data["successor"] == f"{self.node_name}:{self.node_port}":
-                            self.pred = other_node
-                except Exception as e:
-                    pass
-                finally:
-                    conn.close()
+        """Route around a suspect or dead member, using the members this node knows to be alive.
+
+        If a suspect refutes the suspicion, add_node puts it back.
+        """
+        me = f"{self.node_name}:{self.node_port}"
+        live = {address for address in self.membership.live() + [self.pred, self.succ] + self.finger_table + [me]
+                if address != node and self.membership.state(address) in (None, ALIVE)}
+        ring = sorted((self.peer_id(address), address) for address in live)
+        ids = [node_id for node_id, _ in ring]
+
+        def successor(ring_id):
+            return ring[bisect.bisect_left(ids, ring_id % (2 ** self.M)) % len(ring)][1]
+
+        for i in range(self.M):
+            if self.finger_table[i] == node:
+                self.finger_table[i] = successor(self.node_id + 2 ** i)
+        if self.pred == node:
+            self.pred = ring[bisect.bisect_left(ids, self.node_id) - 1][1]
+        if self.succ == node:
+            self.succ = successor(self.node_id + 1)
+            if self.succ != me:
+                # Let the new successor learn of us as its predecessor
+                self.membership.ping(self.succ)
+        self.scheduler.changed()
 
 class ServerHandler(SimpleHTTPRequestHandler):
     def __init__(self, *args, node_instance=None, **kwargs):
         self.node_instance = node_instance
         super().__init__(*args, **kwargs)
 
+    # Keep-alive, so clients and peers can reuse connections; every reply carries a Content-Length
+    protocol_version = "HTTP/1.1"
+    timeout = 60  # Close connections idle for this long
+    gzip_min_size = 1024
+
+    def setup(self):
+        # The headers and the body go out in separate writes, which Nagle's algorithm holds back until
+        # the client's delayed ACK on a reused connection; Unix sockets have no Nagle to turn off
+        self.disable_nagle_algorithm = self.request.family in (socket.AF_INET, socket.AF_INET6)
+        super().setup()
+
+    def log_message(self, format, *args):
+        # Per-request logging goes through /metrics instead
+        pass
+
+    def address_string(self):
+        # Peers on the Unix socket have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def reply(self, status, body, content_type="text/plain", headers=None, etag=False, gzip=False):
+        if isinstance(body, str):
+            body = body.encode()
+        headers = dict(headers or {})
+        if etag and status == 200:
+            tag = '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+            headers["ETag"] = tag
+            if etag_matches(self.headers.get("If-None-Match", ""), tag):
+                status = 304
+        if status == 304:
+            # No body, and no Content-Length that would describe one
+            self.send_response(304)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        if gzip:
+            headers["Vary"] = "Accept-Encoding"
+            if len(body) >= self.gzip_min_size and "gzip" in accepted_encodings(self.headers.get("Accept-Encoding")):
+                body = gzip_module.compress(body, compresslevel=5)
+                headers["Content-Encoding"] = "gzip"
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, status, chunks, content_type="text/plain"):
+        """Reply with the byte strings `chunks` yields, sent with chunked encoding as they come."""
+        self.send_response(status)
+        self.send_header("Content-type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+        self.wfile.write(b"0\r\n\r\n")
+
+    routes = ("/helloworld", "/storage", "/network", "/node", "/node-info", "/predecessor", "/successor", "/scan", "/metrics", "/traces",
+              "/merkle", "/merkle/keys", "/merkle/values", "/sync", "/export", "/import", "/gossip/ping", "/gossip/ping-req", "/sim-recover", "/sim-crash", "/join", "/API/join", "/leave",
+              "/admin/profile", "/admin/profile/start", "/admin/profile/stop", "/admin/profile/result")
+
+    def route(self):
+        path = urlsplit(self.path).path
+        if path.startswith("/storage/"):
+            return "/storage"
+        return path if path in self.routes else "other"
+
+    def send_response(self, code, message=None):
+        self.status_code = code
+        super().send_response(code, message)
+
+    def handle_one_request(self):
+        self.command = None
+        self.status_code = None
+        started = time.perf_counter()
+        super().handle_one_request()
+        if self.command and self.status_code:
+            self.node_instance.request_latency.observe(time.perf_counter() - started, (self.route(), self.command, str(self.status_code)))
+
+    def traced_storage(self, key, operation):
+        """Run a /storage operation, tracing it when the caller asked for it or this entry node samples it."""
+        started = time.perf_counter()
+        try:
+            hops = int(self.headers.get("X-Chord-Hops", 0))
+        except ValueError:
+            hops = -1
+        if hops < 0:
+            self.reply(400, "X-Chord-Hops must be a non-negative integer")
+            return
+        trace_id = self.headers.get("X-Chord-Trace")
+        if trace_id == "1" or (trace_id is None and hops == 0 and random.random() < self.node_instance.trace_sample_rate):
+            trace_id = uuid.uuid4().hex[:16]
+        trace = Trace(trace_id) if trace_id else None
+        if self.headers.get("X-Chord-Gossip"):
+            try:
+                updates = parse_updates(json.loads(self.headers["X-Chord-Gossip"]))
+            except ValueError:
+                self.reply(400, "X-Chord-Gossip must be a list of [address, state, incarnation] updates")
+                return
+            self.node_instance.membership.receive(updates)
+        # Only a forwarding node sends the key id, and it hashed the key the way this ring does; the owner checks it
+        key_id = None
+        if hops and "X-Chord-Key-Id" in self.headers:
+            try:
+                key_id = int(self.headers["X-Chord-Key-Id"])
+            except ValueError:
+                key_id = -1
+            if not 0 <= key_id < 2 ** self.node_instance.M:
+                self.reply(400, "X-Chord-Key-Id must be a ring id")
+                return
+        preconditions = Preconditions(self.headers.get("If-None-Match"), self.headers.get("If-Match"))
+        response, status = operation(key, hops, trace, key_id, preconditions)
+        headers = {"ETag": preconditions.etag} if preconditions.etag else {}
+        if trace:
+            trace[0]["ms"] = round((time.perf_counter() - started) * 1000, 3)
+            headers["X-Chord-Trace"] = trace_id
+            headers["X-Chord-Trace-Hops"] = json.dumps(trace, separators=(",", ":"))
+            if hops == 0:
+                self.node_instance.record_trace(trace_id, self.command, key, status, trace)
+        if isinstance(response, Compressed):
+            if response.encoding in accepted_encodings(self.headers.get("Accept-Encoding")):
+                headers["Content-Encoding"] = response.encoding
+                response = response.data
+            else:
+                response = self.node_instance.readable(key, response)
+                if response is None:
+                    self.reply(500, "Stored value does not decompress")
+                    return
+        self.reply(status, response, headers=headers)
+
+    def parse_page_params(self, params):
+        try:
+            start = int(params.get("start", ["0"])[0])
+            limit = min(max(int(params.get("limit", ["100"])[0]), 1), 1000)
+            cursor = decode_cursor(params["cursor"][0]) if "cursor" in params else None
+        except ValueError:
+            self.reply(400, "Invalid scan parameters")
+            return None
+        return start, limit, cursor
+
+    def read_import(self, body):
+        """(key, value) records of an /import body; ValueError naming the byte offset of the first bad one."""
+        binary = self.headers.get('Content-type') == "application/octet-stream"
+        stream = io.BytesIO(body)
+        records = []
+        while True:
+            offset = stream.tell()
+            try:
+                if binary:
+                    record = read_record(stream)
+                    if record is None:
+                        return records
+                else:
+                    line = stream.readline()
+                    if not line:
+                        return records
+                    item = json.loads(line) if line.strip() else None
+                    if not item:
+                        continue
+                    if not isinstance(item, dict) or "key" not in item or "value" not in item:
+                        raise ValueError("record needs a key and a value")
+                    record = (item["key"], item["value"])
+                if not isinstance(record[0], str) or not isinstance(record[1], (str, Compressed)):
+                    raise ValueError("key and value must be strings")
+            except (ValueError, KeyError, TypeError, IndexError, struct.error) as e:
+                raise ValueError(f"Invalid import record at byte {offset}: {e}") from e
+            records.append(record)
+
     def do_GET(self):
         if self.node_instance.crashed:
-            self.send_response(500)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write("Node has crashed".encode())
+            self.reply(500, "Node has crashed")
             return
         if self.path == '/helloworld':
             response = f"{self.node_instance.node_name}:{self.node_instance.node_port}"
-            self.send_response(200)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(response.encode())
+            self.reply(200, response)
         elif self.path.startswith('/storage/'):
             key = self.path[len('/storage/'):]
-            response, status = self.node_instance.get_value(key)
-            self.send_response(status)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(response.encode())
+            self.traced_storage(key, self.node_instance.get_value)
         elif self.path == '/network':
             response = json.dumps({
                 "successor": self.node_instance.succ,
                 "predecessor": self.node_instance.pred,
-                "finger_table": self.node_instance.finger_table
+                "finger_table": self.node_instance.finger_table,
+                "node_id": self.node_instance.node_id,
+                "M": self.node_instance.M,
+                "hash": self.node_instance.hash_name
             })
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(response.encode())
-        elif self.path == '/node':
-            response = json.dumps({
+            self.reply(200, response, "application/json", etag=True, gzip=True)
+        elif urlsplit(self.path).path == '/node':
+            # Store contents are opt-in and paginated so polling a node's routing state stays cheap
+            params = parse_qs(urlsplit(self.path).query)
+            node = {
                 "node_name": self.node_instance.node_name,
                 "node_port": self.node_instance.node_port,
                 "successor": self.node_instance.succ,
                 "predecessor": self.node_instance.pred,
                 "finger_table": self.node_instance.finger_table,
-                "key_value_store": self.node_instance.key_val,
-                "node_id": self.node_instance.node_id
-            })
-            self.send_response(200)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(response.encode())
-        elif self.path == '/node-info':
-            node_info = {
-                "node_hash": self.node_instance.node_id,
-                "successor": self.node_instance.succ,
-                "others": list(set([self.node_instance.pred] + [node for node in self.node_instance.finger_table if node not in [self.node_instance.succ, self.node_instance.pred]]))
+                "key_count": len(self.node_instance.key_val),
+                "node_id": self.node_instance.node_id,
+                "M": self.node_instance.M,
+                "hash": self.node_instance.hash_name
             }
-            response = json.dumps(node_info)
-            self.send_response(200)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            self.wfile.write(response.encode())
+            if params.get("store", ["0"])[0] == "1":
+                page = self.parse_page_params(params)
+                if page is None:
+                    return
+                start, limit, cursor = page
+                scan = self.node_instance.scan(start, limit, cursor)
+                node["key_value_store"] = {item["key"]: item["value"] for item in scan["items"]}
+                node["cursor"] = scan["cursor"]
+            self.reply(200, json.dumps(node), "application/json", etag=True, gzip=True)
+        elif self.path == '/predecessor':
+            self.reply(200, self.node_instance.pred, etag=True)
+        elif self.path == '/successor':
+            self.reply(200, self.node_instance.succ, etag=True)
+        elif self.path == '/node-info':
+            response = json.dumps(self.node_instance.node_info())
+            self.reply(200, response, "application/json", etag=True)
+        elif self.path.startswith('/scan'):
+            params = parse_qs(urlsplit(self.path).query)
+            page = self.parse_page_params(params)
+            if page is None:
+                return
+            start, limit, cursor = page
+            ring = params.get("ring", ["0"])[0] == "1"
+            origin = params.get("origin", [None])[0]
+            response = json.dumps(self.node_instance.scan(start, limit, cursor, ring, origin))
+            self.reply(200, response, "application/json", gzip=True)
+        elif urlsplit(self.path).path == '/traces':
+            params = parse_qs(urlsplit(self.path).query)
+            try:
+                limit = int(params.get("limit", ["50"])[0])
+            except ValueError:
+                self.reply(400, "limit must be an integer")
+                return
+            # The most recent `limit` traces; traces[-0:] would be all of them
+            traces = list(self.node_instance.traces)[-limit:] if limit > 0 else []
+            self.reply(200, json.dumps(traces), "application/json", gzip=True)
+        elif urlsplit(self.path).path == '/admin/profile':
+            profiler = self.node_instance.profiler
+            self.reply(200, json.dumps(profiler.summary() if profiler else None), "application/json")
+        elif urlsplit(self.path).path == '/admin/profile/result':
+            profiler = self.node_instance.profiler
+            if profiler is None or profiler.running:
+                self.reply(409, "No finished profile, stop the profiler first")
+                return
+            profile_format = parse_qs(urlsplit(self.path).query).get("format", ["collapsed"])[0]
+            if profile_format == "pstats":
+                self.reply(200, profiler.pstats(), "application/octet-stream",
+                           headers={"Content-Disposition": f'attachment; filename="{self.node_instance.node_port}.pstats"'})
+            elif profile_format == "collapsed":
+                self.reply(200, profiler.collapsed(), gzip=True,
+                           headers={"Content-Disposition": f'attachment; filename="{self.node_instance.node_port}.folded"'})
+            else:
+                self.reply(400, "Unknown profile format, use collapsed or pstats")
+        elif urlsplit(self.path).path in ('/merkle', '/merkle/keys', '/merkle/values'):
+            url = urlsplit(self.path)
+            response, status = self.node_instance.merkle_query(url.path, parse_qs(url.query))
+            self.reply(status, response, "application/json" if status == 200 else "text/plain", gzip=True)
+        elif urlsplit(self.path).path == '/export':
+            params = parse_qs(urlsplit(self.path).query)
+            try:
+                lo, hi = (int(params["lo"][0]), int(params["hi"][0])) if "lo" in params else (None, None)
+            except (KeyError, ValueError):
+                self.reply(400, "Invalid export range, give both lo and hi")
+                return
+            export_format = params.get("format", ["ndjson"])[0]
+            if export_format not in ("ndjson", "binary"):
+                self.reply(400, "Unknown export format, use ndjson or binary")
+                return
+            binary = export_format == "binary"
+            self.stream(200, self.node_instance.export(lo, hi, binary), "application/octet-stream" if binary else "application/x-ndjson")
+        elif self.path == '/metrics':
+            self.reply(200, self.node_instance.metrics.render(), "text/plain; version=0.0.4", gzip=True)
         else:
-            self.send_response(404)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write("Not found".encode())
+            self.reply(404, "Not found")
 
     def do_PUT(self):
         if self.path.startswith('/sim-recover'):
-            self.node_instance.crashed = False
-            self.node_instance.loop_prevent_reset_period = 0
-            self.node_instance.loop_prevent = []
-            response = "Node has recovered"
             #print("recovering")
-            def recover_node():
-                others = list(set([self.node_instance.pred, self.node_instance.succ] + self.node_instance.finger_table))
-                try:
-                    others.remove(f"{self.node_instance.node_name}:{self.node_instance.node_port}")  # Remove self from others
-                except Exception as e:
-                    pass
-                for node in others:
-                    try:
-                        #print(node)
-                        try:
-                            self.node_instance.network_join(node)
-                            response = "Joined network successfully"
-                            status = 200
-                        except Exception as e:
-                            response = f"Failed to join network: {e}"
-                            status = 500
-                        if status == 200:
-                            #print("status 200")
-                            break
-                    except Exception as e:
-                        continue
-                else:
-                    response = "Node has NOT recovered"
-                    status = 500
-                if len(others) == 0:
-                    response = "Node has recovered"
-                    status = 200
-                self.send_response(status)
-                self.send_header("Content-type", "text/plain")
-                self.end_headers()
-                self.wfile.write(response.encode())
-                return
-            recover_node()
+            response, status = self.node_instance.recover()
+            self.reply(status, response)
             return
         if self.node_instance.crashed:
-            self.send_response(500)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write("Node is crashed".encode())
+            self.reply(500, "Node is crashed")
             return
-        if self.path.startswith('/storage/'):
+        if urlsplit(self.path).path == '/admin/profile/start':
+            if self.node_instance.profiler is not None and self.node_instance.profiler.running:
+                self.reply(409, "Profiler is already running")
+                return
+            params = parse_qs(urlsplit(self.path).query)
+            try:
+                interval = float(params.get("interval", ["0.005"])[0])
+                duration = float(params.get("duration", ["60"])[0])
+            except ValueError:
+                self.reply(400, "Invalid profiler parameters")
+                return
+            # A zero, negative or NaN interval would make the sampler spin
+            if not all(math.isfinite(value) and value > 0 for value in (interval, duration)):
+                self.reply(400, "interval and duration must be positive numbers")
+                return
+            self.node_instance.profiler = SamplingProfiler(interval, min(duration, 600))
+            self.node_instance.profiler.start()
+            self.reply(200, json.dumps(self.node_instance.profiler.summary()), "application/json")
+        elif urlsplit(self.path).path == '/admin/profile/stop':
+            if self.node_instance.profiler is None:
+                self.reply(409, "Profiler was never started")
+                return
+            self.node_instance.profiler.stop()
+            self.reply(200, json.dumps(self.node_instance.profiler.summary()), "application/json")
+        elif self.path.startswith('/storage/'):
             key = self.path[len('/storage/'):]
             content_length = int(self.headers['Content-Length'])
-            value = self.rfile.read(content_length).decode('utf-8')
-            response, status = self.node_instance.put_value(key, value)
-            self.send_response(status)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(response.encode())
+            value = self.rfile.read(content_length)
+            encoding = self.headers.get('Content-Encoding')
+            if encoding and encoding not in CODECS:
+                self.reply(415, f"Unsupported Content-Encoding, use one of {', '.join(CODECS)}")
+                return
+            try:
+                value = Compressed(encoding, value) if encoding else value.decode('utf-8')
+            except UnicodeDecodeError:
+                self.reply(400, "Value must be UTF-8 text")
+                return
+            self.traced_storage(key, lambda key, hops, trace, key_id, preconditions:
+                                self.node_instance.put_value(key, value, hops, trace, key_id, preconditions))
         elif self.path.startswith('/join'):
             #print("joining")
             # Parse the nprime parameter from the URL
@@ -434,10 +1060,7 @@ class ServerHandler(SimpleHTTPRequestHandler):
                 response = "Invalid request: nprime parameter is missing"
                 status = 400
 
-            self.send_response(status)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(response.encode())
+            self.reply(status, response)
         elif self.path.startswith('/API/join'):
             content_length = int(self.headers['Content-Length'])
             body = self.rfile.read(content_length).decode('utf-8')
@@ -447,15 +1070,11 @@ class ServerHandler(SimpleHTTPRequestHandler):
                 response = asyncio.run(self.node_instance.network_accept(body))
             
             status = 200
-            self.send_response(status)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(response.encode())
+            self.reply(status, response)
         elif self.path.startswith('/leave'):
             try:
                 # Reset the node to its initial state
                 self.node_instance.leave_network()
-                self.node_instance.loop_prevent_reset_period = 0
                 self.node_instance.loop_prevent = []
                 response = "Node has left the network successfully"
                 status = 200
@@ -463,72 +1082,160 @@ class ServerHandler(SimpleHTTPRequestHandler):
                 response = f"Failed to leave network: {e}"
                 status = 500
 
-            self.send_response(status)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(response.encode())
+            self.reply(status, response)
+        elif self.path in ('/gossip/ping', '/gossip/ping-req'):
+            content_length = int(self.headers['Content-Length'])
+            body = self.rfile.read(content_length)
+            membership = self.node_instance.membership
+            try:
+                response = membership.handle_ping(body) if self.path == '/gossip/ping' else membership.handle_ping_req(body)
+            except ValueError as e:
+                self.reply(400, f"Malformed gossip message: {e}")
+                return
+            self.reply(200, response, "application/json")
+        elif urlsplit(self.path).path == '/sync':
+            peer = parse_qs(urlsplit(self.path).query).get("peer", [self.node_instance.succ])[0]
+            try:
+                self.reply(200, json.dumps(self.node_instance.sync_range(peer)), "application/json")
+            except Exception as e:
+                self.reply(502, f"Sync with {peer} failed: {e}")
+        elif self.path == '/import':
+            content_length = int(self.headers['Content-Length'])
+            try:
+                records = self.read_import(self.rfile.read(content_length))
+            except ValueError as e:
+                self.reply(400, str(e))
+                return
+            self.reply(200, json.dumps(self.node_instance.import_records(records)), "application/json")
         elif self.path.startswith('/sim-crash'):
             self.node_instance.crashed = True
             response = "Node has crashed"
             status = 200
-            self.send_response(status)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write(response.encode())
+            self.reply(status, response)
         else:
-            self.send_response(404)
-            self.send_header("Content-type", "text/plain")
-            self.end_headers()
-            self.wfile.write("Not found".encode())
+            self.reply(404, "Not found")
 
-def main():
-    if len(sys.argv) < 4:
-        print("Usage: python3 server.py <node_name> <port> <initialization_list>")
-        #sys.exit(1)
-    
-    try:
-        node_name = sys.argv[1]
-        node_port = int(sys.argv[2])
-        initialization_list = sys.argv[3].split(',')
-        if not initialization_list or len(initialization_list) < 1:
-            print("Initialization list must have at least one element.")
-            #sys.exit(1)
-    except Exception as e:
-        print(f"no args")
-    
+class ReusePortHTTPServer(ThreadingHTTPServer):
+    """Listener that several worker processes bind at once; the kernel spreads connections between them."""
 
-    def run_server(port, node_instance):
-        httpd = HTTPServer(("localhost", port), lambda *args, **kwargs: ServerHandler(*args, node_instance=node_instance, **kwargs))
-        httpd.serve_forever()
-    
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.server_address)  # Left behind by a worker that died
+        super().server_bind()
+
+
+def make_server(node_instance, host=None, port=None, reuse_port=False):
+    server_class = ReusePortHTTPServer if reuse_port else ThreadingHTTPServer
+    return server_class((host or node_instance.node_name, port or node_instance.node_port),
+                        lambda *args, **kwargs: ServerHandler(*args, node_instance=node_instance, **kwargs))
+
+
+def make_unix_server(node_instance, path):
+    return UnixHTTPServer(path, lambda *args, **kwargs: ServerHandler(*args, node_instance=node_instance, **kwargs))
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="server", description="Chord DHT node")
+
+    parser.add_argument("node_name", type=str,
+            help="host name the node binds to and is addressed by")
+    parser.add_argument("node_port", type=int,
+            help="port the node listens on")
+    parser.add_argument("initialization_list", type=str, nargs="?", default=None,
+            help="comma separated addresses (host:port) of the initial ring, including this node (default: only this node)")
+    parser.add_argument("--membership", type=str, default=None,
+            help="file listing the addresses of the initial ring, one per line or comma separated, with # comments; "
+                 "replaces the initialization list, and this node is added if missing")
+    parser.add_argument("--lifetime", type=float, default=600,
+            help="seconds before the node shuts itself down, 0 to run until killed (default 600)")
+    parser.add_argument("--stabilize-delay", type=float, default=1,
+            help="seconds to wait before the first stabilization round, so the initial ring can start up (default 1)")
+    parser.add_argument("--probe-interval", type=float, default=1,
+            help="seconds between failure-detection probes while the ring is changing (default 1)")
+    parser.add_argument("--probe-max-interval", type=float, default=8,
+            help="seconds between probes that a stable ring backs off to (default 8)")
+    parser.add_argument("--maintenance-cpu", type=float, default=0.05,
+            help="CPU budget of background maintenance, as a fraction of one core, 0 for no limit (default 0.05)")
+    parser.add_argument("--maintenance-messages", type=float, default=50,
+            help="message budget of background maintenance, per second, 0 for no limit (default 50)")
+    parser.add_argument("--hash", type=str, default="sha1", choices=HASHES,
+            help="hash giving the ring ids of keys and nodes; blake2b is faster on short keys, and every node of a ring must use the same (default sha1)")
+    parser.add_argument("--compression", type=str, default=None, choices=sorted(CODECS),
+            help="compress stored values with zlib (deflate) or lzma (xz); values are passed between nodes compressed (default: off)")
+    parser.add_argument("--compress-min-size", type=int, default=1024,
+            help="only compress values of at least this many characters (default 1024)")
+    parser.add_argument("--store", type=str, default="dict", choices=["dict", "compact"],
+            help="dict keeps values as Python strings; compact packs them into one arena, a fraction of the memory for small values (default dict)")
+    parser.add_argument("--public-port", type=int, default=None,
+            help="also serve clients on this port, shared with the other workers on the host through SO_REUSEPORT")
+    parser.add_argument("--faults", type=str, default=None,
+            help="JSON scenario of latency, loss, resets, bandwidth caps and partitions to inject into requests to peers (see faults.py)")
+    parser.add_argument("--faults-start", type=float, default=None,
+            help="Unix time the scenario's clock starts from, so several nodes follow one timeline (default: when the node starts)")
+    parser.add_argument("--unix-socket-dir", type=str, default=None,
+            help="listen for co-located peers on a Unix socket in this directory, and reach peers that have one there the same way")
+
+    return parser
+
+
+def read_membership(path):
+    """Addresses listed in a membership file, in file order and without duplicates."""
+    addresses = {}
+    with open(path) as f:
+        for line in f:
+            for address in line.split("#", 1)[0].replace(",", " ").split():
+                addresses[address] = None
+    return list(addresses)
+
+
+def main():
+    started = time.perf_counter()
+    args = arg_parser().parse_args()
+    node_address = f"{args.node_name}:{args.node_port}"
+    if args.membership:
+        initialization_list = read_membership(args.membership)
+        if node_address not in initialization_list:
+            initialization_list.append(node_address)
+    else:
+        initialization_list = args.initialization_list.split(",") if args.initialization_list else [node_address]
 
     def run_app():
-        # start local server
-        if False:
-            node_instance1 = Node("localhost", 65123, ["localhost:65123", "localhost:65124", "localhost:65125"])
-            node_instance2 = Node("localhost", 65124, ["localhost:65123", "localhost:65124", "localhost:65125"])
-            node_instance3 = Node("localhost", 65125, ["localhost:65123", "localhost:65124", "localhost:65125"])
-            node_instance0 = Node("localhost", 65126, ["localhost:65126"])
-            threading.Thread(target=run_server, args=(65123, node_instance1)).start()
-            threading.Thread(target=node_instance1.periodic_stabilize, daemon=True).start()
-            print("started 1")
-            threading.Thread(target=run_server, args=(65124, node_instance2)).start()
-            threading.Thread(target=node_instance2.periodic_stabilize, daemon=True).start()
-            print("started 2")
-            threading.Thread(target=run_server, args=(65125, node_instance3)).start()
-            threading.Thread(target=node_instance3.periodic_stabilize, daemon=True).start()
-            print("started 3")
-            threading.Thread(target=run_server, args=(65126, node_instance0)).start()
-            threading.Thread(target=node_instance0.periodic_stabilize, daemon=True).start()
-            print("started Lonely")
-        if True:
-            node_instance = Node(node_name, node_port, initialization_list) 
-            threading.Thread(target=node_instance.periodic_stabilize, daemon=False).start()
-            httpd = HTTPServer((node_name, node_port), lambda *args, **kwargs: ServerHandler(*args, node_instance=node_instance, **kwargs))
-            httpd.serve_forever()
+        node_instance = Node(args.node_name, args.node_port, initialization_list, hash_name=args.hash)
+        node_instance.stabilization_delay = args.stabilize_delay
+        node_instance.stabilization_period = args.probe_interval
+        node_instance.stabilization_max_period = args.probe_max_interval
+        node_instance.scheduler.cpu_budget = args.maintenance_cpu
+        node_instance.scheduler.message_budget = args.maintenance_messages
+        node_instance.codec.encoding = args.compression
+        node_instance.codec.min_size = args.compress_min_size
+        if args.store == "compact":
+            node_instance.key_val = CompactStore(MerkleTree(node_instance.M))
+        if args.unix_socket_dir:
+            node_instance.transport.socket_dir = args.unix_socket_dir
+        if args.faults:
+            scenario = Scenario.load(args.faults, args.faults_start, node_instance.injected_faults, source=node_address)
+            node_instance.transport = node_instance.membership.transport = FaultyTransport(node_instance.transport, scenario, node_address)
+        threading.Thread(target=node_instance.periodic_stabilize, daemon=False).start()
+        if args.public_port:
+            threading.Thread(target=make_server(node_instance, port=args.public_port, reuse_port=True).serve_forever, daemon=True).start()
+        if args.unix_socket_dir:
+            path = unix_socket_path(args.unix_socket_dir, node_address)
+            threading.Thread(target=make_unix_server(node_instance, path).serve_forever, daemon=True).start()
+        httpd = make_server(node_instance)
+        node_instance.startup_seconds = time.perf_counter() - started
+        httpd.serve_forever()
 
     threading.Thread(target=run_app).start()
-    threading.Timer(600, lambda: os._exit(0)).start()  # Shutdown after 10 minutes
+    if args.lifetime:
+        threading.Timer(args.lifetime, lambda: os._exit(0)).start()  # Shutdown after the lifetime, 10 minutes by default
 
 if __name__ == '__main__':
     main()
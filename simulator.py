@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+
+import argparse
+import bisect
+import heapq
+import json
+import math
+import random
+import sys
+import time
+import uuid
+from collections import Counter
+from urllib.parse import parse_qs
+
+from compression import Compressed
+from server import HASHES, Node, Trace, ring_hash
+from stats import percentiles
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="simulator", description="Simulate a large Chord ring in one process under a virtual clock")
+
+    parser.add_argument("--nodes", type=int, default=10000,
+            help="number of nodes in the ring (default 10000)")
+    parser.add_argument("--bits", type=int, default=32,
+            help="ring id size M in bits (default 32)")
+    parser.add_argument("--hash", type=str, default="sha1", choices=HASHES,
+            help="hash giving the ring ids of keys and nodes (default sha1)")
+    parser.add_argument("--duration", type=float, default=10,
+            help="virtual seconds to simulate (default 10)")
+    parser.add_argument("--lookup-rate", type=float, default=500,
+            help="lookups per virtual second; each writes a fresh key and reads it back (default 500)")
+    parser.add_argument("--latency", type=float, default=5,
+            help="mean one-way message latency in ms (default 5)")
+    parser.add_argument("--jitter", type=float, default=2,
+            help="standard deviation of the one-way latency in ms (default 2)")
+    parser.add_argument("--loss", type=float, default=0.0,
+            help="probability that a request is lost and times out (default 0)")
+    parser.add_argument("--timeout", type=float, default=1.0,
+            help="virtual seconds a lost request takes to time out (default 1)")
+    parser.add_argument("--crash-rate", type=float, default=0.0,
+            help="node crashes per virtual second (default 0)")
+    parser.add_argument("--recover-after", type=float, default=None,
+            help="virtual seconds after which a crashed node recovers through /sim-recover (default never)")
+    parser.add_argument("--stabilize-period", type=float, default=0.0,
+            help="virtual seconds between stabilization ticks of each node while the ring changes, 0 disables stabilization (default 0)")
+    parser.add_argument("--stabilize-max-period", type=float, default=None,
+            help="virtual seconds between stabilization ticks that a stable ring backs off to (default 8 times --stabilize-period)")
+    parser.add_argument("--check-nodes", type=int, default=2000,
+            help="live nodes sampled when checking routing tables against the ideal ring (default 2000)")
+    parser.add_argument("--seed", type=int, default=None,
+            help="random seed for the topology and the event schedule")
+    parser.add_argument("--output", type=str, default=None,
+            help="write the JSON report to this file instead of stdout")
+
+    return parser
+
+
+def route_of(url):
+    path = url.split("?")[0]
+    return "/storage" if path.startswith("/storage/") else path
+
+
+class SimNetwork:
+    """In-memory network between simulated nodes, with latency, loss and a virtual clock.
+
+    Requests are delivered synchronously, so a lookup's virtual latency is the
+    sum of the round trips along its path. Every event runs from its own
+    scheduled time, which lets events overlap in virtual time without sharing
+    a queue. A request nested deeper than `max_depth` (a routing loop) times
+    out, as it would against the forward timeout of a real node.
+    """
+
+    def __init__(self, latency=0.005, jitter=0.002, loss=0.0, timeout=1.0, rng=None, max_depth=100):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.timeout = timeout
+        self.rng = rng or random.Random()
+        self.max_depth = max_depth
+        self.depth = 0
+        self.now = 0.0
+        self.nodes = {}
+        self.messages = Counter()
+        self.shared_metrics = None
+
+    def one_way(self):
+        return max(0.0, self.rng.gauss(self.latency, self.jitter))
+
+    def request(self, address, method, url, body=None, headers=None):
+        self.messages[(method, route_of(url))] += 1
+        if (self.loss and self.rng.random() < self.loss) or self.depth >= self.max_depth:
+            self.now += self.timeout
+            raise TimeoutError(f"Request to {address} timed out")
+        node = self.nodes.get(address)
+        if node is None:
+            self.now += self.one_way()
+            raise ConnectionRefusedError(f"No node at {address}")
+        self.now += self.one_way()
+        self.depth += 1
+        try:
+            response = dispatch(node, method, url, body, headers or {})
+        finally:
+            self.depth -= 1
+        self.now += self.one_way()
+        return response
+
+
+class SimTransport:
+    """Transport of one simulated node, same interface as transport.HttpTransport."""
+
+    def __init__(self, network):
+        self.network = network
+
+    def request(self, address, method, url, body=None, headers=None, timeout=None):
+        return self.network.request(address, method, url, body, headers)
+
+
+def run_coroutine(coro):
+    # Node coroutines never await anything real, so one send runs them to completion without an event loop
+    try:
+        coro.send(None)
+    except StopIteration as stop:
+        return stop.value
+    raise RuntimeError("Simulated coroutine suspended")
+
+
+def dispatch(node, method, url, body, headers):
+    """Answer a request the way ServerHandler would, for the routes nodes send to each other."""
+    path = url.split("?")[0]
+    if node.crashed and path != "/sim-recover":
+        return 500, "Node has crashed", {}
+    try:
+        if path.startswith("/storage/"):
+            key = path[len("/storage/"):]
+            hops = int(headers.get("X-Chord-Hops", 0))
+            key_id = int(headers["X-Chord-Key-Id"]) if hops and "X-Chord-Key-Id" in headers else None
+            trace = Trace(headers["X-Chord-Trace"]) if "X-Chord-Trace" in headers else None
+            if "X-Chord-Gossip" in headers:
+                node.membership.receive(json.loads(headers["X-Chord-Gossip"]))
+            if method == "GET":
+                response, status = node.get_value(key, hops, trace, key_id)
+            else:
+                value = Compressed(headers["Content-Encoding"], body) if "Content-Encoding" in headers else body
+                response, status = node.put_value(key, value, hops, trace, key_id)
+            response_headers = {"X-Chord-Trace-Hops": json.dumps(trace)} if trace else {}
+            return status, response, response_headers
+        if method == "GET" and path == "/node-info":
+            return 200, json.dumps(node.node_info()), {}
+        if method == "GET" and path == "/network":
+            return 200, json.dumps({"successor": node.succ, "predecessor": node.pred, "finger_table": node.finger_table}), {}
+        if method == "GET" and path == "/predecessor":
+            return 200, node.pred, {}
+        if method == "GET" and path == "/successor":
+            return 200, node.succ, {}
+        if method == "GET" and path.startswith("/merkle"):
+            response, status = node.merkle_query(path, parse_qs(url.partition("?")[2]))
+            return status, response, {}
+        if method == "PUT" and path == "/gossip/ping":
+            return 200, node.membership.handle_ping(body), {}
+        if method == "PUT" and path == "/gossip/ping-req":
+            return 200, node.membership.handle_ping_req(body), {}
+        if method == "PUT" and path == "/API/join":
+            return 200, run_coroutine(node.network_accept(body)), {}
+        if method == "PUT" and path == "/sim-recover":
+            response, status = node.recover()
+            return status, response, {}
+    except Exception as e:
+        return 500, str(e), {}
+    return 404, "Not found", {}
+
+
+class SimNode(Node):
+    def __init__(self, network, address, M, hash_name="sha1"):
+        self.network = network
+        node_name, node_port = address.split(":")
+        super().__init__(node_name, int(node_port), [address], M=M, transport=SimTransport(network), clock=lambda: network.now, hash_name=hash_name)
+        self.scheduler.cpu_budget = None  # CPU time is real while the clock is virtual, so only the message budget applies
+        self.scheduler.rng = random.Random(address)  # Reproducible jitter that leaves the event schedule alone
+        self.membership.parallel = False  # The simulated network runs one message at a time on the virtual clock
+
+    def setup_metrics(self):
+        # One set of metrics serves every simulated node; a registry per node would dominate memory at 100k nodes
+        if self.network.shared_metrics is None:
+            before = set(vars(self))
+            Node.setup_metrics(self)
+            self.network.shared_metrics = {name: value for name, value in vars(self).items() if name not in before}
+        vars(self).update(self.network.shared_metrics)
+
+
+class IdealRing:
+    """Sorted ids of the live nodes, the reference routing tables are checked against."""
+
+    def __init__(self, nodes, M):
+        self.M = M
+        pairs = sorted((node.node_id, address) for address, node in nodes.items() if not node.crashed)
+        self.ids = [node_id for node_id, _ in pairs]
+        self.addresses = [address for _, address in pairs]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def successor(self, ring_id):
+        """Owner of `ring_id`: the first live node at or after it."""
+        return self.addresses[bisect.bisect_left(self.ids, ring_id) % len(self.ids)]
+
+    def neighbours(self, node_id):
+        index = bisect.bisect_left(self.ids, node_id)
+        return self.addresses[(index + 1) % len(self.ids)], self.addresses[index - 1]
+
+    def fingers(self, node_id):
+        return [self.successor((node_id + 2 ** i) % 2 ** self.M) for i in range(self.M)]
+
+    def add(self, node_id, address):
+        index = bisect.bisect_left(self.ids, node_id)
+        self.ids.insert(index, node_id)
+        self.addresses.insert(index, address)
+
+    def remove(self, node_id):
+        index = bisect.bisect_left(self.ids, node_id)
+        del self.ids[index]
+        del self.addresses[index]
+
+
+class Simulation:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.network = SimNetwork(args.latency / 1000, args.jitter / 1000, args.loss, args.timeout, self.rng)
+        self.events = []  # heap of (time, sequence, kind, address)
+        self.sequence = 0
+        self.hops = []
+        self.lookups = Counter()
+        self.lookup_latency = []
+        self.injected = Counter()
+
+    def build(self):
+        """Create the nodes and hand each one the routing state of a converged ring."""
+        ids = set()
+        while len(self.network.nodes) < self.args.nodes:
+            address = f"node{len(ids)}-{self.rng.randrange(1 << 30)}:5000"
+            node_id = ring_hash(address, self.args.bits, self.args.hash)
+            if node_id not in ids:
+                ids.add(node_id)
+                self.network.nodes[address] = SimNode(self.network, address, self.args.bits, self.args.hash)
+        self.ring = IdealRing(self.network.nodes, self.args.bits)
+        for node in self.network.nodes.values():
+            node.succ, node.pred = self.ring.neighbours(node.node_id)
+            node.finger_table = self.ring.fingers(node.node_id)
+            if self.args.stabilize_period > 0:
+                node.stabilization_delay = 0
+                node.stabilization_period = self.args.stabilize_period
+                node.stabilization_max_period = self.args.stabilize_max_period or 8 * self.args.stabilize_period
+                node.schedule_maintenance()
+
+    def schedule(self, at, kind, address=None):
+        if at <= self.args.duration:
+            heapq.heappush(self.events, (at, self.sequence, kind, address))
+            self.sequence += 1
+
+    def schedule_arrivals(self, kind, rate):
+        if rate <= 0:
+            return
+        at = self.rng.expovariate(rate)
+        while at <= self.args.duration:
+            self.schedule(at, kind)
+            at += self.rng.expovariate(rate)
+
+    def live_address(self):
+        return self.ring.addresses[self.rng.randrange(len(self.ring))]
+
+    def lookup(self):
+        key, value = uuid.uuid4().hex, uuid.uuid4().hex
+        started = self.network.now
+        node = self.network.nodes[self.live_address()]
+        put_trace, get_trace = Trace("sim"), Trace("sim")
+        _, put_status = node.put_value(key, value, 0, put_trace)
+        response, get_status = self.network.nodes[self.live_address()].get_value(key, 0, get_trace)
+        for trace in (put_trace, get_trace):
+            self.hops.append(sum(1 for hop in trace if hop["decision"].startswith("forward")))
+        self.lookups["total"] += 1
+        self.lookups["put_ok"] += put_status == 200
+        self.lookups["get_ok"] += get_status == 200 and response == value
+        owner = self.network.nodes[self.ring.successor(ring_hash(key, self.args.bits, self.args.hash))]
+        self.lookups["owner_correct"] += key in owner.key_val
+        self.lookup_latency.append(self.network.now - started)
+
+    def crash(self):
+        if len(self.ring) <= 1:
+            return
+        address = self.live_address()
+        node = self.network.nodes[address]
+        node.crashed = True
+        self.ring.remove(node.node_id)
+        self.injected["crash"] += 1
+        if self.args.recover_after is not None:
+            self.schedule(self.network.now + self.args.recover_after, "recover", address)
+
+    def recover(self, address):
+        node = self.network.nodes[address]
+        node.recover()
+        self.ring.add(node.node_id, address)
+        self.injected["recover"] += 1
+
+    def stabilize(self, address):
+        """Run the node's due background tasks, then check back when the next is due or within one base period,
+        whichever is sooner, since churn seen by other events can pull tasks forward."""
+        node = self.network.nodes[address]
+        due = None if node.crashed else node.scheduler.run_pending()
+        at = self.network.now + self.args.stabilize_period
+        self.schedule(at if due is None else min(at, due), "stabilize", address)
+
+    def run(self):
+        started = time.perf_counter()
+        self.build()
+        build_s = time.perf_counter() - started
+        self.schedule_arrivals("lookup", self.args.lookup_rate)
+        self.schedule_arrivals("crash", self.args.crash_rate)
+        if self.args.stabilize_period > 0:
+            for address in self.network.nodes:
+                self.schedule(self.rng.uniform(0, self.args.stabilize_period), "stabilize", address)
+        virtual_end = 0.0
+        while self.events:
+            at, _, kind, address = heapq.heappop(self.events)
+            self.network.now = at
+            if kind == "lookup":
+                self.lookup()
+            elif kind == "crash":
+                self.crash()
+            elif kind == "recover":
+                self.recover(address)
+            elif kind == "stabilize":
+                self.stabilize(address)
+            virtual_end = max(virtual_end, self.network.now)
+        return self.report(build_s, time.perf_counter() - started, virtual_end)
+
+    def check_routing(self):
+        """Fraction of sampled live nodes whose successor, predecessor and fingers match the ideal ring."""
+        live = self.ring.addresses
+        sample = self.rng.sample(live, min(self.args.check_nodes, len(live)))
+        succ_ok = pred_ok = fingers_ok = 0
+        for address in sample:
+            node = self.network.nodes[address]
+            succ, pred = self.ring.neighbours(node.node_id)
+            succ_ok += node.succ == succ
+            pred_ok += node.pred == pred
+            fingers_ok += sum(1 for actual, ideal in zip(node.finger_table, self.ring.fingers(node.node_id)) if actual == ideal)
+        checked = len(sample)
+        return {
+            "checked_nodes": checked,
+            "successor_correct": succ_ok / checked if checked else None,
+            "predecessor_correct": pred_ok / checked if checked else None,
+            "finger_correct": fingers_ok / (checked * self.args.bits) if checked else None,
+        }
+
+    def report(self, build_s, wall_s, virtual_s):
+        total = self.lookups["total"]
+        storage_messages = sum(count for (_, route), count in self.network.messages.items() if route == "/storage")
+        maintenance = sum(self.network.messages.values()) - storage_messages
+        log2_n = math.log2(self.args.nodes)
+        return {
+            "config": {name: value for name, value in vars(self.args).items() if name != "output"},
+            "live_nodes": len(self.ring),
+            "build_s": build_s,
+            "wall_s": wall_s,
+            "virtual_s": virtual_s,
+            "events": dict(self.injected),
+            "lookups": {
+                "count": total,
+                "put_success_rate": self.lookups["put_ok"] / total if total else None,
+                "get_success_rate": self.lookups["get_ok"] / total if total else None,
+                "owner_correct_rate": self.lookups["owner_correct"] / total if total else None,
+                "latency_ms": {p: value * 1000 for p, value in percentiles(self.lookup_latency).items()},
+            },
+            "hops": {
+                "mean": sum(self.hops) / len(self.hops) if self.hops else None,
+                **percentiles(self.hops),
+                "max": max(self.hops, default=None),
+                "log2_n": log2_n,
+                # Chord's expected path length with correct fingers
+                "expected": log2_n / 2,
+                "histogram": dict(sorted(Counter(self.hops).items())),
+            },
+            "routing": self.check_routing(),
+            "messages": {
+                "total": sum(self.network.messages.values()),
+                "by_route": {f"{method} {route}": count for (method, route), count in sorted(self.network.messages.items())},
+                "per_lookup": storage_messages / (2 * total) if total else None,
+                "maintenance_per_node_s": maintenance / self.args.nodes / virtual_s if virtual_s else None,
+            },
+        }
+
+
+def main(args):
+    report = Simulation(args).run()
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,9 @@
+import math
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Nearest-rank percentiles of `values`, keyed "p50" and so on; empty for no values."""
+    if not values:
+        return {}
+    ordered = sorted(values)
+    return {f"p{p}": ordered[max(0, math.ceil(p / 100.0 * len(ordered)) - 1)] for p in points}
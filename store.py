@@ -0,0 +1,535 @@
+import bisect
+import hashlib
+import heapq
+import itertools
+import struct
+import threading
+from array import array
+
+from compression import CODECS, Compressed
+
+
+class SortedKeyIndex:
+    """Sorted (key_id, key) index kept in bounded chunks so inserts stay cheap on large stores."""
+
+    def __init__(self, chunk_size=512):
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.maxes = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, item):
+        if not self.chunks:
+            self.chunks.append([item])
+            self.maxes.append(item)
+            self.size += 1
+            return
+        pos = bisect.bisect_left(self.maxes, item)
+        if pos == len(self.maxes):
+            pos -= 1
+        chunk = bisect.bisect_left(self.chunks[pos], item)
+        self.chunks[pos].insert(chunk, item)
+        self.maxes[pos] = self.chunks[pos][-1]
+        self.size += 1
+        if len(self.chunks[pos]) > 2 * self.chunk_size:
+            # Split oversized chunks so a single insert never moves more than 2 * chunk_size entries
+            half = self.chunks[pos][self.chunk_size:]
+            del self.chunks[pos][self.chunk_size:]
+            self.chunks.insert(pos + 1, half)
+            self.maxes[pos] = self.chunks[pos][-1]
+            self.maxes.insert(pos + 1, half[-1])
+
+    def discard(self, item):
+        pos = bisect.bisect_left(self.maxes, item)
+        if pos == len(self.maxes):
+            return
+        chunk = self.chunks[pos]
+        i = bisect.bisect_left(chunk, item)
+        if i == len(chunk) or chunk[i] != item:
+            return
+        del chunk[i]
+        self.size -= 1
+        if chunk:
+            self.maxes[pos] = chunk[-1]
+        else:
+            del self.chunks[pos]
+            del self.maxes[pos]
+
+    def iter_from(self, item, inclusive=True):
+        find = bisect.bisect_left if inclusive else bisect.bisect_right
+        pos = find(self.maxes, item)
+        if pos == len(self.maxes):
+            return
+        start = find(self.chunks[pos], item)
+        for chunk in self.chunks[pos:]:
+            for i in range(start, len(chunk)):
+                yield chunk[i]
+            start = 0
+
+
+def entry_hash(key, value):
+    # Compressed values hash as stored, so comparing replicas never decompresses them
+    data = value.encode() if isinstance(value, str) else value.encoding.encode() + b"\0" + value.data
+    return int.from_bytes(hashlib.blake2b(key.encode() + b"\0" + data, digest_size=8).digest(), "big")
+
+
+class MerkleTree:
+    """Hash tree over the key-id space, updated on every write.
+
+    Level d splits the M-bit id space into 2^d equal buckets and the leaves sit
+    at level `depth`. A bucket's digest is the XOR of the entry hashes of its
+    keys, so a write changes one leaf and its ancestors in O(depth), and two
+    stores holding the same entries in a bucket have the same digest there.
+    Zero digests are not stored, so an empty store costs nothing.
+    """
+
+    def __init__(self, M, depth=12):
+        self.M = M
+        self.depth = min(depth, M)
+        self.levels = [{} for _ in range(self.depth + 1)]
+
+    def leaf(self, key_id):
+        return key_id >> (self.M - self.depth)
+
+    def bucket_range(self, level, index):
+        """First and last key id covered by bucket `index` of `level`."""
+        shift = self.M - level
+        return index << shift, ((index + 1) << shift) - 1
+
+    def update(self, key_id, delta):
+        leaf = self.leaf(key_id)
+        for level in range(self.depth, -1, -1):
+            digests = self.levels[level]
+            index = leaf >> (self.depth - level)
+            digest = digests.get(index, 0) ^ delta
+            if digest:
+                digests[index] = digest
+            else:
+                del digests[index]
+
+    def digest(self, level, index):
+        return self.levels[level].get(index, 0)
+
+
+class KeyValueStore:
+    """Local key/value store with an ordered index over (key id, key) for range scans.
+
+    With a `merkle` tree every write also updates the tree, so replicas of a key
+    range can be compared bucket by bucket.
+    """
+
+    def __init__(self, merkle=None):
+        self.values = {}
+        self.index = SortedKeyIndex()
+        self.merkle = merkle
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, key):
+        return key in self.values
+
+    def get(self, key, default=None):
+        return self.values.get(key, default)
+
+    def items(self):
+        return self.values.items()
+
+    def delete(self, key, key_id):
+        with self.lock:
+            old = self.values.pop(key, None)
+            if old is None:
+                return False
+            self.index.discard((key_id, key))
+            if self.merkle is not None:
+                self.merkle.update(key_id, entry_hash(key, old))
+            return True
+
+    def put(self, key, key_id, value):
+        with self.lock:
+            old = self.values.get(key)
+            if old is None:
+                self.index.add((key_id, key))
+            self.values[key] = value
+            if self.merkle is not None:
+                delta = entry_hash(key, value) ^ (entry_hash(key, old) if old is not None else 0)
+                if delta:
+                    self.merkle.update(key_id, delta)
+
+    def tidy(self):
+        """Background maintenance; replaced values are freed as they go, so there is nothing to do."""
+
+    def bucket_hashes(self, first, last):
+        """Entry hash of every key whose id lies in [first, last]."""
+        with self.lock:
+            hashes = {}
+            for key_id, key in self.index.iter_from((first, "")):
+                if key_id > last:
+                    break
+                hashes[key] = entry_hash(key, self.values[key])
+            return hashes
+
+    def scan(self, start=0, limit=100, cursor=None):
+        """Return up to `limit` (key_id, key, value) entries ordered by key id, and the cursor to resume from."""
+        with self.lock:
+            if cursor is not None:
+                entries = self.index.iter_from(cursor, inclusive=False)
+            else:
+                entries = self.index.iter_from((start, ""))
+            page = []
+            for key_id, key in entries:
+                if len(page) == limit:
+                    return page, (page[-1][0], page[-1][1])
+                page.append((key_id, key, self.values[key]))
+            return page, None
+
+
+# Entry header in the CompactStore arena: key id, key length, value length, value encoding
+ENTRY = struct.Struct("<QHIB")
+VALUE_ENCODINGS = (None,) + tuple(CODECS)
+EMPTY, TOMBSTONE = -1, -2
+
+
+class CompactStore:
+    """Key/value store that packs entries into one bytearray arena, for millions of small values.
+
+    Each entry is an ENTRY header followed by the UTF-8 key and the value bytes
+    (compressed values keep their encoding in the header). An open-addressing
+    table with linear probing maps keys to entry offsets: `slots` holds the
+    offset, EMPTY, or TOMBSTONE for a deleted key, and `tags` the low 32 bits of
+    the key's string hash, which pick the first slot and skip most mismatches
+    without reading the arena. Ring ids are not used for probing because at the
+    default M=10 there are only 1024 of them. Key ids must fit in 64 bits, so M
+    can be at most 64.
+
+    A value that fits in its old entry is overwritten in place; otherwise a new
+    entry is appended and the old one becomes garbage. Once garbage is over
+    `compact_ratio` of the arena, live entries are slid down over it in place.
+    The table grows or drops its tombstones once more than `max_load` of the
+    slots are taken.
+
+    Scans read a key-id order of (key id, key) pairs, kept apart from the table
+    so that rehashing and compaction leave it valid. It is built from a copy of
+    the arena and sorted outside the lock, so gets and puts carry on meanwhile.
+    Keys added after it was built go into a SortedKeyIndex that scans merge in,
+    and deleted keys are skipped. Once those changes pass `order_slack` of the
+    store, the order is dropped and the next scan builds it again.
+    """
+
+    def __init__(self, merkle=None, capacity=1024, max_load=0.7, compact_ratio=0.5, compact_min=1 << 16, order_slack=0.125, order_min=4096):
+        if merkle is not None and merkle.M > 64:
+            raise ValueError(f"CompactStore keeps 64-bit key ids, so it cannot hold ids of M={merkle.M} bits")
+        self.arena = bytearray()
+        self.slots = array("q", [EMPTY]) * capacity
+        self.tags = array("I", [0]) * capacity
+        self.count = 0
+        self.tombstones = 0
+        self.garbage = 0
+        self.max_load = max_load
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.order_slack = order_slack
+        self.order_min = order_min
+        self.order_ids = None  # Key ids of the ordered entries, sorted by (key id, key)
+        self.order_keys = None  # Their UTF-8 keys, one after another
+        self.order_ends = None  # Where each key ends in order_keys
+        self.added = None  # (key id, key) of the keys added since the order was copied, while one is kept
+        self.removed = 0  # Keys deleted since the order was copied
+        self.merkle = merkle
+        self.lock = threading.Lock()
+        self.order_lock = threading.Lock()  # One order build at a time
+        self.sort_run = 8192  # Entries sorted at a time while building the order
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, key):
+        return self.find(key, key.encode())[1] >= 0
+
+    def find(self, key, key_bytes):
+        """Return (slot the key is in or should go to, its entry offset or EMPTY, its tag)."""
+        tag = hash(key) & 0xFFFFFFFF
+        mask = len(self.slots) - 1
+        i = tag & mask
+        free = -1
+        while True:
+            offset = self.slots[i]
+            if offset == EMPTY:
+                return (i if free < 0 else free), EMPTY, tag
+            if offset == TOMBSTONE:
+                if free < 0:
+                    free = i
+            elif self.tags[i] == tag:
+                start = offset + ENTRY.size
+                if self.arena[start:start + ENTRY.unpack_from(self.arena, offset)[1]] == key_bytes:
+                    return i, offset, tag
+            i = (i + 1) & mask
+
+    def entry_size(self, offset):
+        _, key_length, value_length, _ = ENTRY.unpack_from(self.arena, offset)
+        return ENTRY.size + key_length + value_length
+
+    def read(self, offset):
+        """Return the (key id, key, value) of the entry at `offset`."""
+        key_id, key_length, value_length, encoding = ENTRY.unpack_from(self.arena, offset)
+        start = offset + ENTRY.size
+        key = self.arena[start:start + key_length].decode()
+        data = bytes(self.arena[start + key_length:start + key_length + value_length])
+        return key_id, key, data.decode() if encoding == 0 else Compressed(VALUE_ENCODINGS[encoding], data)
+
+    def get(self, key, default=None):
+        with self.lock:
+            offset = self.find(key, key.encode())[1]
+            return self.read(offset)[2] if offset >= 0 else default
+
+    def items(self):
+        with self.lock:
+            entries = [self.read(offset)[1:] for offset in self.slots if offset >= 0]
+        return iter(entries)
+
+    def put(self, key, key_id, value):
+        key_bytes = key.encode()
+        if isinstance(value, Compressed):
+            encoding, data = VALUE_ENCODINGS.index(value.encoding), value.data
+        else:
+            encoding, data = 0, value.encode()
+        with self.lock:
+            slot, offset, tag = self.find(key, key_bytes)
+            old = None
+            if offset >= 0:
+                old = self.read(offset)[2]
+                _, key_length, value_length, _ = ENTRY.unpack_from(self.arena, offset)
+                if len(data) <= value_length:
+                    ENTRY.pack_into(self.arena, offset, key_id, key_length, len(data), encoding)
+                    start = offset + ENTRY.size + key_length
+                    self.arena[start:start + len(data)] = data
+                    self.garbage += value_length - len(data)
+                    self.update_merkle(key, key_id, value, old)
+                    return
+                self.garbage += ENTRY.size + key_length + value_length
+            else:
+                if self.slots[slot] == TOMBSTONE:
+                    self.tombstones -= 1
+                self.count += 1
+                if self.added is not None:
+                    self.added.add((key_id, key))
+                    self.order_changed()
+            self.slots[slot] = len(self.arena)
+            self.tags[slot] = tag
+            self.arena += ENTRY.pack(key_id, len(key_bytes), len(data), encoding)
+            self.arena += key_bytes
+            self.arena += data
+            self.update_merkle(key, key_id, value, old)
+            self.maintain()
+
+    def delete(self, key, key_id):
+        with self.lock:
+            slot, offset, _ = self.find(key, key.encode())
+            if offset < 0:
+                return False
+            old = self.read(offset)[2]
+            self.garbage += self.entry_size(offset)
+            self.slots[slot] = TOMBSTONE
+            self.tombstones += 1
+            self.count -= 1
+            if self.added is not None:
+                self.added.discard((key_id, key))
+                self.removed += 1
+                self.order_changed()
+            self.update_merkle(key, key_id, None, old)
+            self.maintain()
+            return True
+
+    def update_merkle(self, key, key_id, value, old):
+        if self.merkle is None:
+            return
+        delta = (entry_hash(key, value) if value is not None else 0) ^ (entry_hash(key, old) if old is not None else 0)
+        if delta:
+            self.merkle.update(key_id, delta)
+
+    def maintain(self):
+        if self.count + self.tombstones > self.max_load * len(self.slots):
+            # Mostly tombstones: rehash at the same size to drop them, else double
+            grow = self.count > self.max_load / 2 * len(self.slots)
+            self.rehash(len(self.slots) * 2 if grow else len(self.slots))
+        if self.garbage > self.compact_min and self.garbage > self.compact_ratio * len(self.arena):
+            self.compact()
+
+    def tidy(self):
+        """Background maintenance: compact once garbage passes half of `compact_ratio`, before a put has to."""
+        with self.lock:
+            if self.garbage > self.compact_min and self.garbage > self.compact_ratio / 2 * len(self.arena):
+                self.compact()
+
+    def rehash(self, capacity):
+        slots = array("q", [EMPTY]) * capacity
+        tags = array("I", [0]) * capacity
+        mask = capacity - 1
+        for offset, tag in zip(self.slots, self.tags):
+            if offset < 0:
+                continue
+            i = tag & mask
+            while slots[i] != EMPTY:
+                i = (i + 1) & mask
+            slots[i] = offset
+            tags[i] = tag
+        self.slots, self.tags = slots, tags
+        self.tombstones = 0
+
+    def compact(self):
+        """Slide live entries down over the garbage, in arena order, and trim the arena. Call with the lock held."""
+        write = 0
+        for slot in sorted((slot for slot, offset in enumerate(self.slots) if offset >= 0), key=self.slots.__getitem__):
+            offset = self.slots[slot]
+            size = self.entry_size(offset)
+            if offset != write:
+                self.arena[write:write + size] = self.arena[offset:offset + size]
+                self.slots[slot] = write
+            write += size
+        del self.arena[write:]
+        self.garbage = 0
+
+    def order_changed(self):
+        # Past the slack a new sort costs less than merging, and the index of added keys would keep growing
+        if self.order_ids is not None and len(self.added) + self.removed > max(self.order_min, self.order_slack * self.count):
+            self.order_ids = self.order_keys = self.order_ends = self.added = None
+            self.removed = 0
+
+    def build_order(self):
+        """Make sure there is a key-id order, copying the entries under the lock but sorting them outside it."""
+        with self.order_lock:
+            with self.lock:
+                if self.order_ids is not None:
+                    return
+                arena, slots = bytes(self.arena), array("q", self.slots)
+                self.added, self.removed = SortedKeyIndex(), 0
+            entries = []
+            for offset in slots:
+                if offset >= 0:
+                    key_id, key_length, _, _ = ENTRY.unpack_from(arena, offset)
+                    start = offset + ENTRY.size
+                    entries.append(key_id.to_bytes(8, "big") + arena[start:start + key_length])
+            del arena, slots
+            # Big-endian ids and UTF-8 keys, which sort in code point order, compare as bytes in (key id, key) order.
+            # A sort holds the GIL until it is done, so sort runs of entries and merge them, letting other threads in between.
+            runs = [sorted(entries[i:i + self.sort_run]) for i in range(0, len(entries), self.sort_run)]
+            del entries
+            merged = list(heapq.merge(*runs))
+            del runs
+            ids = array("Q", [int.from_bytes(entry[:8], "big") for entry in merged])
+            ends = array("Q", itertools.accumulate(len(entry) - 8 for entry in merged))
+            keys = b"".join(entry[8:] for entry in merged)
+            with self.lock:
+                self.order_ids, self.order_keys, self.order_ends = ids, keys, ends
+
+    def lock_order(self):
+        """Take the lock with a key-id order in place, building one first if there is none."""
+        while True:
+            self.build_order()
+            self.lock.acquire()
+            if self.order_ids is not None:
+                return
+            # A burst of writes dropped the new order before we got the lock
+            self.lock.release()
+
+    def ordered(self, start, cursor=None):
+        """Yield the live (key id, key, value) entries from key id `start`, or after `cursor`, in order. Call from lock_order."""
+        ids, keys, ends = self.order_ids, self.order_keys, self.order_ends
+        position = bisect.bisect_left(ids, cursor[0] if cursor is not None else start)
+        copied = ((ids[i], keys[ends[i - 1] if i else 0:ends[i]].decode()) for i in range(position, len(ids)))
+        added = self.added.iter_from(cursor, inclusive=False) if cursor is not None else self.added.iter_from((start, ""))
+        previous = None
+        for key_id, key in heapq.merge(copied, added):
+            # A key deleted and added again since the copy comes from both
+            if (key_id, key) == previous or (cursor is not None and (key_id, key) <= cursor):
+                continue
+            previous = key_id, key
+            offset = self.find(key, key.encode())[1]
+            if offset >= 0:
+                yield key_id, key, self.read(offset)[2]
+
+    def scan(self, start=0, limit=100, cursor=None):
+        """Return up to `limit` (key_id, key, value) entries ordered by key id, and the cursor to resume from."""
+        self.lock_order()
+        try:
+            page = []
+            for entry in self.ordered(start, cursor):
+                if len(page) == limit:
+                    return page, (page[-1][0], page[-1][1])
+                page.append(entry)
+            return page, None
+        finally:
+            self.lock.release()
+
+    def bucket_hashes(self, first, last):
+        """Entry hash of every key whose id lies in [first, last]."""
+        self.lock_order()
+        try:
+            hashes = {}
+            for key_id, key, value in self.ordered(first):
+                if key_id > last:
+                    break
+                hashes[key] = entry_hash(key, value)
+            return hashes
+        finally:
+            self.lock.release()
+
+def encode_cursor(cursor):
+    if cursor is None:
+        return None
+    return f"{cursor[0]}:{cursor[1]}"
+
+
+def decode_cursor(text):
+    key_id, key = text.split(":", 1)
+    return int(key_id), key
+
+
+# Record in a binary dump: key length, value length, value encoding, then the UTF-8 key and the value bytes
+RECORD = struct.Struct("<HIB")
+DUMP_MAGIC = b"CHORDDUMP1\n"
+
+
+def pack_record(key, value):
+    key_bytes = key.encode()
+    if isinstance(value, Compressed):
+        encoding, data = VALUE_ENCODINGS.index(value.encoding), value.data
+    else:
+        encoding, data = 0, value.encode()
+    return RECORD.pack(len(key_bytes), len(data), encoding) + key_bytes + data
+
+
+def read_record(stream):
+    """The next (key, value) of a binary dump, compressed values left compressed, or None at the end."""
+    header = stream.read(RECORD.size)
+    if not header:
+        return None
+    if len(header) < RECORD.size:
+        raise ValueError("Truncated dump record")
+    key_size, value_size, encoding = RECORD.unpack(header)
+    body = stream.read(key_size + value_size)
+    if len(body) < key_size + value_size:
+        raise ValueError("Truncated dump record")
+    if encoding >= len(VALUE_ENCODINGS):
+        raise ValueError(f"Unknown value encoding {encoding}")
+    key, data = body[:key_size].decode(), body[key_size:]
+    return key, Compressed(VALUE_ENCODINGS[encoding], data) if encoding else data.decode()
+
+
+def complete_records(buffer, binary):
+    """(bytes of whole records at the start of `buffer`, how many records that is)."""
+    if not binary:
+        end = buffer.rfind(b"\n") + 1
+        return end, buffer.count(b"\n", 0, end)
+    offset = count = 0
+    while offset + RECORD.size <= len(buffer):
+        key_size, value_size, _ = RECORD.unpack_from(buffer, offset)
+        end = offset + RECORD.size + key_size + value_size
+        if end > len(buffer):
+            break
+        offset, count = end, count + 1
+    return offset, count
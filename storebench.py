@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import argparse
+import gc
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from server import ring_hash
+from store import CompactStore, KeyValueStore, MerkleTree
+
+STORES = {
+    "dict": KeyValueStore,
+    "compact": CompactStore,
+}
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="storebench", description="Compare the memory and speed of the node stores on small entries")
+
+    parser.add_argument("--entries", type=int, default=1000000,
+            help="entries stored in each store (default 1000000)")
+    parser.add_argument("--key-size", type=int, default=24,
+            help="characters per key (default 24)")
+    parser.add_argument("--value-size", type=str, default="8,64",
+            help="value length in characters, or a min,max range drawn uniformly (default 8,64)")
+    parser.add_argument("--stores", type=str, default=",".join(STORES),
+            help=f"comma separated stores to measure (default {','.join(STORES)})")
+    parser.add_argument("--bits", type=int, default=32,
+            help="ring id size M the key ids are taken from (default 32)")
+    parser.add_argument("--no-merkle", action="store_true",
+            help="leave out the Merkle tree the nodes keep over their store")
+    parser.add_argument("--overwrite", type=float, default=0.2,
+            help="fraction of entries written a second time with a new value, to exercise garbage and compaction (default 0.2)")
+    parser.add_argument("--lookups", type=int, default=200000,
+            help="random gets timed after loading (default 200000)")
+    parser.add_argument("--seed", type=int, default=0,
+            help="random seed for the values and the lookups (default 0)")
+    parser.add_argument("--output", type=str, default=None,
+            help="write the JSON report to this file instead of stdout")
+
+    return parser
+
+
+def make_entries(args):
+    """A function giving the i-th (key, key id, value), building fresh strings on every call.
+
+    Fresh strings keep the generator's own objects out of the store's measured footprint.
+    """
+    lo, _, hi = args.value_size.partition(",")
+    lo, hi = int(lo), int(hi or lo)
+    text = "".join(random.Random(args.seed).choice("abcdefghijklmnopqrstuvwxyz0123456789 ") for _ in range(4096))
+
+    def entry(i, version=0):
+        key = f"{i:0{args.key_size}x}"[-args.key_size:]
+        size = lo + (i * 2654435761 + version) % (hi - lo + 1)
+        start = (i * 7 + version * 13) % (len(text) - size)
+        return key, ring_hash(key, args.bits), text[start:start + size]
+
+    return entry, (lo + hi) / 2
+
+
+def load(name, args, entry):
+    store = STORES[name](None if args.no_merkle else MerkleTree(args.bits))
+    for i in range(args.entries):
+        store.put(*entry(i))
+    for i in range(int(args.entries * args.overwrite)):
+        store.put(*entry(i, 1))
+    return store
+
+
+def measure(name, args, entry):
+    """Memory of one store, traced while loading it, then put, get and scan speed on an untraced one."""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = load(name, args, entry)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del store
+    gc.collect()
+
+    started = time.perf_counter()
+    store = load(name, args, entry)
+    put_s = time.perf_counter() - started
+    rng = random.Random(args.seed)
+    keys = [entry(rng.randrange(args.entries))[0] for _ in range(args.lookups)]
+    started = time.perf_counter()
+    for key in keys:
+        store.get(key)
+    get_s = time.perf_counter() - started
+    started = time.perf_counter()
+    store.scan(0, 1000)
+    first_scan_s = time.perf_counter() - started
+    return {
+        "entries": len(store),
+        "bytes": used,
+        "bytes_per_entry": used / len(store),
+        "put_ns": put_s / (args.entries * (1 + args.overwrite)) * 1e9,
+        "get_ns": get_s / max(args.lookups, 1) * 1e9,
+        "first_scan_s": first_scan_s,
+    }
+
+
+def run(args):
+    entry, mean_value = make_entries(args)
+    results = {name: measure(name, args, entry) for name in args.stores.split(",")}
+    if "dict" in results:
+        for result in results.values():
+            result["memory_vs_dict"] = result["bytes"] / results["dict"]["bytes"]
+    return {
+        "config": {name: value for name, value in vars(args).items() if name != "output"},
+        "python": platform.python_version(),
+        "payload_bytes_per_entry": args.key_size + mean_value,
+        "stores": results,
+    }
+
+
+def main(args):
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        sys.stdout.write(text + "\n")
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    main(args)
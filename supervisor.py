@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import shlex
+import shutil
+import signal
+import tempfile
+import time
+
+from cluster import LocalCluster, request
+from server import HASHES, ring_hash
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="supervisor", description="Run a pool of ring node processes on one host")
+
+    parser.add_argument("host", type=str,
+            help="host name the workers bind to and are addressed by")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+            help=f"number of worker processes, one ring node each (default: one per core, {os.cpu_count()})")
+    parser.add_argument("--base-port", type=int, default=None,
+            help="give the workers consecutive ports from this one, skipping ports whose ring id is taken (default: free ports)")
+    parser.add_argument("--public-port", type=int, default=None,
+            help="port every worker also accepts clients on, through SO_REUSEPORT")
+    parser.add_argument("--join", type=str, default=None,
+            help="address of a node in an existing ring the workers join, e.g. a worker of another host's supervisor")
+    parser.add_argument("--socket-dir", type=str, default=None,
+            help="directory for the workers' Unix sockets (default: a fresh temporary directory)")
+    parser.add_argument("--no-restart", action="store_true",
+            help="do not restart workers that exit")
+    parser.add_argument("--hash", type=str, default="sha1", choices=HASHES,
+            help="hash giving the ring ids of keys and nodes, the same as the rest of the ring uses (default sha1)")
+    parser.add_argument("--timeout", type=float, default=60,
+            help="seconds to wait for the workers to come up and stabilize (default 60)")
+    parser.add_argument("--server-args", type=str, default="",
+            help="extra arguments passed to every server.py, as one quoted string")
+
+    return parser
+
+
+class Supervisor(LocalCluster):
+    """Worker processes on one host, each running one ring node.
+
+    The workers find each other through Unix sockets in a shared directory and
+    route between themselves over those instead of TCP. With a public port
+    they all accept clients on it, so one address per host spreads load over
+    every core. Workers that exit are restarted and rejoin the ring.
+    """
+
+    def __init__(self, workers, host, base_port=None, public_port=None, join=None, socket_dir=None, restart=True,
+                 server_args=(), timeout=60, hash_name="sha1"):
+        self.own_socket_dir = socket_dir is None
+        self.socket_dir = socket_dir or tempfile.mkdtemp(prefix="chord-")
+        local_args = ["--unix-socket-dir", self.socket_dir]
+        if public_port:
+            local_args += ["--public-port", str(public_port)]
+        super().__init__(workers, host=host, server_args=local_args + list(server_args), timeout=timeout, hash_name=hash_name)
+        self.base_port = base_port
+        self.nprime = join
+        self.restart = restart
+        self.restarts = {}
+
+    def pick_addresses(self):
+        if self.base_port is None:
+            return super().pick_addresses()
+        ids, port = set(), self.base_port
+        while len(self.addresses) < self.size:
+            address = f"{self.host}:{port}"
+            node_id = ring_hash(address, self.M, self.hash_name)
+            if node_id not in ids:
+                ids.add(node_id)
+                self.addresses.append(address)
+            port += 1
+
+    def start(self):
+        if self.nprime is None:
+            return super().start()
+        # The ring spans other hosts, so every worker joins it on its own
+        self.pick_addresses()
+        for address in self.addresses:
+            self.start_node(address, [address])
+        self.wait_until_ready(self.timeout)
+        for address in self.addresses:
+            request(address, "PUT", f"/join?nprime={self.nprime}", timeout=self.timeout)
+
+    def restart_worker(self, index):
+        """Start a worker again under its old address.
+
+        Its peers may still point at that address, and then /join would leave it
+        alone (network_accept ignores nodes it already knows). So it starts from
+        the local address list, and every peer is told about it through
+        /API/join, which only changes the peers that had dropped it.
+        """
+        address = self.addresses[index]
+        self.start_node(address, self.addresses)
+        self.processes[index] = self.processes.pop()
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                request(address, "GET", "/helloworld")
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    return
+                time.sleep(0.05)
+        for peer in [other for other in self.addresses if other != address] + ([self.nprime] if self.nprime else []):
+            try:
+                request(peer, "PUT", "/API/join", body=f"{address},{peer}", timeout=self.timeout)
+            except OSError:
+                continue
+
+    def supervise(self, interval=0.5):
+        while True:
+            for index, process in enumerate(self.processes):
+                if process.poll() is None or not self.restart:
+                    continue
+                # Back off workers that keep dying
+                restarts = [t for t in self.restarts.get(index, []) if time.monotonic() - t < 60]
+                if restarts and time.monotonic() - restarts[-1] < min(2 ** len(restarts), 30):
+                    continue
+                self.restarts[index] = restarts + [time.monotonic()]
+                print(f"worker {self.addresses[index]} exited with {process.returncode}, restarting", flush=True)
+                self.restart_worker(index)
+            time.sleep(interval)
+
+    def stop(self):
+        super().stop()
+        if self.own_socket_dir:
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+
+
+def main(args):
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+    server_args = shlex.split(args.server_args)
+    with Supervisor(args.workers, args.host, args.base_port, args.public_port, args.join, args.socket_dir,
+                    not args.no_restart, server_args, args.timeout, args.hash) as supervisor:
+        print(json.dumps(supervisor.addresses), flush=True)
+        try:
+            supervisor.supervise()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    main(args)
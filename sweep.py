@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import subprocess
+import time
+
+import bench
+from cluster import LocalCluster
+
+WORKLOADS = {
+    "read-heavy": ["--read-ratio", "0.9"],
+    "write-heavy": ["--read-ratio", "0.1"],
+    "zipf-read": ["--read-ratio", "0.95", "--distribution", "zipf"],
+}
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="sweep", description="Run the load generator against local rings of increasing size")
+
+    parser.add_argument("--nodes", type=str, default="1,2,4,8,16",
+            help="comma separated ring sizes to sweep (default 1,2,4,8,16)")
+    parser.add_argument("--workloads", type=str, default="read-heavy,write-heavy",
+            help=f"comma separated workloads out of {', '.join(WORKLOADS)} (default read-heavy,write-heavy)")
+    parser.add_argument("--repeat", type=int, default=3,
+            help="runs per ring size and workload (default 3)")
+    parser.add_argument("--results", type=str, default="results.ndjson",
+            help="file the run records are appended to (default results.ndjson)")
+    parser.add_argument("--label", type=str, default=None,
+            help="label stored with every record, e.g. a release name (default: current git revision)")
+    parser.add_argument("--in-process", action="store_true",
+            help="run the ring nodes as threads in this process")
+    parser.add_argument("--plot", type=str, default=None,
+            help="regenerate plots into this PDF when the sweep finishes")
+    parser.add_argument("bench_args", nargs=argparse.REMAINDER,
+            help="extra arguments passed to bench.py after --, e.g. -- --duration 5 --concurrency 16")
+
+    return parser
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_sweep(args):
+    label = args.label or git_revision()
+    bench_args = [arg for arg in args.bench_args if arg != "--"]
+    for size in [int(n) for n in args.nodes.split(",")]:
+        for workload in args.workloads.split(","):
+            for repeat in range(args.repeat):
+                with LocalCluster(size, in_process=args.in_process) as cluster:
+                    argv = cluster.addresses + ["--trace-sample", "0.05"] + WORKLOADS[workload] + bench_args
+                    report = bench.run(bench.arg_parser().parse_args(argv))
+                record = {
+                    "label": label,
+                    "time": time.time(),
+                    "nodes": size,
+                    "workload": workload,
+                    "repeat": repeat,
+                    "report": report,
+                }
+                with open(args.results, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+                print(f"{label} {workload} nodes={size} run={repeat}: {report['throughput_ops']:.1f} ops/s, "
+                      f"p99 {report['latency']['all'].get('p99_ms')} ms, errors {report['errors']}", flush=True)
+
+
+def main(args):
+    run_sweep(args)
+    if args.plot:
+        import plot
+        plot.plot_results(plot.load_results(args.results), args.plot)
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    main(args)
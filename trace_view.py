@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+import argparse
+import http.client
+import json
+
+BAR_WIDTH = 40
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="trace_view", description="Render lookup traces as hop waterfalls")
+
+    parser.add_argument("node", type=str,
+            help="address (host:port) of the entry node")
+    parser.add_argument("--key", type=str, default=None,
+            help="issue a traced GET for this key instead of reading the node's recent traces")
+    parser.add_argument("--limit", type=int, default=10,
+            help="number of recent traces to show (default 10)")
+
+    return parser
+
+
+def fetch_traces(node, limit):
+    conn = http.client.HTTPConnection(node, timeout=10)
+    try:
+        conn.request("GET", f"/traces?limit={limit}")
+        resp = conn.getresponse()
+        return json.loads(resp.read())
+    finally:
+        conn.close()
+
+
+def traced_get(node, key):
+    conn = http.client.HTTPConnection(node, timeout=10)
+    try:
+        conn.request("GET", "/storage/" + key, headers={"X-Chord-Trace": "1"})
+        resp = conn.getresponse()
+        resp.read()
+        hops = json.loads(resp.getheader("X-Chord-Trace-Hops", "[]"))
+        return {
+            "trace_id": resp.getheader("X-Chord-Trace"),
+            "method": "GET",
+            "key": key,
+            "status": resp.status,
+            "ms": hops[0]["ms"] if hops else None,
+            "hops": hops,
+        }
+    finally:
+        conn.close()
+
+
+def render(trace):
+    """Draw each hop as a bar nested inside the previous one.
+
+    Hops only report inclusive time, and node clocks are not synchronized, so each
+    hop's bar is centred inside its parent: the gap is split evenly between the
+    request and the response leg.
+    """
+    hops = trace["hops"]
+    total = trace["ms"] or 0.0
+    lines = [f"trace {trace['trace_id']} {trace['method']} {trace['key']} -> {trace['status']} "
+             f"in {total:.2f} ms ({len(hops) - 1} hops)"]
+    offset = 0.0
+    parent = total
+    for i, hop in enumerate(hops):
+        ms = hop["ms"] if hop["ms"] is not None else parent
+        offset += (parent - ms) / 2
+        parent = ms
+        next_ms = hops[i + 1]["ms"] if i + 1 < len(hops) and hops[i + 1]["ms"] is not None else 0.0
+        scale = BAR_WIDTH / total if total else 0
+        start = int(round(offset * scale))
+        width = max(1, int(round(ms * scale)))
+        bar = " " * start + "#" * width
+        lines.append(f"  {hop['node']:<24} {hop['node_id']:>8}  {hop['decision']:<32} |{bar:<{BAR_WIDTH}}| "
+                     f"{ms:8.2f} ms (self {ms - next_ms:.2f})")
+    return "\n".join(lines)
+
+
+def main(args):
+    traces = [traced_get(args.node, args.key)] if args.key else fetch_traces(args.node, args.limit)
+    if not traces:
+        print(f"No traces recorded on {args.node}")
+    for trace in traces:
+        print(render(trace))
+        print()
+
+
+if __name__ == "__main__":
+    parser = arg_parser()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,153 @@
+import http.client
+import os
+import socket
+import threading
+
+# Errors a reused keep-alive connection gives when the peer closed it while idle
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.CannotSendRequest, BrokenPipeError, ConnectionResetError)
+
+
+def unix_socket_path(socket_dir, address):
+    """Where a node sharing `socket_dir` with us listens for its co-located peers."""
+    return os.path.join(socket_dir, f"{address}.sock")
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP over a Unix socket, falling back to TCP to `tcp_address` when the socket is gone or refuses."""
+
+    def __init__(self, path, timeout=None, tcp_address=None):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = path
+        self.tcp_address = tcp_address
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        try:
+            self.sock.connect(self.unix_path)
+        except OSError as e:
+            self.sock.close()
+            self.sock = None
+            if self.tcp_address is None or not isinstance(e, (FileNotFoundError, ConnectionRefusedError)):
+                raise
+            host, port = self.tcp_address.rsplit(":", 1)
+            self.sock = socket.create_connection((host, int(port)), self.timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class ConnectionPool:
+    """Idle keep-alive connections to one node, reused most recent first.
+
+    With `unix_path` set the node is reached over that Unix socket instead of TCP
+    while the socket exists. Every new connection checks again, so a peer whose
+    socket appears later moves to it, and one whose socket went away is reached
+    over TCP.
+    """
+
+    def __init__(self, address, size=8, timeout=10, unix_path=None):
+        self.address = address
+        self.size = size
+        self.timeout = timeout
+        self.unix_path = unix_path
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def connect(self, timeout=None):
+        if self.unix_path and os.path.exists(self.unix_path):
+            return UnixHTTPConnection(self.unix_path, timeout=timeout or self.timeout, tcp_address=self.address)
+        return http.client.HTTPConnection(self.address, timeout=timeout or self.timeout)
+
+    def acquire(self):
+        """Return (connection, reused)."""
+        with self.lock:
+            if self.idle:
+                return self.idle.pop(), True
+        return self.connect(), False
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        """Return (status, body, headers dict, reused). Connection failures raise OSError.
+
+        The body is text, or the raw bytes when the response has a Content-Encoding.
+        """
+        conn, reused = self.acquire()
+        conn.timeout = timeout or self.timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(conn.timeout)
+        try:
+            conn.request(method, url, body=body, headers=headers or {})
+            response = conn.getresponse()
+            data = response.read()
+        except STALE_CONNECTION_ERRORS:
+            conn.close()
+            if not reused:
+                raise
+            # The idle connection was closed under us; a fresh one says whether the node is really gone
+            conn, reused = self.connect(timeout), False
+            try:
+                conn.request(method, url, body=body, headers=headers or {})
+                response = conn.getresponse()
+                data = response.read()
+            except BaseException:
+                conn.close()
+                raise
+        except BaseException:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self.release(conn)
+        headers = dict(response.getheaders())
+        return response.status, data if "Content-Encoding" in headers else data.decode(), headers, reused
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+
+class HttpTransport:
+    """Sends node-to-node requests over HTTP, keeping a pool of idle connections per peer.
+
+    Every outgoing request a Node makes goes through `request`, so the simulator
+    (and anything else that wants to intercept ring traffic) can swap in its own
+    transport with the same signature. Peers with a socket in `socket_dir` run on
+    this host, under the same supervisor, and are reached over that Unix socket.
+    """
+
+    def __init__(self, timeout=10, pool_size=4, connections=None, socket_dir=None):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.connections = connections  # optional Counter labelled by whether a connection was reused
+        self.socket_dir = socket_dir
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def pool(self, address):
+        pool = self.pools.get(address)
+        if pool is None:
+            unix_path = unix_socket_path(self.socket_dir, address) if self.socket_dir else None
+            with self.lock:
+                pool = self.pools.setdefault(address, ConnectionPool(address, self.pool_size, self.timeout, unix_path))
+        return pool
+
+    def request(self, address, method, url, body=None, headers=None, timeout=None):
+        """Return (status, body, headers dict) as ConnectionPool.request does. Connection failures raise OSError."""
+        status, text, response_headers, reused = self.pool(address).request(method, url, body, headers, timeout)
+        if self.connections is not None:
+            self.connections.inc(("true" if reused else "false",))
+        return status, text, response_headers
+
+    def close(self):
+        with self.lock:
+            pools, self.pools = list(self.pools.values()), {}
+        for pool in pools:
+            pool.close()